@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""
+benchmark.py
+
+Benchmarks for the vcf_parse.py program. Times each stage of making a
+variant report for a set of input VCFs and reports the throughput. Can
+also run itself under several Python interpreters, and with each VCF
+reader backend and report engine, to compare them on the same inputs.
+
+Usage:  benchmark.py [-h] [-r REPEAT] [-p PYTHON [PYTHON ...]]
+                     [-b BACKEND [BACKEND ...]] [-e ENGINE [ENGINE ...]]
+                     [-c CONFIG] [--json] [input [input ...]]
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import platform
+import subprocess
+
+from scripts.vcf_report import vcf_report
+from scripts.preferred_transcripts import preferred_transcripts
+from scripts.known_variants import known_variants
+from scripts.vcf_backends import choose_backend
+from scripts.columnar_engine import columnar_engine, choose_engine
+
+
+# default inputs, relative to this file
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_INPUTS = [
+    os.path.join(HERE, 'test', 'test.vcf'),
+    os.path.join(HERE, 'test', 'edge_variants.vcf'),
+]
+TRANSCRIPTS = os.path.join(HERE, 'test', 'PreferredTranscripts.txt')
+KNOWN_VARIANTS = os.path.join(HERE, 'test', 'KnownVariants.vcf')
+
+
+# -- BENCHMARKS -------------------------------------------------------
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return(values[mid])
+    return((values[mid - 1] + values[mid]) / 2.0)
+
+
+def time_startup(python, repeat):
+    """
+    Time taken to start the interpreter and import PyVCF, this is paid
+    by every run of vcf_parse.py.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        subprocess.check_call([python, '-c', 'import vcf, csv'])
+        times.append(time.time() - start)
+    return(median(times))
+
+
+def time_pipeline(inp, out_dir, repeat, backend='pyvcf', engine='row',
+        config=None):
+    """
+    Time each stage of making a variant report for a single input,
+    returns the median time of each stage over all repeats.
+    """
+    stages = ['load_data', 'make_report', 'preferred_transcripts',
+              'known_variants', 'write_report']
+    times = dict((stage, []) for stage in stages)
+
+    pt = preferred_transcripts()
+    pt.load(TRANSCRIPTS)
+    known = known_variants()
+    known.load_known_variants(KNOWN_VARIANTS, backend)
+
+    for i in range(repeat):
+        start = time.time()
+        report = vcf_report(backend=backend)
+        report.load_data(inp, out_dir)
+        times['load_data'].append(time.time() - start)
+        if config:
+            report.config = config
+        if engine == 'columnar':
+            report.engine = columnar_engine(report)
+
+        start = time.time()
+        report.make_report(False)
+        times['make_report'].append(time.time() - start)
+
+        start = time.time()
+        pt.apply(report, 'low')
+        times['preferred_transcripts'].append(time.time() - start)
+
+        start = time.time()
+        known.apply_known_variants(report)
+        times['known_variants'].append(time.time() - start)
+
+        start = time.time()
+        report.write_report()
+        times['write_report'].append(time.time() - start)
+
+    rows = len(report.table.rows)
+
+    result = dict((stage, median(times[stage])) for stage in stages)
+    result['total'] = sum(result[stage] for stage in stages)
+    result['records'] = len(report.data)
+    result['rows'] = rows
+    result['records_per_second'] = result['records'] / result['total']
+    result['rows_per_second'] = result['rows'] / result['total']
+    return(result)
+
+
+def run_benchmarks(inputs, repeat, backend='pyvcf', engine='row', 
+        config_file=None):
+    """
+    Runs all benchmarks in this interpreter with one backend and engine,
+    returns the results
+    """
+    backend = choose_backend(backend)
+    engine = choose_engine(engine)
+    config = None
+    if config_file:
+        report = vcf_report()
+        report.load_config(config_file)
+        config = report.config
+    out_dir = tempfile.mkdtemp()
+    try:
+        results = {
+            'python': platform.python_version(),
+            'executable': sys.executable,
+            'backend': backend,
+            'engine': engine,
+            'startup': time_startup(sys.executable, min(repeat, 5)),
+            'inputs': {}
+        }
+        for inp in inputs:
+            results['inputs'][os.path.basename(inp)] = time_pipeline(
+                inp, out_dir, repeat, backend, engine, config)
+    finally:
+        shutil.rmtree(out_dir)
+    return(results)
+
+
+# -- OUTPUT -----------------------------------------------------------
+
+def print_results(all_results):
+    """
+    Prints a table of results, one column per interpreter, backend and
+    engine.
+    If more than one was run, the speedup relative to the first is shown.
+    """
+    base = all_results[0]
+    if len(all_results) > 1:
+        print('ratio to {} ({} {}) shown in brackets\n'.format(
+            base['executable'], base.get('backend', 'pyvcf'), 
+            base.get('engine', 'row')))
+    names = ['{} {} {}'.format(r['python'], r.get('backend', 'pyvcf'),
+             r.get('engine', 'row')) for r in all_results]
+    print('{:<42}'.format('') + ''.join('{:>22}'.format(n) for n in names))
+
+    def row(label, values, fmt):
+        line = '{:<42}'.format(label)
+        for i, value in enumerate(values):
+            cell = fmt.format(value)
+            if i > 0 and values[0]:
+                cell += ' ({:.2f}x)'.format(value / values[0])
+            line += '{:>22}'.format(cell)
+        print(line)
+
+    row('startup + import (s)', [r['startup'] for r in all_results], '{:.3f}')
+    for inp in sorted(base['inputs']):
+        print('\n{} - {} records, {} rows'.format(
+            inp, base['inputs'][inp]['records'], base['inputs'][inp]['rows']))
+        for stage in ('load_data', 'make_report', 'preferred_transcripts',
+                      'known_variants', 'write_report', 'total'):
+            row('  {} (s)'.format(stage),
+                [r['inputs'][inp][stage] for r in all_results], '{:.4f}')
+        row('  records/s',
+            [r['inputs'][inp]['records_per_second'] for r in all_results], '{:.0f}')
+        row('  rows/s',
+            [r['inputs'][inp]['rows_per_second'] for r in all_results], '{:.0f}')
+
+
+# -- MAIN FUNCTION ----------------------------------------------------
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks vcf_parse.py on a set of input VCFs.')
+    parser.add_argument(
+        'input', nargs='*', default=DEFAULT_INPUTS,
+        help='Input VCFs to benchmark, defaults to the test VCFs.')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=10,
+        help='Number of times to repeat each benchmark. Default is 10.')
+    parser.add_argument(
+        '-p', '--python', nargs='+',
+        help='Run the benchmarks under each of these Python interpreters '
+             'and compare them, e.g. -p python2.7 python3.')
+    parser.add_argument(
+        '-b', '--backend', nargs='+', default=['pyvcf'],
+        help='VCF reader backends to benchmark, e.g. -b pyvcf pysam. '
+             'Default is pyvcf.')
+    parser.add_argument(
+        '-e', '--engine', nargs='+', default=['row'],
+        help='Report engines to benchmark, e.g. -e row columnar. Default '
+             'is row.')
+    parser.add_argument(
+        '-c', '--config', 
+        help='Config file to make the reports with, defaults to all '
+             'columns.')
+    parser.add_argument(
+        '--json', action='store_true',
+        help='Print results as JSON instead of a table.')
+    return parser.parse_args()
+
+
+def main(args):
+    logging.getLogger('vcf_parse').addHandler(logging.NullHandler())
+    inputs = [os.path.abspath(inp) for inp in args.input]
+
+    # run under each interpreter in turn, or just this one, with each
+    # backend and engine
+    config = os.path.abspath(args.config) if args.config else None
+    all_results = []
+    for backend in args.backend:
+        for engine in args.engine:
+            if args.python:
+                for python in args.python:
+                    command = [python, os.path.abspath(__file__), '--json',
+                        '-r', str(args.repeat), '-b', backend, '-e', engine]
+                    if config:
+                        command += ['-c', config]
+                    output = subprocess.check_output(command + inputs)
+                    all_results.append(json.loads(output.decode('utf-8')))
+            else:
+                all_results.append(run_benchmarks(
+                    inputs, args.repeat, backend, engine, config))
+
+    if args.json:
+        print(json.dumps(all_results[0] if len(all_results) == 1
+            else all_results, indent=1, sort_keys=True))
+    else:
+        print_results(all_results)
+
+
+if __name__ == '__main__':
+    main(get_args())
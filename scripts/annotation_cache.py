@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+annotation_cache.py
+
+Object that keeps the finished VEP columns of each transcript between
+runs, so that variants seen in earlier samples don't need their CSQ
+entries split and formatted again. Entries are keyed by the variant and
+a hash of the CSQ entry, kept in least recently used order and saved to
+a file at the end of each run. Once the cache is full, the least
+recently used entries are removed.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# changed if the format of the cache file changes, older files are ignored
+CACHE_VERSION = 1
+
+# returned by get when a key isn't in the cache
+MISSING = object()
+
+
+def csq_hash(prefix, entry):
+    """
+    Hash of a CSQ entry. prefix identifies the VEP fields in the VCF
+    and the columns in the report, so the same entry gives a different
+    hash if these change.
+    """
+    return(hashlib.sha1((prefix + entry).encode('utf-8')).digest())
+
+
+def merge_used(cache, used):
+    """
+    Add the keys used by a worker_cache to cache, in the order they
+    were used. New entries are added and the others marked as used.
+    """
+    for key, new, value in used:
+        if new:
+            cache.put(key, value)
+        else:
+            cache.get(key)
+
+
+# -- ANNOTATION CACHE CLASS -------------------------------------------
+
+class annotation_cache:
+    def __init__(self, path=None, max_entries=100000):
+        """
+        Object properties that are loaded when the oject is created.
+        path is the file the cache is saved to, if None the cache is
+        only kept in memory. max_entries is the most transcripts kept.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.cache')
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+
+    def load(self):
+        """Load the cache from its file, if there is one"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                version, entries = pickle.load(f)
+        except Exception:
+            self.logger.warning(
+                'could not read annotation cache {} -- starting a new '
+                'cache'.format(self.path))
+            return
+        if version != CACHE_VERSION:
+            self.logger.info('annotation cache {} is from an older '
+                'version -- starting a new cache'.format(self.path))
+            return
+
+        with self.lock:
+            self.entries = OrderedDict(entries)
+            self.trim()
+        self.logger.info('loaded annotation cache {} - {} entries'.format(
+            self.path, len(self.entries)))
+
+
+    def save(self):
+        """
+        Save the cache to its file. The file is written under a
+        temporary name and renamed, so a failed save never leaves a
+        half written cache.
+        """
+        if not self.path:
+            return
+        with self.lock:
+            entries = list(self.entries.items())
+
+        folder = os.path.dirname(os.path.abspath(self.path))
+        fd, temp = tempfile.mkstemp(dir=folder, suffix='.temp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((CACHE_VERSION, entries), f,
+                    pickle.HIGHEST_PROTOCOL)
+            os.rename(temp, self.path)
+        except Exception:
+            os.remove(temp)
+            raise
+        self.logger.info('saved annotation cache {} - {} entries'.format(
+            self.path, len(entries)))
+
+
+    def get(self, key):
+        """Cached value for a key, or MISSING. Marks the key as used"""
+        with self.lock:
+            value = self.entries.pop(key, MISSING)
+            if value is not MISSING:
+                self.entries[key] = value
+        return(value)
+
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            self.trim()
+
+
+    def resize(self, max_entries):
+        """Change the most transcripts kept, trimming the cache to fit"""
+        with self.lock:
+            self.max_entries = max_entries
+            self.trim()
+
+
+    def __len__(self):
+        with self.lock:
+            return(len(self.entries))
+
+
+    def trim(self):
+        """Remove the least recently used entries, lock must be held"""
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+
+# -- WORKER CACHE CLASS -----------------------------------------------
+
+class worker_cache:
+    def __init__(self, cache):
+        """
+        Object properties that are loaded when the oject is created.
+        Used in place of an annotation cache by a worker process (see
+        parallel_parse.py). Entries are read from cache, which is not
+        changed. Every key looked up is kept in used, in order, with
+        the value of each new entry, so the main process can add them
+        to its own cache as if it had made the rows itself.
+        """
+        self.cache = cache
+        self.added = {}
+        self.used = []
+
+
+    def get(self, key):
+        value = self.added.get(key, MISSING)
+        if value is MISSING:
+            value = self.cache.get(key)
+        if value is not MISSING:
+            self.used.append((key, False, None))
+        return(value)
+
+
+    def put(self, key, value):
+        self.added[key] = value
+        self.used.append((key, True, value))
+
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+api.py
+
+Importable interface to the vcf_parse.py program, for use from other
+Python programs. Makes the rows of a variant report from a VCF one at
+a time, without writing anything to disk. The same vcf_parser object
+can be used for any number of VCFs, including from several threads at
+once.
+
+Example:
+
+    from scripts.api import vcf_parser
+
+    parser = vcf_parser(config='config.txt', transcripts='pt.txt')
+    rows = parser.parse('sample.vcf')
+    for row in rows:
+        print(row.chrom, row.pos, rows.table.value(row, 'SYMBOL'))
+"""
+
+
+import logging
+
+from scripts.vcf_report import vcf_report
+from scripts.report_table import report_table
+from scripts.file_utils import open_text
+from scripts.preferred_transcripts import preferred_transcripts
+from scripts import known_variants as kv
+
+
+# library users may not set up logging, don't warn about it
+logging.getLogger('vcf_parse').addHandler(logging.NullHandler())
+
+
+# -- ANNOTATION -------------------------------------------------------
+
+def annotate_rows(rows, table, config, transcripts, strictness, known):
+    """
+    Chains the preferred transcripts and known variants steps onto an
+    iterator of report rows, either can be None to skip it. Any columns
+    that need adding are added to the table straight away, so the 
+    header is complete before the first row is made.
+    """
+    if transcripts is not None and transcripts.list:
+        columns = transcripts.find_columns(table, config)
+        if columns is not None:
+            rows = transcripts.annotate_rows(rows, columns, strictness)
+
+    if known is not None and known.list:
+        column = known.find_column(table, config)
+        rows = known.annotate_rows(rows, column)
+
+    return(rows)
+
+
+# -- REPORT ROWS CLASS ------------------------------------------------
+
+class report_rows(object):
+    """
+    Iterator over the rows of a variant report, returned by
+    vcf_parser.parse. Each row is a report_row object with chrom, pos,
+    ref and alt fields, and the value of every column in values. INFO
+    and FORMAT values that aren't reformatted are typed as decoded from
+    the VCF rather than text (see report_row).
+
+    Attributes:
+        sample  - sample name from the VCF
+        header  - list of column names, in the same order as values
+        table   - report_table with no rows, table.column(name),
+                  table.value(row, name) and table.text(row, name)
+                  look up columns by name
+    """
+    def __init__(self, report, table, rows):
+        self.sample = report.sample
+        self.header = table.header
+        self.table = table
+        self.rows = rows
+
+
+    def __iter__(self):
+        return(self)
+
+
+    def __next__(self):
+        return(next(self.rows))
+
+    next = __next__
+
+
+# -- PARSER CLASS -----------------------------------------------------
+
+class vcf_parser:
+    def __init__(self, config=None, transcripts=None,
+                 transcript_strictness='low', known_variants=None,
+                 filter_non_pass=False):
+        """
+        Load the reference data used for every VCF parsed. Options are
+        the same as the vcf_parse.py command line:
+
+            config                - config filepath, or a list of
+                                    [annotation, source, header] lists
+            transcripts           - preferred transcripts filepath, or a
+                                    loaded preferred_transcripts object
+            transcript_strictness - 'high' or 'low'
+            known_variants        - known variants VCF filepath, or a
+                                    loaded known_variants object
+            filter_non_pass       - skip variants that aren't PASS
+        """
+        self.logger = logging.getLogger('vcf_parse.api')
+
+        # config
+        if config is None or isinstance(config, list):
+            self.config = config
+        else:
+            report = vcf_report()
+            report.load_config(config)
+            self.config = report.config
+
+        # preferred transcripts
+        if transcripts is None or isinstance(transcripts, preferred_transcripts):
+            self.transcripts = transcripts
+        else:
+            self.transcripts = preferred_transcripts()
+            self.transcripts.load(transcripts)
+
+        # known variants
+        if known_variants is None or isinstance(known_variants, kv.known_variants):
+            self.known_variants = known_variants
+        else:
+            self.known_variants = kv.known_variants()
+            self.known_variants.load_known_variants(known_variants)
+
+        self.transcript_strictness = transcript_strictness
+        self.filter_non_pass = filter_non_pass
+
+
+    def parse(self, vcf_input):
+        """
+        Parse a VCF, vcf_input can be a filepath (plain text or gzip 
+        compressed) or an open file object.
+        Returns a report_rows iterator, the rows are made as they are
+        read so the whole VCF is never held in memory.
+        """
+        # open file if a path is given, it is closed once all rows are read
+        if hasattr(vcf_input, 'read'):
+            vcf_file = None
+        else:
+            vcf_file = open_text(vcf_input, 'r')
+            vcf_input = vcf_file
+
+        report = vcf_report()
+        reader = report.read_header(vcf_input)
+        report.config = self.config
+        table = report_table(report.make_header())
+
+        # chain together the steps that make and annotate each row
+        rows = report.iter_report(
+            self.filter_non_pass, records=self.read_records(reader, vcf_file))
+
+        rows = annotate_rows(rows, table, self.config, self.transcripts,
+            self.transcript_strictness, self.known_variants)
+
+        return(report_rows(report, table, rows))
+
+
+    def read_records(self, reader, vcf_file):
+        """Yields VCF records, closing the file at the end if needed"""
+        try:
+            for record in reader:
+                yield record
+        finally:
+            if vcf_file is not None:
+                vcf_file.close()
+
+
+def parse_vcf(vcf_input, **options):
+    """
+    Parse a single VCF, options are the same as for vcf_parser. Returns
+    a report_rows iterator.
+    """
+    return(vcf_parser(**options).parse(vcf_input))
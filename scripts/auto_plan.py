@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+"""
+auto_plan.py
+
+Chooses how to make the report of a VCF from a quick pre-scan of it,
+so the best options don't have to be known for each input. The scan
+reads the header and a sample of the records to find the size of the
+VCF (estimated from the compression of its start if it is compressed),
+whether it has an index, the number of samples, the number of records,
+the CSQ entries and NM transcripts of each record and the number of
+report columns. From these the time and memory of each way of making
+the report are estimated: in memory (with several processes if the
+VCF can be split), pipelined, or in ranges one after the other. The
+fastest that fits in the --max_memory budget is used, along with the
+engine and whether to read the record cache.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import zlib
+import logging
+import multiprocessing
+
+from scripts.vcf_report import vcf_report
+from scripts.file_utils import open_text, STDIO
+from scripts.parallel_parse import can_map, CHUNKS_PER_WORKER
+from scripts.columnar_engine import available_engines, ENGINES
+from scripts.record_cache import CACHE_SUFFIX
+from scripts.pipeline import BATCH_SIZE
+
+
+# number of records read by the pre-scan
+SAMPLE_RECORDS = 1000
+
+# compressed bytes read to estimate the size of a compressed VCF
+COMPRESSED_SAMPLE = 1024 * 1024
+
+# estimates of time and memory, measured with PyVCF on a 63 MB VCF with
+# 9 CSQ entries for each record. Memory used by the program before any
+# records are read, memory for each byte of the records held, and for
+# each row and column of the report
+BASE_MEMORY = 40 * 1024 * 1024
+RECORD_MEMORY = 2.0
+ROW_MEMORY = 200
+CELL_MEMORY = 28
+
+# seconds to parse each byte of the records, and to make each column of
+# each row
+RECORD_SECONDS = 5e-8
+CELL_SECONDS = 1.2e-6
+
+# smallest part of the VCF worth giving to each process
+PROCESS_MIN_SIZE = 32 * 1024 * 1024
+
+# the columnar engine is only faster with a config, and for enough
+# records to fill several batches
+COLUMNAR_MIN_RECORDS = 10000
+
+# smallest range made when the report is made in ranges
+MIN_RANGE_SIZE = 1024 * 1024
+
+MB = 1024.0 * 1024.0
+
+
+def compression_ratio(path):
+    """
+    Uncompressed bytes for each compressed byte at the start of a gzip
+    (or bgzip) compressed file
+    """
+    with open(path, 'rb') as f:
+        data = f.read(COMPRESSED_SAMPLE)
+    read = len(data)
+    out = 0
+
+    # bgzip files are made of many gzip members, each is decompressed
+    # in turn until the sample runs out part way through one
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            out += len(decompressor.decompress(data))
+        except zlib.error:
+            break
+        data = decompressor.unused_data
+    if not read or not out:
+        return(1.0)
+    return(float(out) / read)
+
+
+def index_path(path):
+    """Filepath of the tabix or CSI index of a VCF, None if it has none"""
+    for suffix in ('.tbi', '.csi'):
+        if os.path.exists(path + suffix):
+            return(path + suffix)
+    return(None)
+
+
+def config_columns(path):
+    """Number of columns a config file adds to the report"""
+    with open(path) as config:
+        return(len([line for line in config if line.strip()]))
+
+
+def bed_count(bed, bed_folder):
+    """Number of BED files applied to the report"""
+    if bed:
+        return(1)
+    if bed_folder and os.path.isdir(bed_folder):
+        return(len([name for name in os.listdir(bed_folder)
+                    if name.endswith('.bed')]))
+    return(0)
+
+
+def prescan(path, config_files=(), bed=None, bed_folder=None):
+    """
+    Quick scan of a VCF, returns a dictionary of what was found. Only
+    the header and the first SAMPLE_RECORDS records are read, the
+    number of records is estimated from the size of those.
+    """
+    scan = {
+        'path': path,
+        'size': os.path.getsize(path),
+        'compressed': path.endswith('.gz'),
+        'index': index_path(path),
+        'beds': bed_count(bed, bed_folder),
+    }
+    scan['uncompressed'] = scan['size']
+    if scan['compressed']:
+        scan['uncompressed'] = int(scan['size'] * compression_ratio(path))
+
+    header = []
+    header_bytes = 0
+    records = 0
+    record_bytes = 0
+    entries = 0
+    transcripts = 0
+    complete = True
+    feature = None
+    report = vcf_report()
+    with open_text(path, 'r') as vcf_input:
+        for line in vcf_input:
+            if line.startswith('#'):
+                header.append(line)
+                header_bytes += len(line)
+                if line.startswith('#CHROM'):
+                    report.read_header(iter(header))
+                    if 'Feature' in report.vep_fields:
+                        feature = report.vep_fields.index('Feature')
+                    scan['samples'] = len(line.rstrip('\n').split('\t')[9:])
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 8:
+                continue
+            if records == SAMPLE_RECORDS:
+                complete = False
+                break
+            records += 1
+            record_bytes += len(line)
+
+            # a variant has a row for each different NM entry, or one
+            # row if it has no CSQ field (see vcf_report.iter_reports)
+            csq = None
+            for field in fields[7].split(';'):
+                if field.startswith('CSQ='):
+                    csq = set(field[4:].split(','))
+            if csq is None or feature is None:
+                transcripts += 1
+            else:
+                entries += len(csq)
+                for entry in csq:
+                    values = entry.split('|')
+                    if len(values) > feature and \
+                            values[feature].startswith('NM'):
+                        transcripts += 1
+
+    # the average record size gives the number of records in the rest
+    # of the file
+    scan['record_bytes'] = float(record_bytes) / records if records else 0.0
+    if complete or not records:
+        scan['records'] = records
+    else:
+        scan['records'] = int((scan['uncompressed'] - header_bytes) /
+                              scan['record_bytes'])
+    scan['data_bytes'] = int(scan['records'] * scan['record_bytes'])
+    scan['csq_entries'] = float(entries) / records if records else 0.0
+    scan['transcripts'] = float(transcripts) / records if records else 1.0
+
+    # columns of the report made with each config
+    if config_files:
+        scan['columns'] = [config_columns(each) + 2 for each in config_files]
+    else:
+        scan['columns'] = [len(report.make_header())]
+    return(scan)
+
+
+# -- RUN PLAN CLASS ---------------------------------------------------
+
+class run_plan:
+    def __init__(self, args, cpus=None):
+        """
+        Object properties that are loaded when the oject is created.
+        args are the command line arguments, the options chosen are set
+        on them by apply. cpus is the number of processes that can run
+        at once, by default the number of CPUs.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.plan')
+        self.args = args
+        self.cpus = cpus or multiprocessing.cpu_count()
+        self.budget = None
+        if args.max_memory:
+            self.budget = args.max_memory * MB
+        self.scan = None
+        self.plan = None
+
+
+    def apply(self):
+        """
+        Scan the input, choose the plan, set its options on args and log
+        it. Returns the plan, or None if the input can't be scanned.
+        """
+        args = self.args
+        if args.input == STDIO:
+            self.logger.info('stdin cannot be pre-scanned -- options are '
+                'not changed')
+            return(None)
+        self.scan = prescan(args.input, args.config or (), args.bed,
+                            args.bed_folder)
+        self.plan = self.choose()
+
+        plan = self.plan
+        args.processes = plan['processes']
+        args.pipeline = plan['strategy'] == 'pipeline'
+        if plan['strategy'] == 'ranges':
+            args.checkpoint = True
+            args.checkpoint_size = plan['range_size'] / MB
+        args.engine = plan['engine']
+        args.record_cache = plan['record_cache']
+        self.log_plan()
+        return(plan)
+
+
+    def choose(self):
+        """
+        Plan with the fastest way of making the report that fits in the
+        memory budget, or the one that uses least memory if none fit.
+        Options set on the command line are kept.
+        """
+        args = self.args
+        scan = self.scan
+        plan = {
+            'backend': args.backend,
+            'engine': args.engine,
+            'record_cache': args.record_cache,
+        }
+
+        # the columnar engine is only faster for the numeric columns
+        # picked out by a config
+        if args.engine == ENGINES[0] and args.config and \
+                'columnar' in available_engines() and \
+                scan['records'] >= COLUMNAR_MIN_RECORDS:
+            plan['engine'] = 'columnar'
+
+        # decoded records are read from the record cache if it is there
+        # and newer than the VCF. PyVCF is kept as the reader, as pysam
+        # is no faster for a whole VCF and holds more memory
+        cache = os.path.abspath(args.input) + CACHE_SUFFIX
+        if not args.record_cache and os.path.exists(cache) and \
+                os.path.getmtime(cache) >= os.path.getmtime(args.input):
+            plan['record_cache'] = True
+
+        candidates = self.candidates()
+        fits = [each for each in candidates if self.budget is None or
+                each['memory'] <= self.budget]
+        if fits:
+            chosen = fits[0]
+        else:
+            chosen = min(candidates, key=lambda each: each['memory'])
+            self.logger.warning('no plan is estimated to fit in {:.0f} MB -- '
+                'using the plan that needs least memory'.format(
+                self.budget / MB))
+        plan.update(chosen)
+
+        # the record cache is only read by a single process making the
+        # report in memory
+        if plan['strategy'] != 'memory' or plan['processes'] > 1:
+            plan['record_cache'] = False
+        return(plan)
+
+
+    def candidates(self):
+        """
+        Ways the report can be made with the options given, fastest
+        first, with their estimated time and memory
+        """
+        args = self.args
+        scan = self.scan
+        splittable = can_map(args.input)
+        configs = len(scan['columns'])
+
+        if args.pipeline:
+            return([self.estimate('pipeline')])
+        if args.checkpoint or args.resume:
+            return([self.estimate('ranges',
+                range_size=args.checkpoint_size * MB)])
+
+        out = []
+        processes = args.processes
+        if processes == 1 and splittable:
+            processes = min(self.cpus, scan['data_bytes'] // PROCESS_MIN_SIZE)
+        if processes > 1:
+            out.append(self.estimate('memory', processes=processes))
+        if args.processes == 1:
+            out.append(self.estimate('memory'))
+            if configs == 1:
+                out.append(self.estimate('pipeline'))
+            if splittable and not (args.stdout or args.sort_by or
+                    args.dedup or args.partition_by):
+                out.append(self.estimate('ranges'))
+        return(out)
+
+
+    def estimate(self, strategy, processes=1, range_size=None):
+        """Estimated time and memory of a way of making the report"""
+        scan = self.scan
+        rows = int(scan['records'] * scan['transcripts'])
+        records_memory = scan['data_bytes'] * RECORD_MEMORY
+        rows_memory = rows * (ROW_MEMORY * len(scan['columns']) +
+                              CELL_MEMORY * sum(scan['columns']))
+        seconds = scan['data_bytes'] * RECORD_SECONDS + \
+            rows * sum(scan['columns']) * CELL_SECONDS
+        per_byte = (records_memory + rows_memory) / max(1, scan['data_bytes'])
+
+        if strategy == 'memory' and processes > 1:
+            # the rows are all returned to the main process, each worker
+            # holds the records and rows of one range at a time
+            memory = BASE_MEMORY + rows_memory + processes * BASE_MEMORY + \
+                (records_memory + rows_memory) / CHUNKS_PER_WORKER
+            seconds /= processes
+        elif strategy == 'memory':
+            memory = BASE_MEMORY + records_memory + rows_memory
+        elif strategy == 'pipeline':
+            # a few batches of records are held at a time, rows are also
+            # kept if BED files are applied
+            memory = BASE_MEMORY + BATCH_SIZE * 10 * scan['record_bytes'] * \
+                (RECORD_MEMORY + per_byte)
+            if scan['beds']:
+                memory += rows_memory
+        else:
+            if range_size is None:
+                range_size = MIN_RANGE_SIZE
+                if self.budget is not None and per_byte:
+                    range_size = max(MIN_RANGE_SIZE,
+                        (self.budget - BASE_MEMORY) / per_byte)
+            range_size = min(range_size, max(MIN_RANGE_SIZE,
+                scan['data_bytes']))
+            memory = BASE_MEMORY + per_byte * range_size
+
+        return({
+            'strategy': strategy,
+            'processes': processes,
+            'range_size': range_size,
+            'records': scan['records'],
+            'rows': rows * len(scan['columns']),
+            'memory': memory,
+            'seconds': seconds,
+        })
+
+
+    def log_plan(self):
+        scan = self.scan
+        plan = self.plan
+        self.logger.info('pre-scan of {}: {:.1f} MB{}, {}, {} samples, '
+            '~{} records, {:.1f} different CSQ entries and {:.1f} NM '
+            'transcripts per record, {} report columns, {} BED files'.format(
+            scan['path'], scan['uncompressed'] / MB,
+            ' uncompressed ({:.1f} MB compressed)'.format(scan['size'] / MB)
+            if scan['compressed'] else '',
+            'index {}'.format(scan['index']) if scan['index'] else 'no index',
+            scan.get('samples', 0), scan['records'], scan['csq_entries'],
+            scan['transcripts'], '/'.join(str(n) for n in scan['columns']),
+            scan['beds']))
+
+        if plan['strategy'] == 'ranges':
+            strategy = 'in ranges of {:.1f} MB'.format(
+                plan['range_size'] / MB)
+        elif plan['strategy'] == 'pipeline':
+            strategy = 'pipelined'
+        else:
+            strategy = 'in memory'
+        self.logger.info('plan: {} reader{}, {} engine, {} processes, report '
+            'made {} -- estimated {} records, {} rows, {:.0f} MB{} and {:.0f}s'
+            .format(plan['backend'],
+            ' with record cache' if plan['record_cache'] else '',
+            plan['engine'], plan['processes'], strategy, plan['records'],
+            plan['rows'], plan['memory'] / MB,
+            '' if self.budget is None else ' of {:.0f} MB'.format(
+            self.budget / MB), plan['seconds']))
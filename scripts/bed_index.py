@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+"""
+bed_index.py
+
+Compiles BED files into interval indexes, with the intervals of each
+chromosome merged and sorted in numpy arrays, so that the variants of a
+report that fall within a BED file can be found with a binary search
+instead of running bedtools. Compiled indexes are saved in a cache
+folder, keyed by the path and SHA-1 hash of the BED file, and later
+runs load them memory-mapped, so a panel of BED files only needs to be
+read and sorted once.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# changed if the format of the index files changes, older indexes are
+# compiled again
+INDEX_VERSION = 1
+
+# lines of a BED file that aren't intervals
+HEADER_PREFIXES = ('#', 'track', 'browser')
+
+
+def read_bed(path):
+    """
+    Intervals of a BED file, as a dictionary of chromosome to a list of
+    (start, end) tuples. Header lines and blank lines are skipped.
+    """
+    out = {}
+    with open(path) as bed:
+        for n, line in enumerate(bed, 1):
+            if not line.strip() or line.startswith(HEADER_PREFIXES):
+                continue
+            fields = line.split()
+            try:
+                interval = (int(fields[1]), int(fields[2]))
+            except (IndexError, ValueError):
+                raise ValueError('invalid BED line {} in {}: {}'.format(
+                    n, path, line.strip()))
+            out.setdefault(fields[0], []).append(interval)
+    return(out)
+
+
+def merge_intervals(intervals):
+    """
+    Sort intervals and merge those that overlap or touch, so the starts
+    and ends of the merged intervals are both sorted
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return(merged)
+
+
+def report_intervals(rows):
+    """
+    Interval of each variant in the report rows, in the same way as
+    the report BED given to bedtools (see bed_object.make_report_bed).
+    Returns a dictionary of chromosome to (variant names, starts, ends).
+    """
+    intervals = {}
+    last_variant = None
+    for row in rows:
+        if row.variant == last_variant:
+            continue
+        last_variant = row.variant
+        start = row.pos - 1
+        if len(row.ref) > 1:
+            end = start + len(row.ref) + 1
+        else:
+            end = start + 1
+        names, starts, ends = intervals.setdefault(row.chrom, ([], [], []))
+        names.append(row.variant)
+        starts.append(start)
+        ends.append(end)
+
+    out = {}
+    for chrom, (names, starts, ends) in intervals.items():
+        out[chrom] = (names, numpy.array(starts, dtype=numpy.int64),
+                      numpy.array(ends, dtype=numpy.int64))
+    return(out)
+
+
+# -- BED INDEX CLASS --------------------------------------------------
+
+class bed_index(object):
+    """
+    Merged intervals of a BED file. intervals is a 2 x n array of the
+    starts and ends of every chromosome one after the other, chroms
+    gives the offset and number of intervals of each chromosome.
+    """
+    def __init__(self, chroms, intervals):
+        self.chroms = chroms
+        self.intervals = intervals
+
+
+    @classmethod
+    def from_bed(cls, path):
+        """Compile the index of a BED file"""
+        chroms = {}
+        starts = []
+        ends = []
+        for chrom, intervals in sorted(read_bed(path).items()):
+            merged = merge_intervals(intervals)
+            chroms[chrom] = (len(starts), len(merged))
+            starts.extend(start for start, end in merged)
+            ends.extend(end for start, end in merged)
+        intervals = numpy.array([starts, ends], dtype=numpy.int64)
+        return(cls(chroms, intervals.reshape(2, len(starts))))
+
+
+    def overlaps(self, chrom, starts, ends):
+        """
+        Boolean array of which of the intervals from starts to ends on
+        a chromosome overlap the BED file by at least one base, as with
+        bedtools intersect
+        """
+        if chrom not in self.chroms:
+            return(numpy.zeros(len(starts), dtype=bool))
+        offset, count = self.chroms[chrom]
+        bed_starts = self.intervals[0, offset:offset + count]
+        bed_ends = self.intervals[1, offset:offset + count]
+
+        # the first BED interval that ends after each start is the only
+        # one that can overlap, as the merged intervals don't overlap
+        i = numpy.searchsorted(bed_ends, starts, side='right')
+        found = i < count
+        out = numpy.zeros(len(starts), dtype=bool)
+        out[found] = bed_starts[i[found]] < ends[found]
+        return(out)
+
+
+    def variants(self, intervals):
+        """
+        Names of the variants that fall within the BED file, from the
+        output of report_intervals
+        """
+        keep = set()
+        for chrom, (names, starts, ends) in intervals.items():
+            hits = self.overlaps(chrom, starts, ends)
+            keep.update(name for name, hit in zip(names, hits.tolist())
+                        if hit)
+        return(keep)
+
+
+# -- BED INDEX CACHE CLASS --------------------------------------------
+
+class bed_index_cache:
+    def __init__(self, folder):
+        """
+        Object properties that are loaded when the oject is created.
+        folder is where the compiled indexes are saved, it is made if
+        it doesn't exist. Indexes that have been loaded are also kept in
+        memory, so they are reused by later runs of the daemon.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        if numpy is None:
+            raise ImportError('numpy is needed for the BED index cache')
+        self.logger = logging.getLogger('vcf_parse.bed')
+        self.folder = os.path.abspath(folder)
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.keys = {}
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.compiled = 0
+        self.loaded = 0
+
+
+    def key(self, path):
+        """
+        Cache key of a BED file, from its path and SHA-1 hash. The key
+        is kept for each size and modification time, so the file is
+        only hashed again if it changes.
+        """
+        stat = os.stat(path)
+        state = (path, stat.st_size, stat.st_mtime)
+        key = self.keys.get(state)
+        if key is None:
+            with open(path, 'rb') as bed:
+                digest = hashlib.sha1(bed.read()).hexdigest()
+            key = hashlib.sha1('{}\n{}\n{}'.format(
+                INDEX_VERSION, path, digest).encode('utf-8')).hexdigest()
+            self.keys[state] = key
+        return(key)
+
+
+    def get(self, bedfile):
+        """
+        Returns the index of a BED file, loaded from the cache folder
+        if it was compiled before, otherwise compiled and saved there
+        """
+        path = os.path.abspath(bedfile)
+        with self.lock:
+            key = self.key(path)
+            index = self.indexes.get(key)
+            if index is None:
+                index = self.load(key)
+                if index is None:
+                    index = bed_index.from_bed(path)
+                    self.save(key, path, index)
+                    self.compiled += 1
+                else:
+                    self.loaded += 1
+                self.indexes[key] = index
+            return(index)
+
+
+    def paths(self, key):
+        base = os.path.join(self.folder, key)
+        return(base + '.npy', base + '.json')
+
+
+    def load(self, key):
+        """Load a compiled index memory-mapped, None if it isn't saved"""
+        array_path, info_path = self.paths(key)
+        if not os.path.exists(info_path):
+            return(None)
+        try:
+            with open(info_path) as f:
+                info = json.load(f)
+            intervals = numpy.load(array_path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            self.logger.warning('could not read BED index {} -- compiling '
+                'it again'.format(info_path))
+            return(None)
+        chroms = dict((chrom, (offset, count))
+                      for chrom, offset, count in info['chroms'])
+        return(bed_index(chroms, intervals))
+
+
+    def save(self, key, path, index):
+        """
+        Save a compiled index. The array is saved first and the info
+        file last, both under temporary names, so an index is only used
+        once it is complete. If it can't be saved, a warning is logged
+        and the run carries on.
+        """
+        array_path, info_path = self.paths(key)
+        info = {
+            'version': INDEX_VERSION,
+            'bed': path,
+            'chroms': sorted([chrom, offset, count]
+                             for chrom, (offset, count) in index.chroms.items()),
+            'intervals': int(index.intervals.shape[1]),
+        }
+        try:
+            for target, write in ((array_path,
+                    lambda f: numpy.save(f, index.intervals)),
+                    (info_path, lambda f: f.write(
+                    json.dumps(info, sort_keys=True).encode('utf-8')))):
+                fd, temp = tempfile.mkstemp(dir=self.folder, suffix='.temp')
+                with os.fdopen(fd, 'wb') as f:
+                    write(f)
+                os.rename(temp, target)
+        except (IOError, OSError):
+            self.logger.warning('could not save BED index of {} in {}'.format(
+                path, self.folder))
@@ -1,9 +1,10 @@
-#!/anaconda3/envs/python2/bin/python
+#!/usr/bin/env python
 
 """
 bed_object.py
 
-Object that deals with the loading and intersecting of BED files. 
+Object that deals with the loading and intersecting of BED files, 
+with bedtools or with compiled interval indexes (see bed_index.py).
 Loaded as part of the vcf_parse.py program.
 
 Author:     Erik Waskiewicz
@@ -18,6 +19,8 @@ import csv
 import logging
 import re
 
+from scripts.bed_index import report_intervals
+
 
 # set global variable to point to bedtools executables - if using conda leave as empty string
 BEDTOOLS_PATH = ''
@@ -26,55 +29,83 @@ BEDTOOLS_PATH = ''
 # -- BED CLASS --------------------------------------------------------
 
 class bed_object:
-    def __init__(self):
+    def __init__(self, index_cache=None):
         """
         Object properties that are loaded when the oject is created.
+        If index_cache (a bed_index_cache) is given, BED files are 
+        applied with their compiled interval indexes instead of bedtools.
         The logger deals with all status messages from the object and
         is a child of the main logger vcf_parse.
         """
         self.logger = logging.getLogger('vcf_parse.bed')
+        self.index_cache = index_cache
+        self.intervals = None
 
 
-    def make_report_bed(self, in_vcf):
+    def prepare_report(self, in_vcf):
         """
-        Takes a variant report and turns into a BED file by parsing 
-        the variant description, and saves file as <report>.temp
+        Work out the variant intervals of the report once for all the
+        BED files, as a report BED for bedtools or as arrays for the
+        compiled indexes
         """
-        # open variant report to loop through
-        with open(in_vcf.report_path, 'r') as report:
-            reader = csv.reader(report, delimiter='\t')
+        if self.index_cache is None:
+            self.make_report_bed(in_vcf)
+        else:
+            self.intervals = report_intervals(in_vcf.table.rows)
+
 
-            # open empty temp file to write output to
-            with open(in_vcf.report_path + '.temp', 'w') as out: 
+    def finish_report(self, in_vcf):
+        """Remove the temporary report BED, if one was made"""
+        if self.index_cache is None:
+            os.remove(self.report_bed_path(in_vcf))
+        self.intervals = None
 
-                # for each line, split variant into BED format and save
-                for line in reader:
 
-                    if line[0] != 'SampleID':
+    def report_bed_path(self, in_vcf):
+        """
+        Filepath of the temporary report BED, in the output folder even
+        if the report itself is written to stdout
+        """
+        return(os.path.join(
+            in_vcf.output_dir, in_vcf.report_name + '_VariantReport.txt.temp'))
+
+
+    def make_report_bed(self, in_vcf):
+        """
+        Takes a variant report and turns into a BED file using the 
+        variant coordinates of each row, and saves file as <report>.temp
+        in the output folder
+        """
+        with open(self.report_bed_path(in_vcf), 'w') as out: 
+
+            # for each variant, convert to BED format and save
+            last_variant = None
+            for row in in_vcf.table.rows:
 
-                        variant = line[1].split(':')
-                        ref = variant[1].split('>')[0].strip('0123456789')
+                # rows for the same variant are next to each other, only
+                # one line is needed for each
+                if row.variant == last_variant:
+                    continue
+                last_variant = row.variant
 
-                        start_pos = int(variant[1].strip('AGTC>,')) - 1
+                start_pos = row.pos - 1
 
-                        #Account for indels overlapping gene bed
-                        if len(ref) > 1:
+                #Account for indels overlapping gene bed
+                if len(row.ref) > 1:
 
-                            end_pos = start_pos + len(ref) + 1
+                    end_pos = start_pos + len(row.ref) + 1
 
-                        else:
-                
-                            end_pos =  start_pos + 1
+                else:
+        
+                    end_pos =  start_pos + 1
 
 
-                        out.write('{}\t{}\t{}\t{}\n'.format(
-                            variant[0],
-                            start_pos,
-                            end_pos,
-                            line[1]
-                        ))
-            out.close()
-        report.close()
+                out.write('{}\t{}\t{}\t{}\n'.format(
+                    row.chrom,
+                    start_pos,
+                    end_pos,
+                    row.variant
+                ))
 
 
     def make_intersect_bed(self, bedfile, in_vcf):
@@ -86,20 +117,20 @@ class bed_object:
           easily be filtered in the next function.
         """
         # intersect report bed and input bed, save as variable
-        report_bed = in_vcf.report_path + '.temp'
+        report_bed = self.report_bed_path(in_vcf)
         intersect_command = (
             '{}intersectBed -a {} -b {}'.format(BEDTOOLS_PATH, report_bed, bedfile)
         )
         try:
             results_intersect = os.popen(intersect_command).read()
         except IOError:
-            self.logger.warn('BEDTools error')
+            self.logger.warning('BEDTools error')
 
         # write bed variable to file
         self.bed_name = os.path.basename(bedfile).split('.')[0]
         self.intersect_bed = os.path.join(
             in_vcf.output_dir, '{}_{}_intersect.bed'.format(
-                in_vcf.sample, self.bed_name))
+                in_vcf.report_name, self.bed_name))
         #self.out_folder = out_folder
 
         out = open(self.intersect_bed, 'w') 
@@ -107,41 +138,50 @@ class bed_object:
         out.close()
 
 
+    def indexed_variants(self, bedfile):
+        """
+        Variants of the report that fall within a BED file, found with
+        the compiled index of the BED file
+        """
+        self.bed_name = os.path.basename(bedfile).split('.')[0]
+        index = self.index_cache.get(bedfile)
+        return(index.variants(self.intervals))
+
+
     def apply_bed(self, bedfile, in_vcf, out_folder):
         """
         Takes an intersect BED from the make_intersect_bed function,
         compares the variant ID within this to the variant ID within 
         the variant report, if the two match, keeps the line of the 
-        report, otherwise discards it
+        report, otherwise discards it. With compiled indexes, the 
+        variants to keep are found from the index instead.
         """
-        # load temp intersect bed, read variants into list
-        with open(self.intersect_bed, 'r') as bed:
-            results = csv.reader(bed, delimiter='\t')
-            keep = []
-            for line in results:
-                keep.append(line[3])
-
-        # open empty file
+        if self.index_cache is not None:
+            keep = self.indexed_variants(bedfile)
+        else:
+            # load temp intersect bed, read variants into list
+            with open(self.intersect_bed, 'r') as bed:
+                results = csv.reader(bed, delimiter='\t')
+                keep = []
+                for line in results:
+                    keep.append(line[3])
+
+        # keep rows of the report where there is a match with the bed
+        # list. Variant description from the report was kept in the 
+        # intersect BED, so they can be directly compared
+        keep = set(keep)
+        rows = [row for row in in_vcf.table.rows if row.variant in keep]
+
+        # save filtered report
         outfile = os.path.join(
             out_folder, '{}_{}_VariantReport.txt'.format(
-                in_vcf.sample, self.bed_name))
-        bed = open(outfile, 'w')
-        bed_report = csv.writer(bed, delimiter='\t')
-
-        # loops through original report, keeps if there is a match with
-        # the bed list. Variant description from the report was kept in
-        # the intersect BED, so they can be directly compared
-        with open(in_vcf.report_path) as report:
-            results = csv.reader(report, delimiter='\t')
-            for line in results:
-                if line[0] == 'SampleID':
-                    bed_report.writerow(line)
-                if line[1] in keep:
-                    bed_report.writerow(line)
+                in_vcf.report_name, self.bed_name))
+        in_vcf.table.write(outfile, rows)
         
         # log and remove intersect BED
         self.logger.info('applied BED file - {}'.format(outfile))
-        os.remove(os.path.abspath(self.intersect_bed))
+        if self.index_cache is None:
+            os.remove(os.path.abspath(self.intersect_bed))
 
 
     def apply_single(self, bedfile, in_vcf):
@@ -153,14 +193,15 @@ class bed_object:
             os.path.abspath(bedfile)))
         
         # make temporary report BED file
-        self.make_report_bed(in_vcf)
+        self.prepare_report(in_vcf)
 
         # make intersect BED and apply to variant report
-        self.make_intersect_bed(bedfile, in_vcf)
+        if self.index_cache is None:
+            self.make_intersect_bed(bedfile, in_vcf)
         self.apply_bed(bedfile, in_vcf, in_vcf.output_dir)
 
         # remove temp report BED
-        os.remove(in_vcf.report_path + '.temp')
+        self.finish_report(in_vcf)
 
     
     def apply_multiple(self, bed_folder, in_vcf):
@@ -177,7 +218,7 @@ class bed_object:
             os.mkdir(out_folder)
 
         # make temporary report BED file once
-        self.make_report_bed(in_vcf)
+        self.prepare_report(in_vcf)
 
         # total number of files for logger
         n = len([name for name in os.listdir(bed_folder) 
@@ -192,10 +233,11 @@ class bed_object:
                     i, n, os.path.abspath(in_bed)))
 
                 # make intersect BED and apply to variant report
-                self.make_intersect_bed(in_bed, in_vcf)
+                if self.index_cache is None:
+                    self.make_intersect_bed(in_bed, in_vcf)
                 self.apply_bed(in_bed, in_vcf, out_folder)
 
                 i+=1
 
         # remove temp report BED
-        os.remove(in_vcf.report_path + '.temp')
+        self.finish_report(in_vcf)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+"""
+checkpoint.py
+
+Makes the reports of a large uncompressed VCF in byte ranges, one after
+the other, saving a checkpoint after each range so that an interrupted
+run can carry on from where it got to. Each range is made as a normal
+report into a scratch folder and its reports (and any BED file reports)
+are appended to the reports in the output folder. The checkpoint holds
+the offset in the VCF reached, the size and last line of each report
+and the summary and filter counts so far. When resumed, the reports are
+cut back to their sizes at the last checkpoint and the next range is
+made, giving the same reports as a run that was never interrupted.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import json
+import shutil
+import logging
+import tempfile
+
+from scripts.parallel_parse import can_map, map_file, header_end
+from scripts.shards import shard_options, range_args, size_ranges, \
+    file_state, report_files, open_binary
+from scripts.report_summary import report_summary
+from scripts.vcf_report import vcf_report
+from scripts.file_utils import open_text
+
+
+# name of the checkpoint file saved in the output folder, it is removed
+# once the run is finished
+CHECKPOINT_FILE = 'vcf_parse_checkpoint.json'
+
+# folder in the output folder that each range is made in
+SCRATCH_FOLDER = 'checkpoint_range'
+
+# changed if the format of the checkpoint file changes
+CHECKPOINT_VERSION = 1
+
+
+def sync_file(path):
+    """Make sure a file is written to disk"""
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+# -- CHECKPOINT RUNNER CLASS ------------------------------------------
+
+class checkpoint_runner:
+    def __init__(self, args, run, references):
+        """
+        Object properties that are loaded when the oject is created.
+        args are the command line arguments, run is the function that
+        makes a single report and references is the reference_data
+        object.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.checkpoint')
+        self.args = args
+        self.run_report = run
+        self.references = references
+        self.output = os.path.abspath(args.output or '.')
+        self.checkpoint_path = os.path.join(self.output, CHECKPOINT_FILE)
+        self.scratch = os.path.join(self.output, SCRATCH_FOLDER)
+        self.summary = None
+
+
+    def run(self):
+        """
+        Make the reports, starting from the last checkpoint if resuming.
+        Returns the checkpoint of the finished run.
+        """
+        args = self.args
+        if not can_map(args.input):
+            raise ValueError('checkpoints can only be made for uncompressed '
+                'VCF files - {}'.format(args.input))
+        if args.pipeline or args.stdout or args.sort_by or args.dedup or \
+                args.partition_by or args.processes > 1:
+            raise ValueError('checkpoints cannot be made with --pipeline, '
+                '--stdout, --sort_by, --dedup, --partition_by or --processes')
+
+        path = os.path.abspath(args.input)
+        options = json.loads(json.dumps(shard_options(args)))
+        checkpoint = None
+        if args.resume:
+            checkpoint = self.load_checkpoint(path, options)
+        if checkpoint is None:
+            checkpoint = self.plan(path, options)
+        else:
+            self.restore(checkpoint)
+
+        ranges = checkpoint['ranges']
+        for index in range(checkpoint['next'], len(ranges)):
+            self.run_range(checkpoint, index)
+            self.save_checkpoint(checkpoint)
+            self.logger.info('checkpoint {} of {} saved - {} of {} bytes '
+                'read'.format(index + 1, len(ranges), checkpoint['offset'],
+                checkpoint['input_state']['size']))
+        self.finish(checkpoint)
+        return(checkpoint)
+
+
+    def plan(self, path, options):
+        """
+        Split the VCF into ranges of --checkpoint_size MB, returns the
+        checkpoint of a run that hasn't started
+        """
+        with open(path, 'rb') as vcf_file:
+            data = map_file(vcf_file)
+            try:
+                start = header_end(data)
+                ranges = [[begin, end] for begin, end, contigs in
+                    size_ranges(data, start,
+                    max(1, int(self.args.checkpoint_size * 1024 * 1024)))]
+            finally:
+                data.close()
+
+        # a VCF with no records still has one empty range, so the
+        # reports are made with their headers
+        if not ranges:
+            ranges = [[start, start]]
+
+        self.load_summary(path, options, None)
+        self.logger.info('making reports of {} in {} ranges with '
+            'checkpoints'.format(path, len(ranges)))
+        return({
+            'version': CHECKPOINT_VERSION,
+            'input': path,
+            'input_state': file_state(path),
+            'options': options,
+            'ranges': ranges,
+            'next': 0,
+            'offset': start,
+            'reports': {},
+            'records': 0,
+            'variants_filtered': 0,
+            'transcripts_filtered': 0,
+            'transcripts_chosen': [0, 0, 0],
+            'summary': None,
+        })
+
+
+    def load_checkpoint(self, path, options):
+        """
+        Load the checkpoint of an interrupted run, None if there isn't
+        one. The VCF and options must be the same as when it was saved.
+        """
+        if not os.path.exists(self.checkpoint_path):
+            self.logger.info('no checkpoint in {} -- starting from the '
+                'beginning'.format(self.output))
+            return(None)
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('version') != CHECKPOINT_VERSION:
+            raise ValueError('checkpoint {} was made by another version of '
+                'vcf_parse'.format(self.checkpoint_path))
+        if checkpoint['input'] != path or \
+                file_state(path) != checkpoint['input_state']:
+            raise ValueError('checkpoint {} was made for another VCF, or {} '
+                'has changed since'.format(self.checkpoint_path, path))
+        if checkpoint['options'] != options:
+            raise ValueError('checkpoint {} was made with other options'
+                .format(self.checkpoint_path))
+        self.load_summary(path, options, checkpoint['summary'])
+        self.logger.info('resuming from checkpoint {} of {} - {} of {} bytes '
+            'read'.format(checkpoint['next'], len(checkpoint['ranges']),
+            checkpoint['offset'], checkpoint['input_state']['size']))
+        return(checkpoint)
+
+
+    def load_summary(self, path, options, state):
+        """
+        Make the summary of the whole run from the VCF header, with the
+        counts saved in the checkpoint if there are any
+        """
+        if not options.get('summary'):
+            return
+        report = vcf_report()
+        with open_text(path, 'r') as vcf_input:
+            report.read_header(vcf_input)
+        self.summary = report_summary(report)
+        if state is not None:
+            self.summary.merge_state(state)
+
+
+    def restore(self, checkpoint):
+        """
+        Cut each report back to its size at the checkpoint, removing
+        anything written after it
+        """
+        for name, saved in checkpoint['reports'].items():
+            path = os.path.join(self.output, name)
+            if not os.path.exists(path) or \
+                    os.path.getsize(path) < saved['size']:
+                raise ValueError('{} is missing or shorter than at the '
+                    'checkpoint -- run again without --resume'.format(path))
+            with open(path, 'r+b') as report:
+                report.truncate(saved['size'])
+
+
+    def run_range(self, checkpoint, index):
+        """
+        Make the reports of one range in the scratch folder, append them
+        to the reports in the output folder and update the checkpoint
+        """
+        if os.path.exists(self.scratch):
+            shutil.rmtree(self.scratch)
+        os.makedirs(self.scratch)
+        byte_range = tuple(checkpoint['ranges'][index])
+        args = range_args(self.args, checkpoint['options'],
+            checkpoint['input'], self.scratch, byte_range)
+        report = self.run_report(args, self.references)
+        for name in report_files(self.scratch):
+            self.append_report(checkpoint, name)
+
+        checkpoint['records'] += len(report.data)
+        if report.filter is not None:
+            checkpoint['variants_filtered'] += report.filter.variants_removed
+            checkpoint['transcripts_filtered'] += \
+                report.filter.transcripts_removed
+        chooser = report.transcript_chooser
+        if chooser is not None:
+            for n, count in enumerate((chooser.variants_preferred,
+                    chooser.variants_best, chooser.transcripts_removed)):
+                checkpoint['transcripts_chosen'][n] += count
+        if self.summary is not None:
+            self.summary.merge(report.summary)
+            checkpoint['summary'] = self.summary.to_state()
+        checkpoint['next'] = index + 1
+        checkpoint['offset'] = byte_range[1]
+
+
+    def append_report(self, checkpoint, name):
+        """
+        Append a report of the range to the same report in the output
+        folder. The header is only written the first time, and a row
+        identical to the last row of the range before is skipped, as it
+        would be in one pass over the records.
+        """
+        path = os.path.join(self.output, name)
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        saved = checkpoint['reports'].get(name)
+        last = None
+        if saved is not None and saved['last'] is not None:
+            last = saved['last'].encode('utf-8')
+
+        with open_binary(os.path.join(self.scratch, name), 'r') as report:
+            header = report.readline()
+            with open_binary(path, 'w' if saved is None else 'a') as out:
+                if saved is None:
+                    out.write(header)
+                for n, line in enumerate(report):
+                    if n == 0 and line == last:
+                        continue
+                    out.write(line)
+                    last = line
+        sync_file(path)
+        checkpoint['reports'][name] = {
+            'size': os.path.getsize(path),
+            'last': None if last is None else last.decode('utf-8'),
+        }
+
+
+    def save_checkpoint(self, checkpoint):
+        """
+        Save the checkpoint under a temporary name and then rename it,
+        so there is always a complete checkpoint
+        """
+        fd, temp = tempfile.mkstemp(dir=self.output, suffix='.temp')
+        with os.fdopen(fd, 'w') as out:
+            json.dump(checkpoint, out, sort_keys=True)
+            out.write('\n')
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(temp, self.checkpoint_path)
+
+
+    def finish(self, checkpoint):
+        """
+        Save the summary and log the counts of the whole run, then
+        remove the checkpoint and scratch folder
+        """
+        options = checkpoint['options']
+        if options.get('filter'):
+            self.logger.info('filter "{}" removed {} variants and {} '
+                'transcripts'.format(options['filter'],
+                checkpoint['variants_filtered'],
+                checkpoint['transcripts_filtered']))
+        if options.get('preferred_only'):
+            self.logger.info('kept the preferred transcript of {} variants '
+                'and the best transcript of {}, {} transcripts removed'
+                .format(*checkpoint['transcripts_chosen']))
+        if self.summary is not None:
+            self.summary.write(self.output)
+
+        if os.path.exists(self.scratch):
+            shutil.rmtree(self.scratch)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        self.logger.info('reports completed from {} ranges - {} records'
+            .format(len(checkpoint['ranges']), checkpoint['records']))
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+"""
+cohort_matrix.py
+
+Builds a sparse variant by sample matrix of the genotype, variant
+frequency and depth of every variant in a cohort of single sample VCFs,
+reading each VCF once, one record at a time. Only the variants that
+have been seen and one entry for each variant called in each sample are
+kept in memory, in typed arrays, so memory grows with the number of
+distinct variants and calls rather than the number of report rows. The
+matrix is saved as a compressed numpy .npz file in coordinate format.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import array
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from scripts.vcf_report import vcf_report
+from scripts.filter_expression import record_filter
+
+
+# name of the matrix file saved in the output folder
+MATRIX_NAME = 'Cohort_VariantMatrix.npz'
+
+# genotype codes, the position of each genotype in this tuple. No call
+# (e.g. ./.) is -1
+GENOTYPES = ('HOM_REF', 'HET', 'HOM_VAR')
+NO_CALL = -1
+
+# depth of a sample that has no DP or AD
+NO_DEPTH = -1
+
+
+def genotype_code(gt):
+    """
+    Genotype code of a GT value such as 0/1 or 1|1, from the number of
+    ALT alleles called. Returns NO_CALL if no alleles are called.
+    """
+    if not gt:
+        return(NO_CALL)
+    alleles = [allele for allele in gt.replace('|', '/').split('/')
+               if allele != '.']
+    if not alleles:
+        return(NO_CALL)
+    alt = len([allele for allele in alleles if allele != '0'])
+    if alt == 0:
+        return(0)
+    if alt == len(alleles):
+        return(2)
+    return(1)
+
+
+def call_value(call, field):
+    """Value of a FORMAT field of a call, None if it doesn't have it"""
+    try:
+        return(call[field])
+    except Exception:
+        return(None)
+
+
+def variant_frequency(call):
+    """
+    Variant frequency of the first ALT allele, as a fraction. The VF
+    field is used if the VCF has it, otherwise it is worked out from AD
+    as with the Frequency column of the report. NaN if neither is there.
+    """
+    vf = call_value(call, 'VF')
+    if isinstance(vf, list):
+        vf = vf[0] if vf else None
+    try:
+        return(float(vf))
+    except (TypeError, ValueError):
+        pass
+    try:
+        depths = call_value(call, 'AD')
+        ref = float(depths[0])
+        alt = float(depths[1])
+        return(alt / (ref + alt))
+    except (TypeError, ValueError, IndexError, ZeroDivisionError):
+        return(float('nan'))
+
+
+def read_depth(call):
+    """
+    Read depth of a call, from DP or else the total of AD. NO_DEPTH if
+    neither is there.
+    """
+    dp = call_value(call, 'DP')
+    try:
+        return(int(dp))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return(int(sum(int(depth) for depth in call_value(call, 'AD'))))
+    except (TypeError, ValueError):
+        return(NO_DEPTH)
+
+
+def load_matrix(path):
+    """
+    Load a saved cohort matrix. Returns a dictionary of numpy arrays:
+    variants and samples are the row and column names, row and col give
+    the position of each entry and genotype, frequency and depth its
+    values. shape is (variants, samples). The entries can be made into
+    a scipy.sparse matrix with coo_matrix((values, (row, col)), shape).
+    """
+    with numpy.load(path) as data:
+        return(dict((name, data[name]) for name in data.files))
+
+
+# -- COHORT MATRIX CLASS ----------------------------------------------
+
+class cohort_matrix:
+    def __init__(self, backend='pyvcf', filter_setting=False,
+                 expression=None):
+        """
+        Object properties that are loaded when the oject is created.
+        backend is the library used to read VCFs (see vcf_backends.py).
+        If filter_setting is set, variants that aren't PASS are left
+        out, and if expression is given only variants that match it
+        (see filter_expression.py) are included.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        if numpy is None:
+            raise ImportError('numpy is needed for the cohort matrix')
+        self.logger = logging.getLogger('vcf_parse.cohort')
+        self.backend = backend
+        self.filter_setting = filter_setting
+        self.expression = expression
+
+        # index of each variant name, and the names in order
+        self.index = {}
+        self.variants = []
+        self.samples = []
+        self.paths = []
+
+        # one entry for each variant called in each sample
+        self.row = array.array('i')
+        self.col = array.array('i')
+        self.genotype = array.array('b')
+        self.frequency = array.array('f')
+        self.depth = array.array('i')
+        self.variants_removed = 0
+
+
+    def add_vcf(self, path):
+        """
+        Add the variants of the first sample of a VCF as a new column.
+        A variant that appears more than once in the VCF is only added
+        the first time.
+        """
+        self.logger.info('adding {} to cohort matrix'.format(path))
+        report = vcf_report(self.backend)
+        records = report.open_data(path, None)
+        try:
+            test = None
+            if self.expression is not None:
+                expression = record_filter(self.expression, report)
+                if expression.transcript is not None:
+                    raise ValueError('--filter conditions on VEP fields '
+                        'cannot be used with --cohort')
+                test = expression.variant
+
+            col = len(self.samples)
+            self.samples.append(report.sample)
+            self.paths.append(os.path.abspath(path))
+            seen = set()
+            for var in records:
+                if self.filter_setting and var.FILTER:
+                    continue
+                if test is not None and not test(var):
+                    self.variants_removed += 1
+                    continue
+
+                name = report.make_variant_name(var)
+                row = self.index.get(name)
+                if row is None:
+                    row = len(self.variants)
+                    self.index[name] = row
+                    self.variants.append(name)
+                elif row in seen:
+                    continue
+                seen.add(row)
+                self.add_entry(row, col, self.sample_call(var, report.sample))
+        finally:
+            report.vcf_file.close()
+        self.logger.info('{} has {} variants'.format(report.sample, len(seen)))
+
+
+    def sample_call(self, var, sample):
+        """The FORMAT fields of a sample, None if not found"""
+        out = None
+        for call in var:
+            if call.sample == sample:
+                out = call
+        return(out)
+
+
+    def add_entry(self, row, col, call):
+        """Add the genotype, frequency and depth of a call"""
+        if call is None:
+            gt, vf, dp = NO_CALL, float('nan'), NO_DEPTH
+        else:
+            gt = genotype_code(call_value(call, 'GT'))
+            vf = variant_frequency(call)
+            dp = read_depth(call)
+        self.row.append(row)
+        self.col.append(col)
+        self.genotype.append(gt)
+        self.frequency.append(vf)
+        self.depth.append(dp)
+
+
+    def recurrence(self):
+        """Number of samples each variant is called in"""
+        return(numpy.bincount(numpy.frombuffer(self.row, dtype=numpy.int32),
+                              minlength=len(self.variants)))
+
+
+    def save(self, path):
+        """Save the matrix to an .npz file, see load_matrix"""
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        numpy.savez_compressed(path,
+            variants=numpy.array(self.variants, dtype=str),
+            samples=numpy.array(self.samples, dtype=str),
+            paths=numpy.array(self.paths, dtype=str),
+            row=numpy.frombuffer(self.row, dtype=numpy.int32),
+            col=numpy.frombuffer(self.col, dtype=numpy.int32),
+            genotype=numpy.frombuffer(self.genotype, dtype=numpy.int8),
+            frequency=numpy.frombuffer(self.frequency, dtype=numpy.float32),
+            depth=numpy.frombuffer(self.depth, dtype=numpy.int32),
+            shape=numpy.array([len(self.variants), len(self.samples)]),
+            genotypes=numpy.array(GENOTYPES, dtype=str))
+        self.logger.info('cohort matrix of {} variants, {} samples and {} '
+            'entries saved to {}'.format(len(self.variants),
+            len(self.samples), len(self.row), path))
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+"""
+columnar_engine.py
+
+Engine that decodes the numeric INFO and FORMAT fields of a VCF in
+batches of records, with one numpy array for each field, and works out
+derived values such as the allele frequency from AD for the whole batch
+at once. The values are then formatted as they appear in the report
+and given to vcf_report.iter_reports, which uses them in place of
+parsing each field one record at a time. Reports are the same as with
+the default row engine.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# engines that can be selected, the first is the default
+ENGINES = ('row', 'columnar')
+
+# number of records decoded at once
+BATCH_SIZE = 1000
+
+try:
+    INTEGER_TYPES = (int, long)
+except NameError:
+    INTEGER_TYPES = (int,)
+
+# marks a field that a record doesn't have
+MISSING = object()
+
+# integers outside this range don't fit in the arrays
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def available_engines():
+    """List of the engines that can be used in this environment"""
+    out = ['row']
+    if numpy is not None:
+        out.append('columnar')
+    return(out)
+
+
+def choose_engine(engine):
+    """
+    Returns the engine to use. If the engine asked for can't be used, a
+    warning is logged and the row engine is used instead.
+    """
+    if engine is None:
+        return(ENGINES[0])
+    if engine not in ENGINES:
+        raise ValueError('unknown engine {}, choose from {}'.format(
+            engine, ', '.join(ENGINES)))
+    if engine not in available_engines():
+        logging.getLogger('vcf_parse.engine').warning(
+            'numpy is not installed -- using the row engine')
+        return(ENGINES[0])
+    return(engine)
+
+
+def is_number(value, type_):
+    """True if value is a single number of the type given in the header"""
+    if isinstance(value, bool):
+        return(False)
+    if type_ == 'Integer':
+        return(isinstance(value, INTEGER_TYPES) and 
+            INT64_MIN <= value <= INT64_MAX)
+    return(isinstance(value, float))
+
+
+def numeric_column(values, type_):
+    """
+    Array of the values of a field for a batch of records, and a mask
+    of the values that are numbers, or None if they all are. Other 
+    values (e.g. None where the field is missing) are left as 0.
+    """
+    if type_ == 'Integer':
+        dtype = numpy.int64
+        types = INTEGER_TYPES
+    else:
+        dtype = numpy.float64
+        types = (float,)
+
+    # checking the exact type is much faster than is_number, and leaves
+    # out bools
+    valid = [type(value) in types for value in values]
+    try:
+        if all(valid):
+            return(numpy.array(values, dtype=dtype), None)
+        column = numpy.array(
+            [value if ok else 0 for value, ok in zip(values, valid)], 
+            dtype=dtype)
+    except OverflowError:
+        valid = [is_number(value, type_) for value in values]
+        column = numpy.array(
+            [value if ok else 0 for value, ok in zip(values, valid)], 
+            dtype=dtype)
+    return(column, numpy.array(valid, dtype=bool))
+
+
+def allele_matrix(values):
+    """
+    Matrix of allele depths (AD) for a batch of records, one row per
+    record and one column per allele, so multi-allelic records fit in
+    the same array. Missing alleles and values that aren't lists of
+    numbers are NaN.
+    """
+    # fast path when every record has the same number of alleles, all
+    # of them numbers
+    try:
+        matrix = numpy.array(values)
+        if (matrix.ndim == 2 and matrix.shape[1] >= 2 and 
+                matrix.dtype.kind in 'iuf'):
+            return(matrix.astype(numpy.float64))
+    except (OverflowError, ValueError):
+        pass
+
+    width = 2
+    for value in values:
+        if isinstance(value, list):
+            width = max(width, len(value))
+    matrix = numpy.full((len(values), width), numpy.nan)
+    for i, value in enumerate(values):
+        if not isinstance(value, list):
+            continue
+        for j, depth in enumerate(value):
+            if is_number(depth, 'Integer') or is_number(depth, 'Float'):
+                matrix[i, j] = depth
+    return(matrix)
+
+
+# -- COLUMNAR ENGINE CLASS --------------------------------------------
+
+class columnar_engine:
+    def __init__(self, report, batch_size=BATCH_SIZE):
+        """
+        Object properties that are loaded when the oject is created.
+        report is a vcf_report with its header read, the numeric fields
+        are found from its INFO and FORMAT headers. batch_size is the
+        number of records decoded at once.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        if numpy is None:
+            raise ImportError('numpy is needed for the columnar engine')
+
+        self.logger = logging.getLogger('vcf_parse.engine')
+        self.sample = report.sample
+        self.batch_size = max(1, batch_size)
+        self.info_types = self.numeric_fields(report.info_fields)
+        self.format_types = self.numeric_fields(report.format_fields)
+        self.batches = 0
+
+
+    def numeric_fields(self, fields):
+        """Fields with a single Integer or Float value, and their types"""
+        out = {}
+        for name, field in fields.items():
+            if field[1] == 1 and field[2] in ('Integer', 'Float'):
+                out[name] = field[2]
+        return(out)
+
+
+    def select_fields(self, reports):
+        """
+        Numeric fields used by any of the reports, and whether any of
+        them have a Frequency column
+        """
+        self.infos = set()
+        self.formats = set()
+        self.frequency = False
+        for report in reports:
+            if not report.config:
+                self.infos.update(self.info_types)
+                self.formats.update(self.format_types)
+                continue
+            for setting in report.config:
+                if setting[1] == 'info' and setting[0] in self.info_types:
+                    self.infos.add(setting[0])
+                if setting[1] == 'format':
+                    if setting[0] == 'Frequency':
+                        self.frequency = True
+                    elif setting[0] in self.format_types:
+                        self.formats.add(setting[0])
+
+
+    def decode(self, records, reports):
+        """
+        Generator that yields each record with a dictionary of its
+        decoded values, in the form used by vcf_report.iter_reports.
+        Records are decoded in batches of batch_size.
+        """
+        self.select_fields(reports)
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == self.batch_size:
+                for item in self.decode_batch(batch):
+                    yield item
+                batch = []
+        if batch:
+            for item in self.decode_batch(batch):
+                yield item
+
+
+    def decode_batch(self, batch):
+        """
+        Decode a batch of records, returns a list of (record, values)
+        pairs. Values are only given where they are numbers or the field
+        is missing, anything else is left for the report to parse, so 
+        that it is handled in exactly the same way as the row engine.
+        """
+        self.batches += 1
+        shared = [{} for record in batch]
+        calls = [self.sample_call(record) for record in batch]
+        infos = [record.INFO for record in batch]
+
+        # INFO values are shown as text
+        for field in self.infos:
+            values = [info.get(field, MISSING) for info in infos]
+            column, valid = numeric_column(values, self.info_types[field])
+            self.add_values(shared, (field, 'info'), column, valid, str)
+            self.add_missing(shared, (field, 'info'), values, valid)
+
+        # FORMAT values are kept as numbers
+        for field in self.formats:
+            values = [self.call_value(call, field) for call in calls]
+            column, valid = numeric_column(values, self.format_types[field])
+            self.add_values(shared, (field, 'format'), column, valid)
+            self.add_missing(shared, (field, 'format'), values, valid)
+
+        # allele frequency (%) of the first ALT allele, from AD
+        if self.frequency:
+            matrix = allele_matrix(
+                [self.call_value(call, 'AD') for call in calls])
+            ref = matrix[:, 0]
+            alt = matrix[:, 1]
+            total = ref + alt
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                frequency = (alt / total) * 100
+            valid = numpy.isfinite(total) & (total != 0)
+            self.add_values(shared, ('Frequency', 'format'), frequency,
+                valid, format_frequency)
+
+        return(list(zip(batch, shared)))
+
+
+    def add_values(self, shared, key, column, valid, formatter=None):
+        """
+        Add the valid values of a column to each record's values, valid
+        is None if they all are
+        """
+        column = column.tolist()
+        if formatter is not None:
+            column = [formatter(value) for value in column]
+        if valid is None:
+            for values, value in zip(shared, column):
+                values[key] = value
+        else:
+            for values, value, ok in zip(shared, column, valid.tolist()):
+                if ok:
+                    values[key] = value
+
+
+    def add_missing(self, shared, key, column, valid):
+        """Fields that are missing from a record are empty in the report"""
+        if valid is None:
+            return
+        for values, value in zip(shared, column):
+            if value is MISSING:
+                values[key] = ''
+
+
+    def sample_call(self, record):
+        """The FORMAT fields of the report sample, None if not found"""
+        out = None
+        for call in record:
+            if call.sample == self.sample:
+                out = call
+        return(out)
+
+
+    def call_value(self, call, field):
+        """
+        Value of a FORMAT field, MISSING if the record doesn't have the
+        field, or None if the report sample wasn't found
+        """
+        if call is None:
+            return(None)
+        try:
+            return(call[field])
+        except Exception:
+            return(MISSING)
+
+
+def format_frequency(frequency):
+    """Allele frequency as shown in the report, e.g. 12.5%"""
+    return('{}%'.format(round(frequency, 2)))
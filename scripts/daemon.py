@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+"""
+daemon.py
+
+Object that runs vcf_parse as a long-running local daemon. Reference
+data stays loaded between jobs, and jobs sent to the daemon are run on
+a bounded pool of worker threads.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import copy
+import json
+import time
+import socket
+import logging
+import threading
+import collections
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# options that can be set for each job, all other options are taken
+# from the arguments that the daemon was started with
+JOB_OPTIONS = (
+    'input', 'output', 'transcripts', 'transcript_strictness', 'bed',
+    'bed_folder', 'known_variants', 'config', 'filter_non_pass', 'summary',
+    'backend', 'annotation_cache', 'record_cache', 'engine', 'filter',
+    'bed_cache', 'preferred_only'
+)
+
+# number of finished jobs to keep in the status history
+JOB_HISTORY = 1000
+
+# hosts the daemon can listen on. Jobs name files that the daemon reads
+# and writes, so it is only reachable from the same machine
+LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
+
+# -- ADDRESS HELPERS --------------------------------------------------
+
+def parse_address(address):
+    """
+    Converts a daemon address into either a (host, port) tuple for a
+    TCP socket or a filepath for a unix socket. A port number on its own
+    listens on localhost, any host other than localhost is an error.
+    """
+    address = str(address)
+    if address.isdigit():
+        return(('127.0.0.1', int(address)))
+
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        host = host.strip('[]')
+        if host not in LOCAL_HOSTS:
+            raise ValueError('daemon host {} is not allowed - the daemon '
+                'can only listen on {}'.format(host, ', '.join(LOCAL_HOSTS)))
+        return((host, int(port)))
+
+    return(os.path.abspath(address))
+
+
+def send_request(address, request, timeout=None):
+    """
+    Sends a single request to a running daemon and returns the decoded
+    response.
+    """
+    address = parse_address(address)
+    if isinstance(address, tuple) and ':' in address[0]:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    elif isinstance(address, tuple):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+
+    try:
+        sock.connect(address)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        response = b''
+        while not response.endswith(b'\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+    finally:
+        sock.close()
+
+    return(json.loads(response.decode('utf-8')))
+
+
+# -- SERVER CLASSES ---------------------------------------------------
+
+class request_handler(socketserver.StreamRequestHandler):
+    """
+    Reads one JSON request per line from a client connection and sends
+    back one JSON response per line.
+    """
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError('request must be a JSON object')
+                response = self.server.daemon.handle_request(request)
+            except ValueError as e:
+                request = {}
+                response = {'status': 'error', 'message': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+            # shut down once the response has been sent
+            if request.get('command') == 'shutdown':
+                self.server.daemon.shutdown()
+                return
+
+
+class tcp_server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class tcp6_server(tcp_server):
+    address_family = socket.AF_INET6
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class unix_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+# -- DAEMON CLASS -----------------------------------------------------
+
+class vcf_daemon:
+    def __init__(self, args, run, references):
+        """
+        Object properties that are loaded when the oject is created.
+        args are the command line arguments, used as defaults for every
+        job, run is the function that processes a single job and
+        references is the shared reference_data object.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.daemon')
+        self.args = args
+        self.run = run
+        self.references = references
+
+        self.queue = queue.Queue(maxsize=max(args.max_queue, 1))
+        self.n_workers = max(args.workers, 1)
+        self.workers = []
+        self.jobs = collections.OrderedDict()
+        self.next_id = 1
+        self.running = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+
+    def start(self):
+        """
+        Load the reference data given on the command line, start the
+        worker threads and open the socket. Returns the address that the
+        daemon is listening on.
+        """
+        # check the address before anything is started
+        address = parse_address(self.args.daemon)
+
+        # warm up the reference data passed in on the command line
+        for config in self.args.config or []:
+            self.references.config(config)
+        if self.args.transcripts:
+            self.references.transcripts(self.args.transcripts)
+        if self.args.known_variants:
+            self.references.known_variants(self.args.known_variants)
+
+        # start worker pool
+        for i in range(self.n_workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        # open socket, remove stale unix socket files first
+        if isinstance(address, tuple) and ':' in address[0]:
+            self.server = tcp6_server(address, request_handler)
+        elif isinstance(address, tuple):
+            self.server = tcp_server(address, request_handler)
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = unix_server(address, request_handler)
+        self.server.daemon = self
+
+        self.logger.info('daemon listening on {} with {} workers'.format(
+            self.server.server_address, self.n_workers))
+        return(self.server.server_address)
+
+
+    def serve(self):
+        """Start the daemon and handle requests until shut down"""
+        if self.server is None:
+            self.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if not isinstance(self.server.server_address, tuple):
+                try:
+                    os.remove(self.server.server_address)
+                except OSError:
+                    pass
+            self.logger.info('daemon stopped')
+
+
+    def shutdown(self):
+        """Stop the server loop, called from a request handler thread"""
+        threading.Thread(target=self.server.shutdown).start()
+
+
+    def handle_request(self, request):
+        """
+        Handle a decoded request from a client, returns the response.
+        """
+        command = request.get('command', 'submit')
+
+        if command == 'submit':
+            return(self.submit(request))
+
+        if command == 'status':
+            return(self.status())
+
+        if command == 'job':
+            with self.lock:
+                job = self.jobs.get(request.get('job'))
+                if job is None:
+                    return({'status': 'error', 'message': 'unknown job'})
+                return({'status': 'ok', 'job': self.job_info(job)})
+
+        if command == 'shutdown':
+            return({'status': 'ok'})
+
+        return({'status': 'error',
+                'message': 'unknown command {}'.format(command)})
+
+
+    def submit(self, request):
+        """
+        Make a job from a request and add it to the queue. The job
+        options default to the arguments that the daemon was started
+        with.
+        """
+        if not request.get('input'):
+            return({'status': 'error', 'message': 'no input VCF provided'})
+
+        args = copy.copy(self.args)
+        for option in JOB_OPTIONS:
+            if option in request:
+                setattr(args, option, request[option])
+        args.config_list = False
+        args.input = os.path.abspath(args.input)
+
+        with self.lock:
+            job = {
+                'id': self.next_id, 'input': args.input, 'state': 'queued',
+                'submitted': time.time(), 'started': None, 'finished': None,
+                'report': None, 'error': None
+            }
+            try:
+                self.queue.put_nowait((job, args))
+            except queue.Full:
+                return({'status': 'error', 'message': 'queue full'})
+            self.jobs[job['id']] = job
+            self.next_id += 1
+
+            # only keep a limited history of jobs
+            while len(self.jobs) > JOB_HISTORY:
+                oldest = next(iter(self.jobs))
+                if self.jobs[oldest]['state'] in ('queued', 'running'):
+                    break
+                del self.jobs[oldest]
+
+        self.logger.info('job {} queued - {}'.format(job['id'], args.input))
+        return({'status': 'queued', 'job': job['id']})
+
+
+    def work(self):
+        """Worker thread, runs jobs from the queue until the process ends"""
+        while True:
+            job, args = self.queue.get()
+            with self.lock:
+                job['state'] = 'running'
+                job['started'] = time.time()
+                self.running += 1
+
+            try:
+                report = self.run(args, self.references)
+                job['report'] = report.report_path
+                job['state'] = 'done'
+            except Exception as e:
+                self.logger.exception('job {} failed'.format(job['id']))
+                job['error'] = str(e)
+                job['state'] = 'failed'
+
+            with self.lock:
+                job['finished'] = time.time()
+                self.running -= 1
+            self.logger.info('job {} {} in {:.3f}s'.format(
+                job['id'], job['state'], job['finished'] - job['submitted']))
+            self.queue.task_done()
+
+
+    def job_info(self, job):
+        """Summary of a single job, including its latency in seconds"""
+        info = dict(job)
+        now = time.time()
+        started = job['started'] or now
+        finished = job['finished'] or now
+        info['queue_seconds'] = round(started - job['submitted'], 4)
+        info['run_seconds'] = round(finished - started, 4) if job['started'] else 0
+        info['latency_seconds'] = round(finished - job['submitted'], 4)
+        return(info)
+
+
+    def status(self):
+        """
+        Status of the daemon - queue depth, number of running jobs and
+        latency of every job in the history.
+        """
+        with self.lock:
+            jobs = [self.job_info(job) for job in self.jobs.values()]
+            finished = [job['latency_seconds'] for job in jobs
+                if job['state'] in ('done', 'failed')]
+            return({
+                'status': 'ok',
+                'queue_depth': self.queue.qsize(),
+                'max_queue': self.queue.maxsize,
+                'workers': self.n_workers,
+                'running': self.running,
+                'completed': len(finished),
+                'mean_latency_seconds':
+                    round(sum(finished) / len(finished), 4) if finished else None,
+                'max_latency_seconds': max(finished) if finished else None,
+                'jobs': jobs
+            })
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""
+external_sort.py
+
+Object that sorts and/ or removes duplicates from the rows of a variant
+report within a fixed memory budget. Rows are sorted in memory until
+the budget is used, then saved to a sorted run file in a scratch
+folder. Once all rows are read, the runs are merged back together.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import heapq
+import shutil
+import logging
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from scripts.report_table import report_row, value_text
+
+
+# keys that the report can be sorted by
+SORT_KEYS = ('position', 'gene', 'consequence')
+
+# rough memory used by each row and each value in a row, in bytes
+ROW_OVERHEAD = 200
+VALUE_OVERHEAD = 50
+
+
+def chrom_key(chrom):
+    """
+    Sort key for chromosome names, numbered chromosomes first in order,
+    then X, Y and MT, then anything else alphabetically.
+    """
+    name = chrom[3:] if chrom.lower().startswith('chr') else chrom
+    if name.isdigit():
+        return((0, int(name), ''))
+    if name in ('X', 'Y', 'M', 'MT'):
+        return((1, ('X', 'Y', 'M', 'MT').index(name), ''))
+    return((2, 0, name))
+
+
+def make_sort_key(sort_by, report):
+    """
+    Make the function that gives the sort key of a row. Gene and
+    consequence use the SYMBOL and Consequence columns of the report,
+    with ties sorted by position.
+    """
+    def position(row):
+        return((chrom_key(row.chrom), row.pos, row.ref, row.alt))
+
+    if sort_by == 'position':
+        return(position)
+
+    annotation = {'gene': 'SYMBOL', 'consequence': 'Consequence'}[sort_by]
+    column = report.annotation_column(annotation)
+    if column is None:
+        raise ValueError('cannot sort by {} - no {} column in report'.format(
+            sort_by, annotation))
+
+    def annotation_key(row):
+        return((value_text(row.values[column]),) + position(row))
+    return(annotation_key)
+
+
+# -- EXTERNAL SORT CLASS ----------------------------------------------
+
+class external_sort:
+    def __init__(self, key=None, dedup=False, memory_mb=512, scratch_dir=None):
+        """
+        Object properties that are loaded when the oject is created.
+        key is a function giving the sort key of a row, or None to keep
+        the original order. If dedup is set, rows that are identical to
+        an earlier row anywhere in the report are removed. memory_mb is
+        the approximate amount of memory the rows held in memory can use
+        before they are saved to disk.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.sort')
+        self.key = key
+        self.dedup = dedup
+        self.memory = int(memory_mb * 1024 * 1024)
+        self.scratch_dir = scratch_dir
+        self.runs = 0
+        self.duplicates = 0
+
+
+    def sort(self, rows):
+        """
+        Generator that takes report rows and yields them sorted and/ or
+        with duplicates removed. Within the same sort key, rows stay in
+        their original order.
+        """
+        scratch = tempfile.mkdtemp(prefix='vcf_parse_sort_', dir=self.scratch_dir)
+        try:
+            # number each row so that the original order can be kept
+            items = ((i, row) for i, row in enumerate(rows))
+
+            # remove duplicates - sort by row contents so identical rows
+            # are next to each other, keep the first of each
+            if self.dedup:
+                items = self.remove_duplicates(
+                    self.sort_items(items, self.contents_key, scratch))
+
+            # sort by the key, or back into the original order
+            if self.key is not None:
+                key = self.key
+                items = self.sort_items(
+                    items, lambda item: (key(item[1]), item[0]), scratch)
+            elif self.dedup:
+                items = self.sort_items(items, lambda item: item[0], scratch)
+
+            for i, row in items:
+                yield row
+        finally:
+            shutil.rmtree(scratch)
+
+        self.logger.info('sorted report - {} runs saved to disk, {} duplicates removed'.format(
+            self.runs, self.duplicates))
+
+
+    def row_text(self, row):
+        """Values of a row as they are written to the report"""
+        return([value_text(value) for value in row.values])
+
+
+    def contents_key(self, item):
+        return((self.row_text(item[1]), item[0]))
+
+
+    def remove_duplicates(self, items):
+        """Skip rows identical to the previous row, items must be sorted"""
+        last_values = None
+        for i, row in items:
+            values = self.row_text(row)
+            if values == last_values:
+                self.duplicates += 1
+                continue
+            last_values = values
+            yield (i, row)
+
+
+    def sort_items(self, items, key, scratch):
+        """
+        Generator that sorts (number, row) items by key. Items are held
+        in memory until the memory budget is used, then sorted and saved
+        as a run. If everything fits in memory nothing is saved.
+        """
+        buffer = []
+        used = 0
+        runs = []
+
+        for item in items:
+            buffer.append(item)
+            used += ROW_OVERHEAD + sum(
+                len(value_text(value)) + VALUE_OVERHEAD
+                for value in item[1].values)
+            if used >= self.memory:
+                runs.append(self.save_run(buffer, key, scratch))
+                buffer = []
+                used = 0
+
+        buffer.sort(key=key)
+        if not runs:
+            for item in buffer:
+                yield item
+            return
+
+        # merge the saved runs and what is left in memory, keys include
+        # the row number so the merge keeps the original order of ties
+        if buffer:
+            runs.append(self.save_run(buffer, key, scratch, presorted=True))
+        del buffer
+        merged = heapq.merge(*[self.read_run(path, key) for path in runs])
+        for sort_key, n, item in merged:
+            yield item
+
+
+    def save_run(self, buffer, key, scratch, presorted=False):
+        """Sort the items in memory and save them to a run file"""
+        if not presorted:
+            buffer.sort(key=key)
+        fd, path = tempfile.mkstemp(suffix='.run', dir=scratch)
+        with os.fdopen(fd, 'wb') as out:
+            for i, row in buffer:
+                pickle.dump(
+                    (i, row.chrom, row.pos, row.ref, row.alt, row.values),
+                    out, pickle.HIGHEST_PROTOCOL)
+        self.runs += 1
+        return(path)
+
+
+    def read_run(self, path, key):
+        """
+        Yields (sort key, run position, item) for each item in a run
+        file. The position makes sure rows are never compared directly.
+        """
+        with open(path, 'rb') as run:
+            n = 0
+            while True:
+                try:
+                    i, chrom, pos, ref, alt, values = pickle.load(run)
+                except EOFError:
+                    break
+                item = (i, report_row(chrom, pos, ref, alt, values))
+                yield (key(item), n, item)
+                n += 1
+        os.remove(path)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+file_utils.py
+
+Helper functions for opening input and output files, so that gzip
+compressed files, stdin and stdout can be used anywhere a plain text 
+file can.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import sys
+import gzip
+
+
+# filepath that means stdin when reading and stdout when writing
+STDIO = '-'
+
+
+class standard_stream(object):
+    """
+    stdin or stdout, used like an open file. Closing it only flushes 
+    any output, so that the stream can still be used afterwards.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+
+    def __getattr__(self, name):
+        return(getattr(self.stream, name))
+
+
+    def __iter__(self):
+        return(iter(self.stream))
+
+
+    def __enter__(self):
+        return(self)
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        if self.stream is sys.stdout:
+            self.stream.flush()
+
+
+def describe_path(path, mode='r'):
+    """Name of a filepath for log messages"""
+    if path == STDIO:
+        return('stdin' if mode == 'r' else 'stdout')
+    return(os.path.abspath(path))
+
+
+def open_text(path, mode='r'):
+    """
+    Open a text file for reading ('r') or writing ('w'). Files ending
+    in .gz are decompressed/ compressed with gzip. A path of '-' reads
+    from stdin or writes to stdout.
+    """
+    if path == STDIO:
+        if mode == 'r':
+            return(standard_stream(sys.stdin))
+        return(standard_stream(sys.stdout))
+    if path.endswith('.gz'):
+        if sys.version_info[0] >= 3:
+            return(gzip.open(path, mode + 't'))
+        return(gzip.open(path, mode + 'b'))
+    return(open(path, mode))
@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+
+"""
+filter_expression.py
+
+Parses filter expressions such as 'DP>=100 and IMPACT in (HIGH,MODERATE)'
+over the INFO, FORMAT and VEP fields of a VCF, and compiles them once
+into Python closures. The expression is split into the conditions that
+only need the variant, which are checked before the CSQ field is
+decoded, and the conditions that need a VEP transcript, which are
+checked before each row of the report is made. Rows that are filtered
+out therefore cost very little.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import re
+import logging
+
+
+# record attributes that can be used in an expression
+RECORD_FIELDS = ('CHROM', 'POS', 'REF', 'ALT', 'FILTER')
+
+# tokens of an expression, = is the same as ==
+TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<op>==|!=|<=|>=|<|>|=)|
+        (?P<punct>[(),])|
+        (?P<quoted>'[^']*'|"[^"]*")|
+        (?P<word>[^\s()<>=!,'"]+)
+    )''', re.VERBOSE)
+
+
+class filter_error(ValueError):
+    """Raised when a filter expression can't be parsed"""
+    pass
+
+
+def tokenize(text):
+    """
+    Split an expression into (kind, text) tokens. kind is op, punct,
+    string (quoted), word, or a keyword (and, or, not, in).
+    """
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = TOKEN.match(text, pos)
+        if match is None or match.end() == pos:
+            raise filter_error('cannot parse filter at "{}"'.format(
+                text[pos:].strip()))
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'quoted':
+            tokens.append(('string', value[1:-1]))
+        elif kind == 'word' and value.lower() in ('and', 'or', 'not', 'in'):
+            tokens.append((value.lower(), value))
+        else:
+            tokens.append((kind, value))
+    return(tokens)
+
+
+def to_number(value):
+    """
+    Value as a float, or None if it isn't a number. Values like A:0.01
+    (allele:frequency, as in the VEP MAF fields) give the frequency.
+    """
+    if isinstance(value, bool):
+        return(None)
+    try:
+        return(float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return(float(str(value).rsplit(':', 1)[1]))
+    except (IndexError, ValueError):
+        return(None)
+
+
+def parse_literal(token):
+    """A literal as a number if it is one, otherwise as text"""
+    kind, value = token
+    if kind == 'word':
+        number = to_number(value)
+        if number is not None and ':' not in value:
+            return(number)
+    return(value)
+
+
+# -- VALUE GETTERS ----------------------------------------------------
+# Each returns a function that takes a record and a split CSQ entry (or
+# None) and returns a list of the values of a field, an empty list if
+# the field is missing.
+
+def as_values(value):
+    if value is None:
+        return([])
+    if isinstance(value, (list, tuple)):
+        return([v for v in value if v is not None])
+    return([value])
+
+
+def record_getter(name):
+    if name == 'FILTER':
+        def get(record, vep):
+            # PASS is an empty list, missing filter is None
+            if record.FILTER is None:
+                return([])
+            return(list(record.FILTER) or ['PASS'])
+    elif name == 'ALT':
+        def get(record, vep):
+            return([str(alt) for alt in record.ALT if alt is not None])
+    else:
+        def get(record, vep):
+            return(as_values(getattr(record, name)))
+    return(get)
+
+
+def info_getter(name):
+    def get(record, vep):
+        try:
+            return(as_values(record.INFO[name]))
+        except Exception:
+            return([])
+    return(get)
+
+
+def format_getter(name, sample):
+    def get(record, vep):
+        value = None
+        for call in record:
+            if call.sample == sample:
+                try:
+                    value = call[name]
+                except Exception:
+                    value = None
+        return(as_values(value))
+    return(get)
+
+
+def frequency_getter(sample):
+    """Allele frequency (%) of the first ALT allele, from AD"""
+    ad = format_getter('AD', sample)
+    def get(record, vep):
+        try:
+            depths = ad(record, vep)
+            ref = float(depths[0])
+            alt = float(depths[1])
+            return([(alt / (ref + alt)) * 100])
+        except (TypeError, ValueError, IndexError, ZeroDivisionError):
+            return([])
+    return(get)
+
+
+def vep_getter(pos):
+    """VEP values with more than one entry (joined by &) are split"""
+    def get(record, vep):
+        if vep is None:
+            return([])
+        try:
+            value = vep[pos]
+        except IndexError:
+            return([])
+        if not value:
+            return([])
+        return(value.split('&'))
+    return(get)
+
+
+# -- CONDITIONS -------------------------------------------------------
+
+def make_comparison(get, op, literal):
+    """
+    Condition that is true if any value of the field matches. != is
+    true if the field has values and none of them are equal. A missing
+    field never matches.
+    """
+    negate = op == '!='
+    if op in ('=', '!='):
+        op = '=='
+
+    if isinstance(literal, float):
+        compare = {
+            '==': lambda number: number == literal,
+            '<': lambda number: number < literal,
+            '<=': lambda number: number <= literal,
+            '>': lambda number: number > literal,
+            '>=': lambda number: number >= literal,
+        }[op]
+        def matches(value):
+            number = to_number(value)
+            return(number is not None and compare(number))
+    else:
+        if op != '==':
+            raise filter_error(
+                '{} needs a number, not {}'.format(op, literal))
+        def matches(value):
+            return(str(value) == literal)
+
+    if negate:
+        def condition(record, vep):
+            values = get(record, vep)
+            return(bool(values) and not any(matches(v) for v in values))
+    else:
+        def condition(record, vep):
+            return(any(matches(v) for v in get(record, vep)))
+    return(condition)
+
+
+def make_membership(get, literals, negate):
+    """
+    Condition that is true if any value of the field is in the list,
+    or for not in, if the field has values and none are in the list
+    """
+    strings = set(str(v) for v in literals if not isinstance(v, float))
+    numbers = set(v for v in literals if isinstance(v, float))
+
+    def matches(value):
+        if str(value) in strings:
+            return(True)
+        return(bool(numbers) and to_number(value) in numbers)
+
+    if negate:
+        def condition(record, vep):
+            values = get(record, vep)
+            return(bool(values) and not any(matches(v) for v in values))
+    else:
+        def condition(record, vep):
+            return(any(matches(v) for v in get(record, vep)))
+    return(condition)
+
+
+def make_exists(get):
+    """Condition that is true if the field has a value, e.g. a flag"""
+    def condition(record, vep):
+        return(any(v is not False and v != '' for v in get(record, vep)))
+    return(condition)
+
+
+def make_and(conditions):
+    def condition(record, vep):
+        for test in conditions:
+            if not test(record, vep):
+                return(False)
+        return(True)
+    return(condition)
+
+
+def make_or(conditions):
+    def condition(record, vep):
+        for test in conditions:
+            if test(record, vep):
+                return(True)
+        return(False)
+    return(condition)
+
+
+def make_not(test):
+    def condition(record, vep):
+        return(not test(record, vep))
+    return(condition)
+
+
+# -- PARSER -----------------------------------------------------------
+
+class expression_parser(object):
+    """
+    Recursive descent parser for filter expressions:
+
+        expression := and_expr ('or' and_expr)*
+        and_expr   := not_expr ('and' not_expr)*
+        not_expr   := 'not' not_expr | '(' expression ')' | condition
+        condition  := field op value
+                    | field ['not'] 'in' '(' value (',' value)* ')'
+                    | field
+
+    Each part of the expression is returned as a (closure, uses_vep)
+    pair, the conditions joined by 'and' at the top level are returned
+    as a list of these so that they can be split by level.
+    """
+    def __init__(self, text, report):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+        self.report = report
+
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return(self.tokens[self.pos])
+        return((None, None))
+
+
+    def take(self, kind=None):
+        token = self.peek()
+        if token[0] is None:
+            raise filter_error('filter "{}" ends too early'.format(self.text))
+        if kind is not None and token[0] != kind:
+            raise filter_error('expected {} in filter, found "{}"'.format(
+                kind, token[1]))
+        self.pos += 1
+        return(token)
+
+
+    def parse(self):
+        """Returns the list of top level conditions joined by 'and'"""
+        parts = self.parse_or()
+        if self.peek()[0] is not None:
+            raise filter_error('unexpected "{}" in filter'.format(
+                self.peek()[1]))
+        return(parts)
+
+
+    def parse_or(self):
+        """
+        Returns the list of conditions joined by 'and', or a list of one
+        condition if they are joined by 'or'
+        """
+        groups = [self.parse_and()]
+        while self.peek()[0] == 'or':
+            self.take()
+            groups.append(self.parse_and())
+        if len(groups) == 1:
+            return(groups[0])
+        groups = [join_and(group) for group in groups]
+        return([(make_or([test for test, uses_vep in groups]), 
+                 any(uses_vep for test, uses_vep in groups))])
+
+
+    def parse_and(self):
+        parts = [self.parse_not()]
+        while self.peek()[0] == 'and':
+            self.take()
+            parts.append(self.parse_not())
+        return(parts)
+
+
+    def parse_not(self):
+        kind, value = self.peek()
+        if kind == 'not':
+            self.take()
+            test, uses_vep = self.parse_not()
+            return((make_not(test), uses_vep))
+        if kind == 'punct' and value == '(':
+            self.take()
+            out = join_and(self.parse_or())
+            self.expect_punct(')')
+            return(out)
+        return(self.parse_condition())
+
+
+    def expect_punct(self, char):
+        kind, value = self.take()
+        if kind != 'punct' or value != char:
+            raise filter_error('expected "{}" in filter, found "{}"'.format(
+                char, value))
+
+
+    def parse_condition(self):
+        kind, name = self.take()
+        if kind != 'word':
+            raise filter_error('expected a field name in filter, found '
+                '"{}"'.format(name))
+        get, uses_vep = self.field(name)
+
+        kind, value = self.peek()
+        if kind == 'op':
+            self.take()
+            literal = parse_literal(self.take_value())
+            return((make_comparison(get, value, literal), uses_vep))
+
+        if kind in ('in', 'not'):
+            negate = kind == 'not'
+            if negate:
+                self.take()
+                if self.peek()[0] != 'in':
+                    raise filter_error('expected in after not in filter')
+            self.take()
+            self.expect_punct('(')
+            literals = [parse_literal(self.take_value())]
+            while self.peek() == ('punct', ','):
+                self.take()
+                literals.append(parse_literal(self.take_value()))
+            self.expect_punct(')')
+            return((make_membership(get, literals, negate), uses_vep))
+
+        return((make_exists(get), uses_vep))
+
+
+    def take_value(self):
+        token = self.take()
+        if token[0] not in ('word', 'string'):
+            raise filter_error('expected a value in filter, found "{}"'.format(
+                token[1]))
+        return(token)
+
+
+    def field(self, name):
+        """
+        Value getter for a field name, and whether it needs the VEP
+        transcript. Names can start with INFO., FORMAT. or VEP. (or
+        CSQ.), otherwise they are looked for in the record fields, then
+        INFO, FORMAT and VEP in that order.
+        """
+        report = self.report
+        source = None
+        field = name
+        if '.' in name:
+            prefix, rest = name.split('.', 1)
+            if prefix.upper() in ('INFO', 'FORMAT', 'VEP', 'CSQ'):
+                source = prefix.upper().replace('CSQ', 'VEP')
+                field = rest
+
+        if source is None and field in RECORD_FIELDS:
+            return(record_getter(field), False)
+        if source in (None, 'INFO') and field in report.info_fields \
+                and field != 'CSQ':
+            return(info_getter(field), False)
+        if source in (None, 'FORMAT'):
+            if field == 'Frequency':
+                return(frequency_getter(report.sample), False)
+            if field in report.format_fields:
+                return(format_getter(field, report.sample), False)
+        if source in (None, 'VEP') and field in report.vep_fields:
+            return(vep_getter(report.vep_fields.index(field)), True)
+
+        raise filter_error('unknown field {} in filter'.format(name))
+
+
+def join_and(parts):
+    if len(parts) == 1:
+        return(parts[0])
+    return((make_and([p[0] for p in parts]), any(p[1] for p in parts)))
+
+
+# -- FILTER CLASS -----------------------------------------------------
+
+class record_filter:
+    def __init__(self, expression, report):
+        """
+        Object properties that are loaded when the oject is created.
+        expression is the filter text, report is a vcf_report with its
+        header read, which is used to find each field.
+        variant is the closure of the conditions that only need the
+        record, transcript is the closure of those that need a split CSQ
+        entry. Either is None if there are no conditions of that kind.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.filter')
+        self.expression = expression
+        parts = expression_parser(expression, report).parse()
+
+        variant = [test for test, uses_vep in parts if not uses_vep]
+        transcript = [test for test, uses_vep in parts if uses_vep]
+        self.variant = None
+        if variant:
+            test = make_and(variant) if len(variant) > 1 else variant[0]
+            self.variant = lambda record: test(record, None)
+        self.transcript = None
+        if transcript:
+            self.transcript = (make_and(transcript)
+                if len(transcript) > 1 else transcript[0])
+
+        self.variants_removed = 0
+        self.transcripts_removed = 0
+
+
+    def log_counts(self):
+        self.logger.info('filter "{}" removed {} variants and {} '
+            'transcripts'.format(self.expression, self.variants_removed,
+            self.transcripts_removed))
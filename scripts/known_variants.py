@@ -1,4 +1,4 @@
-#!/anaconda3/envs/python2/bin/python
+#!/usr/bin/env python
 
 """
 known_variants.py
@@ -14,9 +14,28 @@ Updated:    31 Oct 2018
 
 
 import os
-import csv
-import vcf
 import logging
+from contextlib import closing
+
+from scripts.vcf_backends import open_vcf
+
+
+def read_known_variants(inp, backend='pyvcf'):
+    """
+    Generator of the (variant name, classification) of each record in
+    a known variants VCF, backend is the library used to read the VCF
+    (see vcf_backends.py)
+    """
+    vcf_input, vcf_reader = open_vcf(inp, backend)
+    with closing(vcf_input):
+        for var in vcf_reader:
+            var_name = '{}:{}{}>{}'.format(
+                str(var.CHROM), 
+                str(var.POS), 
+                str(var.REF), 
+                str(var.ALT).strip('[]').replace(' ', '')
+            )
+            yield (var_name, var.INFO['Classification'])
 
 
 # -- KNOWN VARIANTS CLASS ---------------------------------------------
@@ -31,45 +50,40 @@ class known_variants:
         self.logger = logging.getLogger('vcf_parse.known')
 
 
-    def load_known_variants(self, inp):
+    def load_known_variants(self, inp, backend='pyvcf'):
         """
-        Load in vcf and save as list
+        Load in vcf and save as list, backend is the library used to
+        read the VCF (see vcf_backends.py)
         """
-        # read input vcf with pyvcf package, save as list
+        # read input vcf, save as list
         self.logger.info(
             'loading known variants from {}'.format(os.path.abspath(inp)))
 
-        with open(inp, 'r') as vcf_input:
-            vcf_reader = vcf.Reader(vcf_input)
-            vcf_list = []
-            vcf_records = []
-            for var in vcf_reader:
-                var_name = '{}:{}{}>{}'.format(
-                    str(var.CHROM), 
-                    str(var.POS), 
-                    str(var.REF), 
-                    str(var.ALT).strip('[]').replace(' ', '')
-                )
-                classification = var.INFO['Classification']
-                vcf_list.append(var_name)
-                vcf_records.append([var_name, classification])
-
-            self.list = vcf_list
-            self.records = vcf_records
-            self.logger.info('loading known variants completed')
+        vcf_list = []
+        vcf_records = []
+        classifications = {}
+        for var_name, classification in read_known_variants(inp, backend):
+            vcf_list.append(var_name)
+            vcf_records.append([var_name, classification])
+            classifications.setdefault(var_name, []).append(
+                '{}'.format(classification))
 
+        self.list = vcf_list
+        self.records = vcf_records
+        self.classifications = classifications
+        self.logger.info('loading known variants completed')
 
-    def apply_known_variants(self, report):
+
+    def find_column(self, table, config):
         """
-        check that there is a Classification column
-        Compares variant id with list of known variants, annotates if there is a match
+        Find the classification column number in a report table, using
+        the column name from the config if there is one. If there isn't
+        a classification column, one is added to the end of the table.
         """
-        # set report path
-        report_path = report.report_path
-
         # find classification column in config file
-        if report.config:
-            for record in report.config:
+        classification_id = None
+        if config:
+            for record in config:
                 if record[0] == 'Classification':
                     if record[2] != '':
                         classification_id = record[2]
@@ -78,48 +92,44 @@ class known_variants:
         else:
             classification_id = 'Classification'
 
-        if self.list:
-            # open report file and new temp file to save output
-            report_temp = os.path.join(report_path + '.temp')
-            f1 = open(report_path, 'rb')
-            reader = csv.reader(f1, delimiter='\t')
-            f2 = open(report_temp, 'wb')
-            writer = csv.writer(f2, delimiter='\t')
-
-            # load header, 
-            header = next(reader)
-            variant_column = 1
-
-            # find classification column, make one if not present
-            try:
-                classification_column = header.index(classification_id)
-            except:
-                classification_column = len(header)
-                header += ['Classification']
-
-            writer.writerow(header)
-
-            # loop though the report, annotate with classification if there is a match
-            for row in reader:
-                if row[variant_column] in self.list:
-                    i = ''
-                    for r in self.records:
-                        if r[0] == row[variant_column]:
-                            i += '{},'.format(r[1])
-                    writer.writerow(row[0:classification_column] + [i.rstrip(',')] + row[classification_column+1:])
+        # find classification column, make one if not present
+        classification_column = table.column(classification_id)
+        if classification_column is None:
+            classification_column = table.add_column('Classification')
+        return(classification_column)
+
+
+    def annotate_rows(self, rows, classification_column):
+        """
+        Generator that takes report rows, compares the variant id with 
+        the list of known variants and yields the rows with the 
+        classification added if there is a match.
+        """
+        for row in rows:
+            classifications = self.classifications.get(row.variant)
+            if classifications is not None:
+                value = ','.join(classifications)
+                if classification_column < len(row.values):
+                    row.values[classification_column] = value
                 else:
-                    writer.writerow(row)
+                    row.values.append(value)
+            yield row
+
 
-            # tidy up
+    def apply_known_variants(self, report):
+        """
+        check that there is a Classification column
+        Compares variant id with list of known variants, annotates if there is a match
+        """
+        if self.list:
+            column = self.find_column(report.table, report.config)
+            for row in self.annotate_rows(report.table.rows, column):
+                pass
             self.logger.info('known variants applied')
-            f1.close()
-            f2.close()
-            os.remove(report_path)
-            os.rename(report_temp, report_path)
         
         # if error, skip adding known variants
         else:
-            self.logger.warn(
+            self.logger.warning(
                 'could not load known variants file provided, skipping step.'
             )
             return
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+"""
+parallel_parse.py
+
+Makes the variant report of a large uncompressed VCF with several
+worker processes. The VCF is memory-mapped, the end of the header is
+found and the records after it are split into byte ranges that start
+and end on line boundaries. Each worker maps the same file, parses the
+records of its own range and makes the report rows for them, so the
+file is never copied between processes. Preferred transcripts and known
+variants are also applied by the workers, with the known variants read
+from a table shared by all of them (see shared_reference.py). Workers
+read the annotation cache but don't change it, the entries they used
+are added to the main process's cache with their rows. The rows of
+each range are joined in order, giving the same report as a single
+process.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import mmap
+import logging
+import multiprocessing
+
+from scripts.file_utils import STDIO
+from scripts.report_table import report_table, report_row
+from scripts.vcf_report import vcf_report
+from scripts.filter_expression import record_filter
+from scripts.columnar_engine import columnar_engine
+from scripts.report_summary import report_summary
+from scripts.preferred_transcripts import preferred_transcripts, \
+    transcript_chooser
+from scripts.known_variants import known_variants
+from scripts.shared_reference import shared_references, \
+    shared_known_variants, numpy
+from scripts.api import annotate_rows
+from scripts.annotation_cache import annotation_cache, worker_cache, \
+    merge_used
+
+
+# number of ranges for each worker, more ranges than workers keeps all
+# the workers busy if some ranges are slower than others
+CHUNKS_PER_WORKER = 4
+
+# smallest range worth giving to a worker, in bytes
+MIN_CHUNK_SIZE = 256 * 1024
+
+# annotation caches read by the workers, by filepath. Set by the main
+# process before the workers start, so forked workers have them already
+# and others load them from the file once
+WORKER_CACHES = {}
+
+
+def can_map(path):
+    """True if a VCF can be memory-mapped and split into ranges"""
+    return(path != STDIO and not path.endswith('.gz'))
+
+
+def decode(line):
+    """Text of a line read from the mapped file"""
+    if bytes is str:
+        return(line)
+    return(line.decode('utf-8'))
+
+
+def map_file(vcf_file):
+    """Read only memory map of an open file"""
+    return(mmap.mmap(vcf_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def header_end(data):
+    """Offset of the first record, just after the last header line"""
+    pos = 0
+    size = len(data)
+    while pos < size and data[pos:pos + 1] == b'#':
+        end = data.find(b'\n', pos)
+        if end == -1:
+            return(size)
+        pos = end + 1
+    return(pos)
+
+
+def chunk_ranges(data, start, chunks):
+    """
+    Split the records from start to the end of the file into up to
+    chunks (start, end) byte ranges of about the same size. Each range
+    starts at the beginning of a line and ends just after a newline (or
+    at the end of the file), so no record is split between ranges.
+    """
+    size = len(data)
+    bounds = [start]
+    for n in range(1, chunks):
+        target = start + (size - start) * n // chunks
+        if target <= bounds[-1]:
+            continue
+        end = data.find(b'\n', target - 1)
+        end = size if end == -1 else end + 1
+        if end >= size:
+            break
+        bounds.append(end)
+    bounds.append(size)
+    return([(bounds[n], bounds[n + 1]) for n in range(len(bounds) - 1)
+            if bounds[n] < bounds[n + 1]])
+
+
+def range_lines(data, start, end):
+    """Generator of the lines in a byte range of the mapped file"""
+    data.seek(start)
+    while data.tell() < end:
+        yield decode(data.readline())
+
+
+def vcf_lines(path, start, end):
+    """
+    Generator of the header lines of a VCF followed by the record lines
+    in a byte range, which must start and end on line boundaries. The
+    file is memory-mapped, so only the lines used are read.
+    """
+    with open(path, 'rb') as vcf_file:
+        data = map_file(vcf_file)
+        try:
+            header = decode(data[:header_end(data)])
+            for line in header.splitlines(True):
+                yield line
+            for line in range_lines(data, start, end):
+                yield line
+        finally:
+            data.close()
+
+
+def load_worker_cache(path, max_entries):
+    """Annotation cache read by the workers, loaded once per process"""
+    cache = WORKER_CACHES.get(path)
+    if cache is None:
+        cache = annotation_cache(path, max_entries)
+        cache.load()
+        WORKER_CACHES[path] = cache
+    return(cache)
+
+
+def parse_chunk(job):
+    """
+    Worker function, makes the rows of every report for the records in
+    one byte range of the VCF. job is (path, start, end, settings),
+    where settings has the config of each report and the options of the
+    main report. Returns a dictionary of the rows of
+    each report, as (chrom, pos, ref, alt, values) tuples, the summary
+    and the filter counts. If settings has preferred transcripts or the
+    folder of the shared known variants, they are applied to the rows.
+    If it has an annotation cache, the keys used and the hits and 
+    misses of each report are returned too.
+    """
+    path, start, end, settings = job
+
+    # reports are set up in the same way as in vcf_parse.run
+    report = vcf_report()
+    reader = report.read_header(vcf_lines(path, start, end))
+    report.set_output(None)
+    report.config = settings['configs'][0]
+    reports = [report]
+    for n, config in enumerate(settings['configs'][1:]):
+        reports.append(report.config_report(config, str(n)))
+    if settings['filter'] is not None:
+        report.filter = record_filter(settings['filter'], report)
+    if settings['engine']:
+        report.engine = columnar_engine(report)
+    if settings['summary']:
+        report.summary = report_summary(report)
+    if settings['chooser'] is not None:
+        report.transcript_chooser = transcript_chooser(report, 
+            *settings['chooser'])
+    cache = None
+    if settings['annotation_cache'] is not None:
+        cache = worker_cache(load_worker_cache(*settings['annotation_cache']))
+        for each in reports:
+            each.annotation_cache = cache
+
+    transcripts = None
+    if settings['transcripts'] is not None:
+        transcripts = preferred_transcripts()
+        transcripts.list = settings['transcripts']
+    known = None
+    if settings['known'] is not None:
+        known = shared_known_variants(settings['known'])
+
+    rows = dict((id(each), []) for each in reports)
+    for each, row in report.iter_reports(
+            settings['filter_setting'], reports, reader):
+        rows[id(each)].append(row)
+
+    # annotated in the same way as the transform stage of the pipeline
+    if transcripts is not None or known is not None:
+        for each in reports:
+            table = report_table(each.make_header())
+            rows[id(each)] = list(annotate_rows(rows[id(each)], table, 
+                each.config, transcripts, settings['strictness'], known))
+
+    out = {
+        'rows': [[(row.chrom, row.pos, row.ref, row.alt, row.values) 
+                  for row in rows[id(each)]] for each in reports],
+        'summary': report.summary,
+        'filtered': None,
+        'chosen': None,
+        'cache': None,
+    }
+    if cache is not None:
+        out['cache'] = (cache.used, [(each.cache_hits, each.cache_misses) 
+                                     for each in reports])
+    if report.filter is not None:
+        out['filtered'] = (report.filter.variants_removed,
+                           report.filter.transcripts_removed)
+    chooser = report.transcript_chooser
+    if chooser is not None:
+        out['chosen'] = (chooser.variants_preferred, chooser.variants_best,
+                         chooser.transcripts_removed)
+    return(out)
+
+
+# -- PARALLEL PARSER CLASS --------------------------------------------
+
+class parallel_parser:
+    def __init__(self, path, workers, chunks=None):
+        """
+        Object properties that are loaded when the oject is created.
+        path is an uncompressed VCF file, workers is the number of
+        worker processes. chunks is the number of byte ranges the
+        records are split into, by default CHUNKS_PER_WORKER for each
+        worker, but none smaller than MIN_CHUNK_SIZE.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        if not can_map(path):
+            raise ValueError('only uncompressed VCF files can be parsed '
+                'in parallel - {}'.format(path))
+        self.logger = logging.getLogger('vcf_parse.parallel')
+        self.path = path
+        self.workers = max(1, workers)
+        self.chunks = chunks
+
+        # set by make_reports if the workers applied them
+        self.transcripts_applied = False
+        self.known_applied = False
+
+
+    def split(self):
+        """Byte ranges of the records in the VCF"""
+        with open(self.path, 'rb') as vcf_file:
+            data = map_file(vcf_file)
+            try:
+                start = header_end(data)
+                chunks = self.chunks
+                if chunks is None:
+                    chunks = min(self.workers * CHUNKS_PER_WORKER,
+                        (len(data) - start) // MIN_CHUNK_SIZE)
+                ranges = chunk_ranges(data, start, max(1, chunks))
+            finally:
+                data.close()
+        return(ranges)
+
+
+    def make_reports(self, filter_setting, reports, transcripts=None,
+                     strictness='low', known=None):
+        """
+        Makes the variant reports in the same way as
+        vcf_report.make_reports, with each byte range of the VCF parsed
+        by a worker. reports[0] is the main report, its filter, engine
+        and summary are used in the workers and the results added back
+        to it. Preferred transcripts and known variants, if given, are 
+        applied by the workers too, transcripts_applied and 
+        known_applied are set if they were. known can be a loaded 
+        known_variants object, shared while the reports are made, or a
+        shared_references object made by the caller.
+        """
+        report = reports[0]
+        ranges = self.split()
+        settings = {
+            'configs': [each.config for each in reports],
+            'filter_setting': filter_setting,
+            'filter': None,
+            'engine': report.engine is not None,
+            'summary': report.summary is not None,
+            'chooser': None,
+            'transcripts': None,
+            'strictness': strictness,
+            'known': None,
+            'annotation_cache': None,
+        }
+        if report.filter is not None:
+            settings['filter'] = report.filter.expression
+        chooser = report.transcript_chooser
+        if chooser is not None:
+            settings['chooser'] = (chooser.transcripts, chooser.strictness)
+        cache = report.annotation_cache
+        if cache is not None:
+            WORKER_CACHES[cache.path] = cache
+            settings['annotation_cache'] = (cache.path, cache.max_entries)
+        self.transcripts_applied = bool(transcripts and transcripts.list)
+        if self.transcripts_applied:
+            settings['transcripts'] = transcripts.list
+
+        # known variants are shared with the workers, rather than each 
+        # worker being sent its own copy
+        shared = None
+        if isinstance(known, shared_references):
+            settings['known'] = known.folder
+            self.known_applied = True
+        elif known and known.list:
+            if numpy is None:
+                self.logger.info('numpy is not installed -- known variants '
+                    'are applied after the workers finish')
+            else:
+                shared = shared_references(known)
+                settings['known'] = shared.folder
+                self.known_applied = True
+        jobs = [(self.path, begin, end, settings) for begin, end in ranges]
+
+        self.logger.info('making variant report from {} ranges of {} with '
+            '{} workers'.format(len(jobs), self.path, self.workers))
+        for each in reports:
+            each.table = report_table(each.make_header())
+            if self.known_applied:
+                known_variants().find_column(each.table, each.config)
+
+        # ranges are given out in order and their results come back in
+        # the same order
+        pool = None
+        if self.workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(self.workers, len(jobs)))
+            results = pool.imap(parse_chunk, jobs)
+        else:
+            results = (parse_chunk(job) for job in jobs)
+        try:
+            for result in results:
+                self.add_result(reports, result)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if shared is not None:
+                shared.close()
+            if cache is not None:
+                WORKER_CACHES.pop(cache.path, None)
+
+        for each in reports:
+            self.logger.info('variant report made - {} rows'.format(
+                len(each.table.rows)))
+
+
+    def add_result(self, reports, result):
+        """Add the rows, summary and filter counts of one range"""
+        for each, rows in zip(reports, result['rows']):
+            table_rows = each.table.rows
+
+            # a row identical to the last row of the range before is
+            # skipped, as it would be in one pass over the records
+            if rows and table_rows and rows[0][4] == table_rows[-1].values:
+                rows = rows[1:]
+            for chrom, pos, ref, alt, values in rows:
+                table_rows.append(report_row(chrom, pos, ref, alt, values))
+
+        report = reports[0]
+        if result['summary'] is not None:
+            report.summary.merge(result['summary'])
+        if result['filtered'] is not None:
+            report.filter.variants_removed += result['filtered'][0]
+            report.filter.transcripts_removed += result['filtered'][1]
+        if result['chosen'] is not None:
+            chooser = report.transcript_chooser
+            chooser.variants_preferred += result['chosen'][0]
+            chooser.variants_best += result['chosen'][1]
+            chooser.transcripts_removed += result['chosen'][2]
+        if result['cache'] is not None:
+            used, counts = result['cache']
+            merge_used(report.annotation_cache, used)
+            for each, (hits, misses) in zip(reports, counts):
+                each.cache_hits += hits
+                each.cache_misses += misses
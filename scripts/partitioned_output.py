@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+partitioned_output.py
+
+Object that writes the variant report split into one file per
+chromosome or per gene, in a folder next to the main report. Only a
+limited number of files are kept open at once, the least recently used
+is closed when another is needed and reopened to add to it later. A
+manifest can be saved with the number of rows and size of each file.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import re
+import csv
+import logging
+from collections import OrderedDict
+
+
+# ways the report can be split
+PARTITION_KEYS = ('chrom', 'gene')
+
+# name of the partition for rows with no gene
+NO_GENE = 'no_gene'
+
+
+def partition_filename(name):
+    """Make a partition name safe to use as a filename"""
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', name)
+    return(name.lstrip('.') or NO_GENE)
+
+
+# -- PARTITION WRITER CLASS -------------------------------------------
+
+class partition_writer:
+    def __init__(self, report, partition_by, max_open=64, manifest=False):
+        """
+        Object properties that are loaded when the oject is created.
+        report is the vcf_report being written, its table header must
+        be complete. partition_by is chrom or gene (the SYMBOL column).
+        max_open is the most partition files open at once. If manifest
+        is set, a manifest.txt is saved with the rows and bytes of each
+        partition.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.partition')
+        self.header = report.table.header
+        self.partition_by = partition_by
+        self.max_open = max(1, max_open)
+        self.manifest = manifest
+        self.folder = os.path.join(report.output_dir,
+            '{}_VariantReport_by_{}'.format(report.report_name, partition_by))
+
+        # column used to split the report
+        self.column = None
+        if partition_by == 'gene':
+            self.column = report.annotation_column('SYMBOL')
+            if self.column is None:
+                raise ValueError('cannot split report by gene - no SYMBOL '
+                    'column in report')
+
+        self.handles = OrderedDict()
+        self.rows = {}
+        self.paths = {}
+        self.reopened = 0
+        if not os.path.exists(self.folder):
+            os.mkdir(self.folder)
+
+
+    def partition(self, row):
+        """
+        Name of the partition a row belongs to, this is also used as the
+        filename so it only contains safe characters
+        """
+        if self.column is None:
+            return(partition_filename(row.chrom))
+        gene = row.values[self.column]
+        if not gene or gene == 'No VEP output':
+            return(NO_GENE)
+        return(partition_filename(gene))
+
+
+    def writer(self, name):
+        """
+        csv writer for a partition. Opens the file if needed, closing
+        the least recently used file if too many are open.
+        """
+        handle = self.handles.pop(name, None)
+        if handle is None:
+            if len(self.handles) >= self.max_open:
+                old_name, (old_file, old_writer) = self.handles.popitem(
+                    last=False)
+                old_file.close()
+
+            if name in self.paths:
+                # file was closed earlier, add to the end of it
+                out = open(self.paths[name], 'a')
+                writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+                self.reopened += 1
+            else:
+                path = os.path.join(self.folder, name + '.txt')
+                self.paths[name] = path
+                self.rows[name] = 0
+                out = open(path, 'w')
+                writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+                writer.writerow(self.header)
+            handle = (out, writer)
+
+        self.handles[name] = handle
+        return(handle[1])
+
+
+    def write_rows(self, rows):
+        """Add rows to their partitions"""
+        for row in rows:
+            name = self.partition(row)
+            self.writer(name).writerow(row.values)
+            self.rows[name] += 1
+
+
+    def pass_rows(self, rows):
+        """
+        Generator that adds rows to their partitions as they pass 
+        through, so the rows can be written elsewhere in the same pass
+        """
+        for row in rows:
+            self.write_rows((row,))
+            yield row
+
+
+    def close(self):
+        """Close all open files and save the manifest if needed"""
+        for out, writer in self.handles.values():
+            out.close()
+        self.handles.clear()
+
+        if self.manifest:
+            self.write_manifest()
+        self.logger.info('split report into {} files by {} - {}'.format(
+            len(self.paths), self.partition_by, self.folder))
+        if self.reopened:
+            self.logger.info('partition files reopened {} times, more than '
+                '{} files were needed at once'.format(
+                self.reopened, self.max_open))
+
+
+    def write_manifest(self):
+        """Save the file, number of rows and size of each partition"""
+        path = os.path.join(self.folder, 'manifest.txt')
+        with open(path, 'w') as out:
+            writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+            writer.writerow(['Partition', 'File', 'Rows', 'Bytes'])
+            for name in sorted(self.paths):
+                writer.writerow([
+                    name,
+                    os.path.basename(self.paths[name]),
+                    self.rows[name],
+                    os.path.getsize(self.paths[name])
+                ])
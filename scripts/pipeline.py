@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+pipeline.py
+
+Object that makes a variant report with separate reader, transform and
+writer threads, connected by bounded queues. Reading (and decompressing)
+the VCF, making the report rows and writing (and compressing) the
+report then overlap, while the queues cap how much is held in memory.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import csv
+import time
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from scripts.report_table import report_table
+from scripts.file_utils import open_text, describe_path
+from scripts.api import annotate_rows
+
+
+# number of records/ rows passed between stages at a time
+BATCH_SIZE = 100
+
+# marks the end of the data in a queue
+END = object()
+
+
+class pipeline_stopped(Exception):
+    """Raised in a stage when another stage has failed"""
+    pass
+
+
+# -- QUEUE CLASS ------------------------------------------------------
+
+class stage_queue(object):
+    """
+    Bounded queue between two stages that records how full it is each
+    time something is added, and how often a stage had to wait.
+    """
+    def __init__(self, name, maxsize, stop):
+        self.name = name
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stop = stop
+        self.puts = 0
+        self.total = 0
+        self.max = 0
+        self.full = 0
+        self.empty = 0
+
+
+    def put(self, item):
+        if self.queue.full():
+            self.full += 1
+        while True:
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                if self.stop.is_set():
+                    raise pipeline_stopped()
+        size = self.queue.qsize()
+        self.puts += 1
+        self.total += size
+        self.max = max(self.max, size)
+
+
+    def get(self):
+        if self.queue.empty():
+            self.empty += 1
+        while True:
+            try:
+                return(self.queue.get(timeout=0.1))
+            except queue.Empty:
+                if self.stop.is_set():
+                    raise pipeline_stopped()
+
+
+    def stats(self):
+        """Occupancy of the queue, recorded each time an item was added"""
+        return({
+            'size': self.queue.maxsize,
+            'max': self.max,
+            'mean': float(self.total) / self.puts if self.puts else 0.0,
+            'producer_waits': self.full,
+            'consumer_waits': self.empty,
+        })
+
+
+# -- PIPELINE CLASS ---------------------------------------------------
+
+class report_pipeline:
+    def __init__(self, report, queue_size=64, batch_size=BATCH_SIZE):
+        """
+        Object properties that are loaded when the oject is created.
+        report is a vcf_report with its header read by open_data.
+        queue_size is the number of batches each queue can hold.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.pipeline')
+        self.report = report
+        self.batch_size = batch_size
+        self.stop = threading.Event()
+        self.error = None
+        self.records = stage_queue('records', queue_size, self.stop)
+        self.rows = stage_queue('rows', queue_size, self.stop)
+
+
+    def run(self, vcf_reader, filter_setting, transcripts=None,
+            strictness='low', known=None, keep_rows=False, sort_rows=None,
+            partitions=None):
+        """
+        Make and write the variant report. Records are read from
+        vcf_reader, preferred transcripts and known variants are applied
+        if given. sort_rows is an optional function that takes and 
+        returns an iterator of rows, run as part of the transform stage.
+        partitions is an optional partition_writer, made once the header
+        is complete, that the writer stage also sends rows to.
+        If keep_rows is set, the rows are also kept in report.table so 
+        that BED files can be applied afterwards.
+        """
+        self.logger.info('making variant report with pipelined stages')
+        start = time.time()
+        report = self.report
+        report.table = report_table(report.make_header())
+
+        # chain of row generators, run by the transform stage. Built
+        # here so that the header is complete before writing starts
+        rows = report.iter_report(
+            filter_setting, records=self.iter_batches(self.records))
+        rows = annotate_rows(rows, report.table, report.config,
+            transcripts, strictness, known)
+        if sort_rows is not None:
+            rows = sort_rows(rows)
+        if partitions is not None:
+            partitions = partitions()
+
+        stages = [
+            threading.Thread(target=self.stage, args=(self.read, vcf_reader)),
+            threading.Thread(target=self.stage, args=(self.transform, rows)),
+            threading.Thread(target=self.stage, 
+                args=(self.write, (keep_rows, partitions))),
+        ]
+        for thread in stages:
+            thread.daemon = True
+            thread.start()
+        for thread in stages:
+            thread.join()
+
+        report.vcf_file.close()
+        if self.error is not None:
+            raise self.error
+
+        for q in (self.records, self.rows):
+            stats = q.stats()
+            self.logger.info(
+                'queue {}: max {}/{} batches, mean {:.1f}, producer waited '
+                '{} times, consumer waited {} times'.format(
+                q.name, stats['max'], stats['size'], stats['mean'],
+                stats['producer_waits'], stats['consumer_waits']))
+        self.logger.info('variant report completed in {:.3f}s - {}'.format(
+            time.time() - start, describe_path(report.report_path, 'w')))
+
+
+    def stage(self, function, argument):
+        """
+        Runs a stage, if it fails the other stages are stopped and the
+        error is raised again from run.
+        """
+        try:
+            function(argument)
+        except pipeline_stopped:
+            pass
+        except Exception as e:
+            self.logger.exception('pipeline stage failed')
+            self.error = e
+            self.stop.set()
+
+
+    def batches(self, items):
+        """Group an iterator into lists of batch_size items"""
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+    def iter_batches(self, q):
+        """Yield each item from the batches in a queue, until the end"""
+        while True:
+            batch = q.get()
+            if batch is END:
+                return
+            for item in batch:
+                yield item
+
+
+    def read(self, vcf_reader):
+        """Reader stage - read and decompress records"""
+        for batch in self.batches(vcf_reader):
+            self.records.put(batch)
+        self.records.put(END)
+
+
+    def transform(self, rows):
+        """Transform stage - make and annotate report rows"""
+        for batch in self.batches(rows):
+            self.rows.put(batch)
+        self.rows.put(END)
+
+
+    def write(self, options):
+        """Writer stage - write and compress the report"""
+        keep_rows, partitions = options
+        table = self.report.table
+        with open_text(self.report.report_path, 'w') as out:
+            writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+            writer.writerow(table.header)
+            for batch in iter(self.rows.get, END):
+                writer.writerows(row.values for row in batch)
+                if keep_rows:
+                    table.rows.extend(batch)
+                if partitions is not None:
+                    partitions.write_rows(batch)
+        if partitions is not None:
+            partitions.close()
@@ -1,4 +1,4 @@
-#!/anaconda3/envs/python2/bin/python
+#!/usr/bin/env python
 
 """
 preferred_transcripts.py
@@ -18,6 +18,22 @@ import csv
 import logging
 
 
+# order of VEP IMPACT values, most severe first
+IMPACT_ORDER = ('HIGH', 'MODERATE', 'LOW', 'MODIFIER')
+
+
+def preferred_set(transcripts, strictness):
+    """
+    Set of preferred transcripts to match against. High strictness 
+    means that transcripts must be exact match, low strictness means 
+    that transcripts can have different value after the . in refseq 
+    transcripts, so the version is removed.
+    """
+    if strictness == 'high':
+        return(set(transcripts))
+    return(set(record.split('.')[0] for record in transcripts))
+
+
 # -- PREFERRED TRANSCRIPTS CLASS --------------------------------------
 
 class preferred_transcripts:
@@ -52,18 +68,17 @@ class preferred_transcripts:
             self.list = None
 
 
-    def apply(self, report, strictness):
+    def find_columns(self, table, config):
         """
-        Take a variant report and loop through each row, change 
-        preferred transcript to true if there's a match, otherwise 
-        change to false.
+        Find the transcript and preferred column numbers in a report 
+        table, using the column names from the config if there is one.
+        Returns None if either can't be found.
         """
-        # set report path
-        report_path = report.report_path
-
         # set transcript and preferred ids
-        if report.config:
-            for record in report.config:
+        transcript_id = None
+        preferred_id = None
+        if config:
+            for record in config:
                 if record[0] == 'Feature':
                     if record[2] != '':
                         transcript_id = record[2]
@@ -78,84 +93,161 @@ class preferred_transcripts:
             transcript_id = 'Feature'
             preferred_id = 'Preferred'
 
+        # find the preferred and transcript column numbers
+        preferred_column = table.column(preferred_id)
+        transcript_column = table.column(transcript_id)
+
+        # if transcript column cant be found, the rest of the functions 
+        # can carry on as normal because the report hasnt been touched.
+        if transcript_column == None or preferred_column == None:
+            self.logger.warning(
+                '''Could not find transcripts/ preferred column in variant 
+                report file, continuing without adding preferred transcripts.'''
+            )
+            return(None)
+
+        return((transcript_column, preferred_column))
+
+
+    def annotate_rows(self, rows, columns, strictness):
+        """
+        Generator that takes report rows and yields them with the 
+        preferred column changed to true if there's a match, otherwise
+        false. columns is the pair of column numbers from find_columns.
+        """
+        transcript_column, preferred_column = columns
+        preferred = preferred_set(self.list, strictness)
+
+        for row in rows:
+            transcript = row.values[transcript_column]
+            if transcript != 'No VEP output':
+                if strictness != 'high':
+                    transcript = transcript.split('.')[0]
+                if transcript in preferred:
+                    row.values[preferred_column] = 'True'
+                else:
+                    row.values[preferred_column] = 'False'
+            yield row
+
+
+    def apply(self, report, strictness):
+        """
+        Take a variant report and loop through each row, change 
+        preferred transcript to true if there's a match, otherwise 
+        change to false.
+        """
         if self.list:
-            # open report file and new temp file to save output
-            report_temp = os.path.join(report_path + '.temp')
-            f1 = open(report_path, 'rb')
-            reader = csv.reader(f1, delimiter='\t')
-            f2 = open(report_temp, 'wb')
-            writer = csv.writer(f2, delimiter='\t')
-
-            # add header to new file
-            header = next(reader)
-            writer.writerow(header)
-
-            # find the preferred and transcript column numbers
-            preferred_column = None
-            transcript_column = None
-            preferred_column = header.index(preferred_id)
-            transcript_column = header.index(transcript_id)
-
-            # if transcript column cant be found, exit the script and tidy up.
-            # The rest of the functions can carry on as normal because the 
-            # original variant report hasnt been touched.
-            if transcript_column == None or preferred_column == None:
-                self.logger.warn(
-                    '''Could not find transcripts/ preferred column in variant 
-                    report file, continuing without adding preferred transcripts.'''
-                )
-                f1.close()
-                f2.close()
-                os.remove(report_temp)
+            columns = self.find_columns(report.table, report.config)
+            if columns is None:
                 return
 
-            # loop though the report, change preferred to true if there
-            # is a match, false if there is not
-            # high strictness means that transcripts must be exact match
-            if strictness == 'high':
-                for row in reader:
-                    if row[transcript_column] == 'No VEP output':
-                        writer.writerow(row)
-                    elif row[transcript_column] in self.list:
-                        writer.writerow(row[0:preferred_column] + ['True'] + 
-                        row[preferred_column+1:])
-                    else:
-                        writer.writerow(row[0:preferred_column] + ['False'] + 
-                        row[preferred_column+1:])
-
-            # low strictness means that transcripts can have different 
-            # value after the . in refseq transcripts
-            if strictness == 'low':
-                for row in reader:
-                    if row[transcript_column] == 'No VEP output':
-                        writer.writerow(row)
-                    else:
-                        match = False
-                        try:
-                            trimmed = row[transcript_column].split('.')[0]
-                        except:
-                            trimmed = row[transcript_column]
-                        for record in self.list:
-                            trimmed_pt = record.split('.')[0]
-                            if trimmed_pt == trimmed:
-                                match = True
-                        if match == True:
-                            writer.writerow(row[0:preferred_column] + ['True'] + 
-                            row[preferred_column+1:])
-                        else:
-                            writer.writerow(row[0:preferred_column] + ['False'] + 
-                            row[preferred_column+1:])
-
-            # tidy up
+            for row in self.annotate_rows(report.table.rows, columns, strictness):
+                pass
             self.logger.info('preferred transcripts applied')
-            f1.close()
-            f2.close()
-            os.remove(report_path)
-            os.rename(report_temp, report_path)
         
         # if error, skip adding preferred transcripts
         else:
-            self.logger.warn(
+            self.logger.warning(
                 'could not load preferred transcripts file provided, skipping step.'
             )
             return
+
+
+# -- TRANSCRIPT CHOOSER CLASS -----------------------------------------
+
+class transcript_chooser:
+    def __init__(self, report, transcripts=None, strictness='low'):
+        """
+        Object properties that are loaded when the oject is created.
+        Chooses the CSQ entries of each variant that are included in
+        the report when only the preferred transcript is wanted. report
+        is a vcf_report with its header read, transcripts is the list of
+        preferred transcripts (preferred_transcripts.list), if any.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.pt')
+        self.transcripts = transcripts
+        self.strictness = strictness
+        self.preferred = preferred_set(transcripts or [], strictness)
+
+        # positions of the VEP fields used to pick the best transcript,
+        # None if the VCF doesn't have the field
+        def position(*names):
+            for name in names:
+                if name in report.vep_fields:
+                    return(report.vep_fields.index(name))
+            return(None)
+        self.feature = position('Feature')
+        self.pick = position('PICK')
+        self.mane = position('MANE_SELECT', 'MANE')
+        self.canonical = position('CANONICAL')
+        self.impact = position('IMPACT')
+
+        self.variants_preferred = 0
+        self.variants_best = 0
+        self.transcripts_removed = 0
+
+
+    def rank(self, n, vep_split):
+        """
+        Sort key of a transcript, lowest is best: picked by VEP, then
+        MANE Select, then canonical, then most severe IMPACT, then the 
+        first in the CSQ field
+        """
+        def value(pos):
+            if pos is None or pos >= len(vep_split):
+                return('')
+            return(vep_split[pos])
+
+        impact = value(self.impact)
+        return((
+            value(self.pick) != '1',
+            value(self.mane) == '',
+            value(self.canonical) != 'YES',
+            IMPACT_ORDER.index(impact) if impact in IMPACT_ORDER 
+                else len(IMPACT_ORDER),
+            n
+        ))
+
+
+    def choose(self, entries):
+        """
+        Returns the CSQ entries (shared_entry objects) of a variant to
+        include in the report: the preferred transcripts, or the single
+        best transcript if none are preferred. Only NM transcripts are 
+        included in the report, so the others are left out first.
+        """
+        if self.feature is None:
+            return(entries)
+        transcripts = []
+        for n, entry in enumerate(entries):
+            vep_split = entry.split()
+            if vep_split[self.feature].startswith('NM'):
+                transcripts.append((n, entry, vep_split))
+        if not transcripts:
+            return([])
+
+        preferred = []
+        for n, entry, vep_split in transcripts:
+            transcript = vep_split[self.feature]
+            if self.strictness != 'high':
+                transcript = transcript.split('.')[0]
+            if transcript in self.preferred:
+                preferred.append(entry)
+        if preferred:
+            self.variants_preferred += 1
+            self.transcripts_removed += len(transcripts) - len(preferred)
+            return(preferred)
+
+        best = min(transcripts, key=lambda t: self.rank(t[0], t[2]))
+        self.variants_best += 1
+        self.transcripts_removed += len(transcripts) - 1
+        return([best[1]])
+
+
+    def log_counts(self):
+        self.logger.info('kept the preferred transcript of {} variants and '
+            'the best transcript of {}, {} transcripts removed'.format(
+            self.variants_preferred, self.variants_best, 
+            self.transcripts_removed))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+record_cache.py
+
+Saves the decoded records of a VCF to a cache file next to the VCF, so
+that later runs on the same VCF (e.g. with a different config or BED
+files) can load the records without parsing the VCF again. The cache is
+JSON lines, so reading it never runs code from the file. It records the
+size, modification time, inode and SHA-1 hash of the VCF. If the size,
+modification time and inode all match, the cache is used without
+reading the VCF, the hash is only checked when the size matches but
+the file has been touched or copied.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+
+from scripts.vcf_backends import plain_reader, plain_record, header_field
+
+
+# changed if the format of the cache file changes, older files are ignored
+CACHE_VERSION = 2
+
+# added to the VCF filepath to make the cache filepath
+CACHE_SUFFIX = '.records.cache'
+
+
+def file_state(path):
+    """Size, modification time in ns and inode of a file"""
+    stat = os.stat(path)
+    mtime = getattr(stat, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(stat.st_mtime * 1e9)
+    return([stat.st_size, mtime, stat.st_ino])
+
+
+def file_sha1(path):
+    """SHA-1 hash of a file"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return(sha1.hexdigest())
+
+
+def native(value):
+    """
+    Strings are read from JSON as unicode on Python 2, they are made
+    str again so records are the same as those read from the VCF
+    """
+    if isinstance(value, list):
+        return([native(each) for each in value])
+    if isinstance(value, dict):
+        return(dict((native(key), native(each)) 
+            for key, each in value.items()))
+    if isinstance(value, type(u'')) and not isinstance(value, str):
+        return(value.encode('utf-8'))
+    return(value)
+
+
+def load_json(line):
+    """Decode a line of the cache"""
+    if sys.version_info[0] >= 3:
+        return(json.loads(line))
+    return(native(json.loads(line)))
+
+
+# -- RECORD CACHE CLASS -----------------------------------------------
+
+class record_cache:
+    def __init__(self, vcf_path):
+        """
+        Object properties that are loaded when the oject is created.
+        vcf_path is the VCF the records are read from, the cache is
+        saved next to it.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.records')
+        self.vcf_path = os.path.abspath(vcf_path)
+        self.path = self.vcf_path + CACHE_SUFFIX
+        self.state = None
+        self.sha1 = None
+
+
+    def matches(self, saved):
+        """
+        True if the VCF is the one the saved cache was made from. The
+        VCF is only hashed if its size matches but the modification
+        time or inode don't.
+        """
+        self.state = file_state(self.vcf_path)
+        if saved.get('state') == self.state:
+            self.sha1 = saved.get('sha1')
+            return(True)
+        if saved.get('state', [None])[0] != self.state[0]:
+            return(False)
+        self.sha1 = file_sha1(self.vcf_path)
+        return(saved.get('sha1') == self.sha1)
+
+
+    def load(self):
+        """
+        Returns the cached (header, records) for the VCF, or None if
+        there isn't a cache or the VCF has changed since it was made.
+        header has samples, infos and formats attributes like a reader.
+        """
+        if not os.path.exists(self.path):
+            return(None)
+        try:
+            with open(self.path) as f:
+                saved = load_json(f.readline())
+                if saved.get('version') != CACHE_VERSION or \
+                        not self.matches(saved):
+                    self.logger.info('VCF has changed since the record '
+                        'cache was made -- parsing VCF again')
+                    return(None)
+                samples, infos, formats = load_json(f.readline())
+                header = plain_reader(samples,
+                    OrderedDict((each[0], header_field(each[1:])) 
+                        for each in infos),
+                    OrderedDict((each[0], header_field(each[1:])) 
+                        for each in formats))
+                records = [plain_record.from_state(load_json(line)) 
+                           for line in f]
+        except Exception:
+            self.logger.warning('could not read record cache {} -- '
+                'parsing VCF again'.format(self.path))
+            return(None)
+
+        self.logger.info('loaded {} records from record cache {}'.format(
+            len(records), self.path))
+        return(header, records)
+
+
+    def save(self, reader, records):
+        """
+        Save the header from reader and the records to the cache, one
+        JSON line each. Records from any backend are saved as plain
+        records. If the cache can't be written, a warning is logged and
+        the run carries on.
+        """
+        if self.state is None:
+            self.state = file_state(self.vcf_path)
+        if self.sha1 is None:
+            self.sha1 = file_sha1(self.vcf_path)
+        header = plain_reader.from_reader(reader)
+
+        # written under a temporary name and renamed, so a failed save
+        # never leaves a half written cache
+        try:
+            fd, temp = tempfile.mkstemp(
+                dir=os.path.dirname(self.path), suffix='.temp')
+        except (IOError, OSError):
+            self.logger.warning('could not write record cache {}'.format(
+                self.path))
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps({'version': CACHE_VERSION, 
+                    'state': self.state, 'sha1': self.sha1}) + '\n')
+                f.write(json.dumps([header.samples,
+                    [[name] + list(info) for name, info in header.infos.items()],
+                    [[name] + list(fmt) for name, fmt in header.formats.items()]
+                ]) + '\n')
+                for record in records:
+                    f.write(json.dumps(
+                        plain_record.from_record(record).__getstate__()) + '\n')
+            os.rename(temp, self.path)
+        except Exception:
+            os.remove(temp)
+            raise
+        self.logger.info('saved {} records to record cache {}'.format(
+            len(records), self.path))
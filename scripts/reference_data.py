@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+reference_data.py
+
+Object that loads and holds the reference data used to annotate a
+variant report (config, preferred transcripts and known variants), so
+that it can be reused between runs in long-running modes.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import logging
+import threading
+
+from scripts.vcf_report import vcf_report
+from scripts.preferred_transcripts import preferred_transcripts
+from scripts.known_variants import known_variants
+from scripts.annotation_cache import annotation_cache
+from scripts.bed_index import bed_index_cache, numpy
+
+
+# -- REFERENCE DATA CLASS ---------------------------------------------
+
+class reference_data:
+    def __init__(self):
+        """
+        Object properties that are loaded when the oject is created.
+        Loaded reference files are kept in a dictionary keyed by the
+        type of reference, the file path and the modification time, so
+        a file is only reloaded if it has changed on disk. Annotation
+        caches are kept by file path, as they are saved after each run,
+        and BED index caches by folder. The daemon's worker threads share
+        this object: the loaded references are only read by a run, and
+        the annotation and BED index caches lock their own entries.
+        """
+        self.logger = logging.getLogger('vcf_parse.ref')
+        self.cache = {}
+        self.annotation_caches = {}
+        self.bed_caches = {}
+        self.lock = threading.Lock()
+
+
+    def get(self, kind, path, loader):
+        """
+        Return the loaded reference of a given type from the cache,
+        calling the loader function to load it if it isn't there yet.
+        """
+        path = os.path.abspath(path)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        key = (kind, path)
+
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] == mtime:
+                return(cached[1])
+
+            loaded = loader(path)
+            self.cache[key] = (mtime, loaded)
+            return(loaded)
+
+
+    def config(self, path):
+        """Load a report config file, returns the config list"""
+        def load(path):
+            report = vcf_report()
+            report.load_config(path)
+            return(report.config)
+        return(self.get('config', path, load))
+
+
+    def transcripts(self, path):
+        """Load a preferred transcripts file, returns the loaded object"""
+        def load(path):
+            pt = preferred_transcripts()
+            pt.load(path)
+            return(pt)
+        return(self.get('transcripts', path, load))
+
+
+    def known_variants(self, path, backend='pyvcf'):
+        """
+        Load a known variants VCF, returns the loaded object. All 
+        backends load the same data, so it is cached whichever was used.
+        """
+        def load(path):
+            known = known_variants()
+            known.load_known_variants(path, backend)
+            return(known)
+        return(self.get('known', path, load))
+
+
+    def bed_index_cache(self, folder):
+        """
+        Returns the cache of compiled BED indexes in a folder. The same
+        object is used for every run, so loaded indexes are reused. If
+        numpy isn't installed, a warning is logged and None is returned
+        so that bedtools is used.
+        """
+        if numpy is None:
+            self.logger.warning('numpy is not installed -- using bedtools '
+                'to apply BED files')
+            return(None)
+        folder = os.path.abspath(folder)
+        with self.lock:
+            cache = self.bed_caches.get(folder)
+            if cache is None:
+                cache = bed_index_cache(folder)
+                self.bed_caches[folder] = cache
+            return(cache)
+
+
+    def annotation_cache(self, path, max_entries):
+        """
+        Load an annotation cache, returns the loaded object. The same 
+        object is used for every run, the file is only read the first
+        time.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            cache = self.annotation_caches.get(path)
+            if cache is None:
+                cache = annotation_cache(path, max_entries)
+                cache.load()
+                self.annotation_caches[path] = cache
+        cache.resize(max_entries)
+        return(cache)
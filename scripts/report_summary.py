@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+"""
+report_summary.py
+
+Object that collects summary statistics for a variant report while the
+report is being made: the number of variants per gene, IMPACT and
+consequence, and histograms of depth (DP) and variant frequency (VF).
+The summary is saved as JSON next to the variant report, so QC doesn't
+need to read the whole report again.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import json
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# histogram bins - DP in steps of 10 up to 1000, VF in steps of 1%.
+# Values above the last bin are counted in the last bin
+DP_BINS = list(range(0, 1010, 10))
+VF_BINS = list(range(0, 101, 1))
+
+# number of values held before they are added to the histograms
+FLUSH_SIZE = 10000
+
+
+# -- HISTOGRAM CLASS --------------------------------------------------
+
+class histogram(object):
+    """
+    Counts of values in fixed bins, held in a numpy array. Values are
+    buffered and added to the counts in blocks, so each value only costs
+    a list append.
+    """
+    def __init__(self, bins):
+        self.edges = numpy.array(bins, dtype=float)
+        self.counts = numpy.zeros(len(bins) - 1, dtype=numpy.int64)
+        self.buffer = []
+        self.total = 0.0
+        self.n = 0
+
+
+    def add(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= FLUSH_SIZE:
+            self.flush()
+
+
+    def flush(self):
+        if not self.buffer:
+            return
+        values = numpy.array(self.buffer, dtype=float)
+        self.buffer = []
+        self.total += values.sum()
+        self.n += len(values)
+
+        # values above the last edge go in the last bin
+        values = numpy.clip(values, self.edges[0], self.edges[-1])
+        counts, edges = numpy.histogram(values, bins=self.edges)
+        self.counts += counts
+
+
+    def to_state(self):
+        """Counts as plain values, see merge_state"""
+        self.flush()
+        return({
+            'counts': [int(count) for count in self.counts],
+            'total': float(self.total),
+            'n': self.n,
+        })
+
+
+    def merge_state(self, state):
+        """Add the counts of another histogram with the same bins"""
+        self.flush()
+        self.counts += numpy.array(state['counts'], dtype=numpy.int64)
+        self.total += state['total']
+        self.n += state['n']
+
+
+    def to_dict(self):
+        self.flush()
+        return({
+            'bins': [format_number(edge) for edge in self.edges],
+            'counts': [int(count) for count in self.counts],
+            'n': self.n,
+            'mean': round(self.total / self.n, 4) if self.n else None,
+        })
+
+
+def format_number(value):
+    """Whole numbers as ints, so the JSON doesn't show 10.0"""
+    if value == int(value):
+        return(int(value))
+    return(value)
+
+
+# -- SUMMARY CLASS ----------------------------------------------------
+
+class report_summary:
+    def __init__(self, report):
+        """
+        Object properties that are loaded when the oject is created.
+        report is a vcf_report with its header read, the positions of
+        the VEP fields are taken from it.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        if numpy is None:
+            raise ImportError('numpy is needed to make a report summary')
+
+        self.logger = logging.getLogger('vcf_parse.summary')
+        self.sample = report.sample
+        self.vep_columns = {}
+        for field in ('SYMBOL', 'IMPACT', 'Consequence'):
+            if field in report.vep_fields:
+                self.vep_columns[field] = report.vep_fields.index(field)
+
+        self.variants = 0
+        self.no_vep = 0
+        self.genes = {}
+        self.impacts = {}
+        self.consequences = {}
+        self.dp = histogram(DP_BINS)
+        self.vf = histogram(VF_BINS)
+
+
+    def add_variant(self, variant, transcripts):
+        """
+        Add a variant to the summary. transcripts is the list of CSQ 
+        entries included in the report for the variant. A variant is
+        counted once for each gene, IMPACT and consequence it has.
+        """
+        transcripts = [entry.split('|') for entry in transcripts]
+        self.variants += 1
+        if not transcripts:
+            self.no_vep += 1
+
+        self.count(self.genes, 'SYMBOL', transcripts)
+        self.count(self.impacts, 'IMPACT', transcripts)
+        self.count(self.consequences, 'Consequence', transcripts, split='&')
+
+        dp, vf = self.depth_and_frequency(variant)
+        if dp is not None:
+            self.dp.add(dp)
+        if vf is not None:
+            self.vf.add(vf)
+
+
+    def count(self, counts, field, transcripts, split=None):
+        pos = self.vep_columns.get(field)
+        if pos is None:
+            return
+        values = set()
+        for vep in transcripts:
+            try:
+                value = vep[pos]
+            except IndexError:
+                continue
+            if split:
+                values.update(value.split(split))
+            else:
+                values.add(value)
+        values.discard('')
+        for value in values:
+            counts[value] = counts.get(value, 0) + 1
+
+
+    def depth_and_frequency(self, variant):
+        """
+        Depth from the INFO DP field, or the sample DP if there isn't
+        one. Variant frequency (%) is worked out from the sample AD in
+        the same way as the Frequency column.
+        """
+        dp = None
+        vf = None
+        try:
+            dp = float(variant.INFO['DP'])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        for sample in variant:
+            if sample.sample != self.sample:
+                continue
+            if dp is None:
+                try:
+                    dp = float(sample['DP'])
+                except (AttributeError, TypeError, ValueError):
+                    pass
+            try:
+                ad = sample['AD']
+                ref = float(ad[0])
+                alt = float(ad[1])
+                vf = (alt / (ref + alt)) * 100
+            except (AttributeError, TypeError, ValueError,
+                    IndexError, ZeroDivisionError):
+                pass
+        return(dp, vf)
+
+
+    def merge(self, other):
+        """
+        Add the counts of a summary made from other records of the same
+        VCF, e.g. by a worker process (see parallel_parse.py)
+        """
+        self.merge_state(other.to_state())
+
+
+    def to_state(self):
+        """
+        Counts of the summary as plain values, which can be saved as 
+        JSON and added to another summary with merge_state (see 
+        shards.py)
+        """
+        return({
+            'variants': self.variants,
+            'no_vep': self.no_vep,
+            'genes': self.genes,
+            'impacts': self.impacts,
+            'consequences': self.consequences,
+            'DP': self.dp.to_state(),
+            'VF': self.vf.to_state(),
+        })
+
+
+    def merge_state(self, state):
+        """Add the counts from to_state of another summary"""
+        self.variants += state['variants']
+        self.no_vep += state['no_vep']
+        for counts, others in ((self.genes, state['genes']), 
+                (self.impacts, state['impacts']),
+                (self.consequences, state['consequences'])):
+            for value, count in others.items():
+                counts[value] = counts.get(value, 0) + count
+        self.dp.merge_state(state['DP'])
+        self.vf.merge_state(state['VF'])
+
+
+    def __getstate__(self):
+        # loggers can't be pickled in python 2
+        state = self.__dict__.copy()
+        del state['logger']
+        return(state)
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger('vcf_parse.summary')
+
+
+    def to_dict(self):
+        return({
+            'sample': self.sample,
+            'variants': self.variants,
+            'variants_without_vep': self.no_vep,
+            'genes': self.genes,
+            'impacts': self.impacts,
+            'consequences': self.consequences,
+            'DP': self.dp.to_dict(),
+            'VF': self.vf.to_dict(),
+        })
+
+
+    def write(self, output_dir):
+        """
+        Save the summary as JSON in the output folder, next to the 
+        variant report, named <sample>_VariantSummary.json. Returns the
+        filepath.
+        """
+        path = os.path.join(output_dir, self.sample + '_VariantSummary.json')
+        with open(path, 'w') as out:
+            json.dump(self.to_dict(), out, sort_keys=True)
+            out.write('\n')
+        self.logger.info('variant summary completed - {}'.format(path))
+        return(path)
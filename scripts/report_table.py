@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+report_table.py
+
+Objects that hold a variant report in memory, so that each stage of
+vcf_parse.py can work on the same report without writing it to disk
+and reading it back in.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import csv
+
+from scripts.file_utils import open_text
+
+
+def value_text(value):
+    """
+    Text of a report value as the csv writer writes it, so values of
+    different types can be compared
+    """
+    if value is None:
+        return('')
+    return(str(value))
+
+
+# -- REPORT ROW CLASS -------------------------------------------------
+
+class report_row(object):
+    """
+    A single row of the variant report. The variant coordinates are
+    kept as typed fields so that later stages don't need to parse them
+    back out of the variant name. values holds the value of every
+    column in the report, starting with SampleID and Variant. VEP 
+    columns and reformatted fields (e.g. genotype) are text, other INFO
+    and FORMAT columns keep the values decoded from the VCF (ints, 
+    floats, lists or None), which the csv writer turns into text when
+    the report is saved. report_table.text gives the text of a column.
+    """
+    __slots__ = ('chrom', 'pos', 'ref', 'alt', 'values')
+
+    def __init__(self, chrom, pos, ref, alt, values):
+        self.chrom = chrom
+        self.pos = pos
+        self.ref = ref
+        self.alt = alt
+        self.values = values
+
+
+    @property
+    def variant(self):
+        return(self.values[1])
+
+
+# -- REPORT TABLE CLASS -----------------------------------------------
+
+class report_table:
+    def __init__(self, header):
+        """
+        Object properties that are loaded when the oject is created.
+        Column positions are worked out once from the header, where a
+        column name appears more than once the first is used.
+        """
+        self.header = list(header)
+        self.rows = []
+        self.index_columns()
+
+
+    def index_columns(self):
+        self.columns = {}
+        for i, name in enumerate(self.header):
+            self.columns.setdefault(name, i)
+
+
+    def column(self, name):
+        """Position of a column in the report, None if it isn't there"""
+        return(self.columns.get(name))
+
+
+    def add_column(self, name):
+        """Add an empty column to the end of the report, returns its position"""
+        self.header.append(name)
+        self.index_columns()
+        return(len(self.header) - 1)
+
+
+    def value(self, row, name):
+        """Value of a named column in a row, None if it isn't there"""
+        i = self.columns.get(name)
+        if i is None or i >= len(row.values):
+            return(None)
+        return(row.values[i])
+
+
+    def text(self, row, name):
+        """
+        Text of a named column in a row as it is written to the report, 
+        None if it isn't there
+        """
+        i = self.columns.get(name)
+        if i is None or i >= len(row.values):
+            return(None)
+        return(value_text(row.values[i]))
+
+
+    def take_rows(self):
+        """
+        Generator that takes the rows out of the table as they are read,
+        so each row can be freed once whatever reads it is done with it
+        """
+        rows = self.rows
+        self.rows = []
+        rows.reverse()
+        while rows:
+            yield rows.pop()
+
+
+    def write(self, path, rows=None):
+        """
+        Write the header and rows to a tab seperated file, compressed if
+        the path ends in .gz. If rows is given, only those rows are 
+        written.
+        """
+        if rows is None:
+            rows = self.rows
+        with open_text(path, 'w') as out:
+            writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+            writer.writerow(self.header)
+            for row in rows:
+                writer.writerow(row.values)
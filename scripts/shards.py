@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+
+"""
+shards.py
+
+Spreads the variant report of one very large uncompressed VCF across
+several machines, e.g. as the tasks of a cluster array job. A plan step
+splits the records into shards, one per contig or of about the same
+size, and saves them in a JSON manifest along with the report options.
+Each shard is then made as a normal report of only its own records,
+into its own folder, and a merge step joins the shard reports (and any
+BED file reports) into the same files that a single run would make,
+with the summary and metrics of all the shards added up.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import copy
+import gzip
+import json
+import time
+import logging
+
+from scripts.parallel_parse import can_map, map_file, header_end, \
+    chunk_ranges, decode
+from scripts.report_summary import report_summary
+from scripts.vcf_report import vcf_report
+from scripts.file_utils import open_text
+
+
+# steps of a sharded run
+SHARD_STEPS = ('plan', 'run', 'merge')
+
+# ways the records can be split into shards
+SHARD_BY = ('contig', 'size')
+
+# report options saved in the manifest and used for every shard
+SHARD_OPTIONS = (
+    'transcripts', 'transcript_strictness', 'bed', 'bed_folder',
+    'known_variants', 'config', 'filter_non_pass', 'summary', 'backend',
+    'annotation_cache', 'engine', 'filter', 'gzip_output', 'bed_cache',
+    'preferred_only'
+)
+
+# options that are filepaths, saved as absolute paths so shards can be
+# run from any folder
+PATH_OPTIONS = ('transcripts', 'bed', 'bed_folder', 'known_variants',
+    'config', 'annotation_cache', 'bed_cache')
+
+# changed if the format of the manifest changes
+MANIFEST_VERSION = 1
+
+# name of the metrics file saved in each shard folder, it is saved last
+# so also shows that the shard is finished
+METRICS_FILE = 'shard_metrics.json'
+
+
+def line_start(data, pos, start):
+    """Offset of the first line starting at or after pos"""
+    if pos <= start:
+        return(start)
+    end = data.find(b'\n', pos - 1)
+    return(len(data) if end == -1 else end + 1)
+
+
+def line_contig(data, pos):
+    """Contig of the record line starting at pos"""
+    line_end = data.find(b'\n', pos)
+    if line_end == -1:
+        line_end = len(data)
+    end = data.find(b'\t', pos, line_end)
+    if end == -1:
+        end = line_end
+    return(decode(data[pos:end]))
+
+
+def contig_ranges(data, start):
+    """
+    Split the records from start to the end of the file into a byte
+    range for each contig. The records of each contig must be next to
+    each other, as in a sorted VCF. The end of each contig is found by
+    searching with steps that double and then halve, so only a few
+    lines of each contig are read.
+    """
+    size = len(data)
+    ranges = []
+    pos = start
+    while pos < size:
+        contig = line_contig(data, pos)
+
+        # lo is a line of this contig, hi the start of a later contig
+        lo = pos
+        step = 64 * 1024
+        while True:
+            hi = line_start(data, lo + step, start)
+            if hi >= size or line_contig(data, hi) != contig:
+                break
+            lo = hi
+            step *= 2
+
+        while True:
+            after = line_start(data, lo + 1, start)
+            if after >= hi:
+                break
+            mid = line_start(data, (lo + hi) // 2, start)
+            if mid <= lo or mid >= hi:
+                mid = after
+            if line_contig(data, mid) == contig:
+                lo = mid
+            else:
+                hi = mid
+
+        ranges.append((pos, hi, [contig]))
+        pos = hi
+    return(ranges)
+
+
+def size_ranges(data, start, shard_size):
+    """
+    Split the records into byte ranges of about shard_size bytes,
+    with the first and last contig of each
+    """
+    chunks = max(1, -(-(len(data) - start) // shard_size))
+    ranges = []
+    for begin, end in chunk_ranges(data, start, chunks):
+        last = max(begin, data.rfind(b'\n', begin, end - 1) + 1)
+        contigs = [line_contig(data, begin)]
+        if line_contig(data, last) != contigs[0]:
+            contigs.append(line_contig(data, last))
+        ranges.append((begin, end, contigs))
+    return(ranges)
+
+
+def absolute_path(path):
+    """
+    Absolute filepath, keeping a trailing / as the name of the BED file
+    folder is taken from the path before it
+    """
+    out = os.path.abspath(path)
+    if path.endswith(('/', os.sep)):
+        out += os.sep
+    return(out)
+
+
+def file_state(path):
+    """Size and modification time of a file"""
+    stat = os.stat(path)
+    return({'size': stat.st_size, 'mtime': stat.st_mtime})
+
+
+def report_files(folder):
+    """
+    Variant report files (the main report and BED file reports) in a
+    shard folder, as paths relative to the folder
+    """
+    out = []
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if name.endswith(('_VariantReport.txt', '_VariantReport.txt.gz')):
+                out.append(os.path.relpath(os.path.join(root, name), folder))
+    return(sorted(out))
+
+
+def open_binary(path, mode):
+    """Open a report as bytes, with gzip if it ends in .gz"""
+    if path.endswith('.gz'):
+        return(gzip.open(path, mode + 'b'))
+    return(open(path, mode + 'b'))
+
+
+def shard_options(args):
+    """
+    Report options of the arguments that are used for every shard, 
+    with filepaths made absolute
+    """
+    options = {}
+    for option in SHARD_OPTIONS:
+        value = getattr(args, option)
+        if option in PATH_OPTIONS and value:
+            if isinstance(value, list):
+                value = [absolute_path(each) for each in value]
+            else:
+                value = absolute_path(value)
+        options[option] = value
+    return(options)
+
+
+def range_args(args, options, path, folder, byte_range):
+    """
+    Arguments to make the reports of a byte range of a VCF into folder,
+    with the report options given. Options are set in the same way as 
+    for a daemon job.
+    """
+    args = copy.copy(args)
+    for option, value in options.items():
+        setattr(args, option, value)
+    args.input = path
+    args.output = folder
+    args.byte_range = byte_range
+    args.shard = None
+    args.config_list = False
+    args.record_cache = False
+    args.processes = 1
+    for option in ('pipeline', 'stdout', 'dedup'):
+        setattr(args, option, False)
+    args.sort_by = None
+    args.partition_by = None
+    return(args)
+
+
+# -- SHARD RUNNER CLASS -----------------------------------------------
+
+class shard_runner:
+    def __init__(self, args, run, references):
+        """
+        Object properties that are loaded when the oject is created.
+        args are the command line arguments, run is the function that
+        makes a single report and references is the reference_data
+        object.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.shards')
+        self.args = args
+        self.run = run
+        self.references = references
+        self.manifest_path = args.manifest
+        if self.manifest_path is None and args.shard == 'plan':
+            self.manifest_path = os.path.join(
+                os.path.abspath(args.output or '.'), 'shard_manifest.json')
+        if self.manifest_path is None:
+            raise ValueError('--manifest is needed to run or merge shards')
+
+
+    def plan(self):
+        """
+        Split the input VCF into shards and save the manifest. Returns
+        the manifest.
+        """
+        args = self.args
+        if not can_map(args.input):
+            raise ValueError('only uncompressed VCF files can be split into '
+                'shards - {}'.format(args.input))
+        if args.pipeline or args.stdout or args.sort_by or args.dedup or \
+                args.partition_by or args.processes > 1:
+            raise ValueError('shards cannot be made with --pipeline, '
+                '--stdout, --sort_by, --dedup, --partition_by or --processes')
+
+        path = os.path.abspath(args.input)
+        with open(path, 'rb') as vcf_file:
+            data = map_file(vcf_file)
+            try:
+                start = header_end(data)
+                if args.shard_by == 'size':
+                    ranges = size_ranges(data, start,
+                        max(1, int(args.shard_size * 1024 * 1024)))
+                else:
+                    ranges = contig_ranges(data, start)
+            finally:
+                data.close()
+
+        # a VCF with no records still has one empty shard, so the reports
+        # are made with their headers
+        if not ranges:
+            ranges = [(start, start, [])]
+
+        options = shard_options(args)
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'input': path,
+            'input_state': file_state(path),
+            'output': os.path.abspath(args.output or '.'),
+            'shard_by': args.shard_by,
+            'options': options,
+            'shards': [{'index': n, 'start': begin, 'end': end,
+                        'bytes': end - begin, 'contigs': contigs}
+                       for n, (begin, end, contigs) in enumerate(ranges)],
+        }
+        folder = os.path.dirname(os.path.abspath(self.manifest_path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(self.manifest_path, 'w') as out:
+            json.dump(manifest, out, indent=1, sort_keys=True)
+            out.write('\n')
+        self.logger.info('planned {} shards of {} by {} - {}'.format(
+            len(ranges), path, args.shard_by, self.manifest_path))
+        return(manifest)
+
+
+    def load_manifest(self):
+        """Load the manifest and check the VCF hasn't changed since"""
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError('shard manifest {} was made by another version '
+                'of vcf_parse'.format(self.manifest_path))
+        if file_state(manifest['input']) != manifest['input_state']:
+            raise ValueError('{} has changed since the shards were planned'
+                .format(manifest['input']))
+        return(manifest)
+
+
+    def shard_folder(self, manifest, index):
+        """Folder that the reports of a shard are saved in"""
+        return(os.path.join(manifest['output'], 'shards',
+            'shard_{}'.format(index)))
+
+
+    def run_shard(self, index):
+        """
+        Make the reports of one shard, with the options in the manifest,
+        and save its metrics. Returns the report.
+        """
+        manifest = self.load_manifest()
+        shards = manifest['shards']
+        if not 0 <= index < len(shards):
+            raise ValueError('no shard {} - the manifest has {} shards '
+                '(0 to {})'.format(index, len(shards), len(shards) - 1))
+        shard = shards[index]
+        folder = self.shard_folder(manifest, index)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        args = range_args(self.args, manifest['options'], manifest['input'],
+            folder, (shard['start'], shard['end']))
+        self.logger.info('running shard {} of {} - {}'.format(
+            index, len(shards), ', '.join(shard['contigs'])))
+        started = time.time()
+        report = self.run(args, self.references)
+
+        metrics = {
+            'index': index,
+            'records': len(report.data),
+            'rows': len(report.table.rows),
+            'seconds': round(time.time() - started, 3),
+            'variants_filtered': None,
+            'transcripts_filtered': None,
+            'summary': None,
+        }
+        if report.filter is not None:
+            metrics['variants_filtered'] = report.filter.variants_removed
+            metrics['transcripts_filtered'] = report.filter.transcripts_removed
+        if report.summary is not None:
+            metrics['summary'] = report.summary.to_state()
+        with open(os.path.join(folder, METRICS_FILE), 'w') as out:
+            json.dump(metrics, out, sort_keys=True)
+            out.write('\n')
+        self.logger.info('shard {} completed - {} records, {} rows'.format(
+            index, metrics['records'], metrics['rows']))
+        return(report)
+
+
+    def merge(self):
+        """
+        Join the reports of every shard into the output folder, in shard
+        order, and add up the summaries and metrics. Returns the paths
+        of the merged reports.
+        """
+        manifest = self.load_manifest()
+        folders = [self.shard_folder(manifest, shard['index'])
+                   for shard in manifest['shards']]
+        unfinished = [str(n) for n, folder in enumerate(folders)
+            if not os.path.exists(os.path.join(folder, METRICS_FILE))]
+        if unfinished:
+            raise ValueError('shards not finished - {}'.format(
+                ', '.join(unfinished)))
+
+        # every shard makes the same report files
+        names = report_files(folders[0])
+        for folder in folders[1:]:
+            if report_files(folder) != names:
+                raise ValueError('shard {} has different reports to shard '
+                    '0'.format(folder))
+        out_paths = []
+        for name in names:
+            out_paths.append(self.merge_report(
+                [os.path.join(folder, name) for folder in folders],
+                os.path.join(manifest['output'], name)))
+
+        metrics = []
+        for folder in folders:
+            with open(os.path.join(folder, METRICS_FILE)) as f:
+                metrics.append(json.load(f))
+        self.merge_metrics(manifest, metrics)
+        self.logger.info('merged {} reports from {} shards into {}'.format(
+            len(out_paths), len(folders), manifest['output']))
+        return(out_paths)
+
+
+    def merge_report(self, paths, out_path):
+        """
+        Join the reports of each shard, keeping the header of the first.
+        Lines are copied as they are, so the report is the same as from
+        a single run. A row identical to the last row of the shard 
+        before is skipped, as it would be in one pass over the records.
+        """
+        folder = os.path.dirname(out_path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        header = None
+        last = None
+        with open_binary(out_path, 'w') as out:
+            for path in paths:
+                with open_binary(path, 'r') as report:
+                    first = report.readline()
+                    if header is None:
+                        header = first
+                        out.write(first)
+                    elif first != header:
+                        raise ValueError('shard report {} has a different '
+                            'header'.format(path))
+                    for n, line in enumerate(report):
+                        if n == 0 and line == last:
+                            continue
+                        out.write(line)
+                        last = line
+        return(out_path)
+
+
+    def merge_metrics(self, manifest, metrics):
+        """
+        Add up the metrics of each shard and save them next to the
+        reports, along with the summary if one was made
+        """
+        output = manifest['output']
+        options = manifest['options']
+        total = {
+            'shards': len(metrics),
+            'records': sum(each['records'] for each in metrics),
+            'rows': sum(each['rows'] for each in metrics),
+            'seconds': round(sum(each['seconds'] for each in metrics), 3),
+            'slowest_shard_seconds': max(each['seconds'] for each in metrics),
+            'variants_filtered': None,
+            'transcripts_filtered': None,
+            'per_shard': [dict((key, value) for key, value in each.items()
+                if key != 'summary') for each in metrics],
+        }
+        if options.get('filter'):
+            for key in ('variants_filtered', 'transcripts_filtered'):
+                total[key] = sum(each[key] for each in metrics)
+            self.logger.info('filter "{}" removed {} variants and {} '
+                'transcripts'.format(options['filter'],
+                total['variants_filtered'], total['transcripts_filtered']))
+
+        # the summary is made with the header of the VCF, which has the
+        # sample name and the VEP fields
+        report = vcf_report()
+        with open_text(manifest['input'], 'r') as vcf_input:
+            report.read_header(vcf_input)
+        if options.get('summary'):
+            summary = report_summary(report)
+            for each in metrics:
+                summary.merge_state(each['summary'])
+            summary.write(output)
+
+        path = os.path.join(output, report.sample + '_ShardMetrics.json')
+        with open(path, 'w') as out:
+            json.dump(total, out, sort_keys=True)
+            out.write('\n')
+        self.logger.info('shard metrics completed - {}'.format(path))
+        return(total)
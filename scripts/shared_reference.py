@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+"""
+shared_reference.py
+
+Shares reference data between worker processes without each worker
+holding its own copy. The parent process writes a lookup table once, as
+numpy arrays in a folder in shared memory (/dev/shm where there is one,
+otherwise the temporary folder), and each worker maps the arrays read
+only, so every worker reads the same pages of memory however many there
+are. Keys are found with a binary search on a sorted array of 64-bit key
+hashes, and the keys and values are kept in byte arrays with an array of
+offsets, so the table is compact whatever the length of the keys. Known
+variants can be read straight from their VCF into the table, so the
+parent process doesn't keep a copy of its own. Folders are removed when
+the program exits, and folders left by programs that were killed are
+removed by the next run.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import json
+import errno
+import atexit
+import shutil
+import struct
+import hashlib
+import logging
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from scripts.known_variants import known_variants, read_known_variants
+
+
+# folder the shared tables are made in, /dev/shm is kept in memory
+SHARED_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') and \
+    os.access('/dev/shm', os.W_OK) else None
+
+# start of the name of each shared folder, followed by the process id of
+# the program that made it
+SHARED_PREFIX = 'vcf_parse_shared_'
+
+# arrays of each table, saved as <name>.<array>.npy
+TABLE_ARRAYS = ('hashes', 'key_offsets', 'keys', 'value_offsets', 'values')
+
+
+def key_hash(key):
+    """64-bit hash of a key, the same in every process"""
+    return(struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0])
+
+
+def encode(text):
+    if isinstance(text, bytes):
+        return(text)
+    return(text.encode('utf-8'))
+
+
+def decode(data):
+    if bytes is str:
+        return(data)
+    return(data.decode('utf-8'))
+
+
+def process_running(pid):
+    """True if a process with the id pid is running"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return(e.errno == errno.EPERM)
+    return(True)
+
+
+def remove_stale(root):
+    """
+    Remove the shared folders in root left by programs that are no
+    longer running, e.g. because they were killed
+    """
+    for name in os.listdir(root):
+        pid = name[len(SHARED_PREFIX):].split('_')[0]
+        if name.startswith(SHARED_PREFIX) and pid.isdigit() and \
+                not process_running(int(pid)):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def known_classifications(path, backend='pyvcf'):
+    """
+    Generator of the variant name and classifications of each known
+    variant in a VCF, joined as they are in the report. Variants are
+    taken out of the dictionary as they are given out, so it is gone by
+    the time the table is built from them.
+    """
+    classifications = {}
+    for name, classification in read_known_variants(path, backend):
+        classifications.setdefault(name, []).append(
+            '{}'.format(classification))
+    while classifications:
+        name, values = classifications.popitem()
+        yield (name, ','.join(values))
+
+
+def blob(items):
+    """Byte array of items joined together, and the offset of each"""
+    offsets = numpy.zeros(len(items) + 1, dtype=numpy.int64)
+    if items:
+        offsets[1:] = numpy.cumsum([len(item) for item in items])
+    data = numpy.frombuffer(b''.join(items) or b'\0', dtype=numpy.uint8)
+    return(offsets, data)
+
+
+# -- SHARED TABLE CLASS -----------------------------------------------
+
+class shared_table(object):
+    """
+    Read only table of text keys and values, mapped from the arrays
+    saved in a folder by shared_table.write
+    """
+    def __init__(self, folder, name):
+        self.folder = folder
+        self.name = name
+        with open(os.path.join(folder, name + '.json')) as f:
+            self.size = json.load(f)['size']
+        # empty arrays can't be mapped
+        mode = 'r' if self.size else None
+        for array in TABLE_ARRAYS:
+            setattr(self, array, numpy.load(os.path.join(folder,
+                '{}.{}.npy'.format(name, array)), mmap_mode=mode))
+
+
+    @classmethod
+    def write(cls, folder, name, mapping):
+        """
+        Save a dictionary, or (key, value) pairs, of text keys and values
+        as a table in folder. The info file is saved last, so a table is
+        only opened once it is complete.
+        """
+        if hasattr(mapping, 'items'):
+            mapping = mapping.items()
+        items = sorted((key_hash(encode(key)), encode(key), encode(value))
+                       for key, value in mapping)
+        hashes = numpy.array([item[0] for item in items], dtype=numpy.uint64)
+        key_offsets, keys = blob([item[1] for item in items])
+        value_offsets, values = blob([item[2] for item in items])
+        arrays = (hashes, key_offsets, keys, value_offsets, values)
+        for array, data in zip(TABLE_ARRAYS, arrays):
+            numpy.save(os.path.join(folder, '{}.{}.npy'.format(name, array)),
+                       data)
+        with open(os.path.join(folder, name + '.json'), 'w') as out:
+            json.dump({'size': len(items)}, out)
+        return(cls(folder, name))
+
+
+    def __len__(self):
+        return(self.size)
+
+
+    def item(self, array, offsets, n):
+        return(array[offsets[n]:offsets[n + 1]].tobytes())
+
+
+    def lookup(self, keys):
+        """List of the values of keys, None for keys not in the table"""
+        out = [None] * len(keys)
+        if not self.size or not keys:
+            return(out)
+        encoded = [encode(key) for key in keys]
+        hashes = numpy.array([key_hash(key) for key in encoded],
+                             dtype=numpy.uint64)
+        starts = numpy.searchsorted(self.hashes, hashes).tolist()
+        table_hashes = self.hashes
+        for i, (key, start) in enumerate(zip(encoded, starts)):
+            n = start
+            while n < self.size and table_hashes[n] == hashes[i]:
+                if self.item(self.keys, self.key_offsets, n) == key:
+                    out[i] = decode(self.item(
+                        self.values, self.value_offsets, n))
+                    break
+                n += 1
+        return(out)
+
+
+    def get(self, key, default=None):
+        value = self.lookup([key])[0]
+        return(default if value is None else value)
+
+
+# -- SHARED KNOWN VARIANTS CLASS --------------------------------------
+
+class shared_known_variants(known_variants):
+    def __init__(self, folder):
+        """
+        Known variants read from the shared table in folder, made by
+        shared_references. Used in place of a loaded known_variants
+        object, with the same columns and annotations.
+        """
+        known_variants.__init__(self)
+        self.classifications = shared_table(folder, 'known')
+        self.list = self.classifications
+
+
+    def annotate_rows(self, rows, classification_column):
+        """
+        Generator that takes report rows and yields them with the
+        classification added if the variant is known. The variants of
+        all the rows are looked up at once.
+        """
+        rows = list(rows)
+        found = self.classifications.lookup([row.variant for row in rows])
+        for row, value in zip(rows, found):
+            if value is not None:
+                if classification_column < len(row.values):
+                    row.values[classification_column] = value
+                else:
+                    row.values.append(value)
+            yield row
+
+
+# -- SHARED REFERENCES CLASS ------------------------------------------
+
+class shared_references:
+    def __init__(self, known, root=None, backend='pyvcf'):
+        """
+        Object properties that are loaded when the oject is created.
+        known is the filepath of a known variants VCF, read with backend
+        straight into the table, or a loaded known_variants object. The
+        classifications are saved as a shared table in a new folder 
+        within root (by default SHARED_ROOT, or the temporary folder), 
+        which workers open with shared_known_variants.
+        The folder is removed by close, or when the program exits.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        if numpy is None:
+            raise ImportError('numpy is needed to share reference data')
+        self.logger = logging.getLogger('vcf_parse.shared')
+        root = root or SHARED_ROOT or tempfile.gettempdir()
+        remove_stale(root)
+        self.folder = tempfile.mkdtemp(
+            prefix='{}{}_'.format(SHARED_PREFIX, os.getpid()), dir=root)
+        atexit.register(self.close)
+        try:
+            if hasattr(known, 'classifications'):
+                known = ((name, ','.join(classifications)) for name,
+                    classifications in known.classifications.items())
+            else:
+                known = known_classifications(known, backend)
+            table = shared_table.write(self.folder, 'known', known)
+        except BaseException:
+            self.close()
+            raise
+        self.logger.info('{} known variants shared with worker processes '
+            'from {}'.format(len(table), self.folder))
+
+
+    def close(self):
+        """Remove the folder, can be called more than once"""
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+
+"""
+vcf_backends.py
+
+Readers for the different VCF parsing libraries that vcf_parse.py can
+use. PyVCF is the default. If pysam is installed, VCFs can instead be
+parsed by htslib, which is much faster. Records from every backend look
+like PyVCF records (CHROM, POS, REF, ALT, FILTER, INFO and samples), so
+the rest of the program doesn't need to know which backend is used and
+the reports are the same.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import struct
+import logging
+from collections import OrderedDict
+
+import vcf
+
+from scripts.file_utils import open_text, STDIO
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+
+# backends that can be selected, the first is the default
+BACKENDS = ('pyvcf', 'pysam')
+
+
+def available_backends():
+    """List of the backends that can be used in this environment"""
+    out = ['pyvcf']
+    if pysam is not None:
+        out.append('pysam')
+    return(out)
+
+
+def choose_backend(backend):
+    """
+    Returns the backend to use. If the backend asked for isn't installed,
+    a warning is logged and PyVCF is used instead.
+    """
+    if backend is None:
+        return(BACKENDS[0])
+    if backend not in BACKENDS:
+        raise ValueError('unknown VCF backend {}, choose from {}'.format(
+            backend, ', '.join(BACKENDS)))
+    if backend not in available_backends():
+        logging.getLogger('vcf_parse.backend').warning(
+            '{} is not installed -- using pyvcf to read VCFs'.format(backend))
+        return(BACKENDS[0])
+    return(backend)
+
+
+def open_vcf(path, backend='pyvcf'):
+    """
+    Open a VCF (plain text or gzip compressed) with the given backend.
+    pysam can only read gzip compressed VCFs made with bgzip. Returns
+    the open file, which must be closed once all the records are read,
+    and the reader. The reader has samples, infos and formats
+    attributes like a PyVCF reader, and yields PyVCF style records.
+    """
+    backend = choose_backend(backend)
+    if backend == 'pysam':
+        # htslib only reads bgzip compressed files, not plain gzip
+        try:
+            reader = pysam_reader(path)
+            return(reader, reader)
+        except NotImplementedError:
+            logging.getLogger('vcf_parse.backend').warning(
+                '{} is not bgzip compressed -- using pyvcf to read it'.format(
+                path))
+
+    # files are decompressed by open_text, so pyvcf doesn't need to
+    vcf_file = open_text(path, 'r')
+    return(vcf_file, vcf.Reader(vcf_file, compressed=False))
+
+
+# -- PYSAM BACKEND ----------------------------------------------------
+
+def float32_to_float(value):
+    """
+    htslib stores floats with single precision, so 0.4583 is read back
+    as 0.45829999446868896. Returns the shortest decimal that gives the
+    same single precision number, which is what was written in the VCF
+    if it had no more than 7 significant figures. Only used for VCFs
+    read from stdin, otherwise Float values are read from the text of
+    the record (see record_text).
+    """
+    if value is None or value != value or value in (
+            float('inf'), float('-inf')):
+        return(value)
+    single = struct.unpack('f', struct.pack('f', value))[0]
+    for digits in range(1, 10):
+        out = float('{:.{}g}'.format(value, digits))
+        if struct.unpack('f', struct.pack('f', out))[0] == single:
+            return(out)
+    return(value)
+
+
+def text_floats(text):
+    """Float values of a field in the text of a record, as PyVCF reads"""
+    return(tuple(None if value == '.' else float(value) 
+                 for value in text.split(',')))
+
+
+class record_text(object):
+    """
+    Text of the Float fields of a record line, read alongside htslib so
+    that Float values are the ones written in the VCF rather than
+    htslib's single precision copy of them. Only the Float fields are
+    kept, not the whole line.
+    """
+    __slots__ = ('info', 'samples')
+
+    def __init__(self, fields, info_floats, format_floats):
+        self.info = {}
+        self.samples = []
+        if info_floats and len(fields) > 7:
+            for item in fields[7].split(';'):
+                name, _, value = item.partition('=')
+                if name in info_floats:
+                    self.info[name] = value
+        if format_floats and len(fields) > 9:
+            keys = fields[8].split(':')
+            columns = [(n, key) for n, key in enumerate(keys) 
+                       if key in format_floats]
+            for sample in fields[9:]:
+                values = sample.split(':')
+                self.samples.append(dict((key, values[n]) 
+                    for n, key in columns if n < len(values)))
+
+
+    def info_value(self, key):
+        """Text of an INFO field, None if the record doesn't have it"""
+        return(self.info.get(key))
+
+
+    def format_value(self, sample, key):
+        """Text of a FORMAT field of the nth sample, None if missing"""
+        if sample >= len(self.samples):
+            return(None)
+        return(self.samples[sample].get(key))
+
+
+class pyvcf_alt(str):
+    """ALT allele that prints like a PyVCF substitution in a list"""
+    def __repr__(self):
+        return(str.__str__(self))
+
+
+class header_field(tuple):
+    """(id, num, type, desc) of an INFO or FORMAT header line"""
+    pass
+
+
+class pysam_reader(object):
+    """
+    Reads a VCF with pysam (htslib), and makes each record look like a
+    PyVCF record. Header lines are kept in the order they appear in the
+    file, as PyVCF does.
+    """
+    def __init__(self, path):
+        pysam.set_verbosity(0)
+        self.path = path
+        self.file = pysam.VariantFile(path)
+        header = self.file.header
+
+        # the record lines are also read as text, for their Float values.
+        # stdin can only be read once, so single precision values are
+        # used for it
+        self.text = None
+        self.lines = None
+        self.line_number = 0
+        if path == STDIO:
+            logging.getLogger('vcf_parse.backend').warning('pysam reads '
+                'Float values from stdin with single precision -- values '
+                'with more than 7 significant figures may differ from '
+                'pyvcf')
+        else:
+            self.text = open_text(path, 'r')
+            self.lines = self.record_lines()
+        self.samples = list(header.samples)
+
+        self.infos = OrderedDict()
+        self.formats = OrderedDict()
+        for record in header.records:
+            if record.type not in ('INFO', 'FORMAT'):
+                continue
+            name = record.get('ID')
+            if record.type == 'INFO':
+                meta = header.info[name]
+                self.infos[name] = header_field(
+                    (name, meta.number, meta.type, meta.description))
+            else:
+                meta = header.formats[name]
+                self.formats[name] = header_field(
+                    (name, meta.number, meta.type, meta.description))
+        self.info_floats = set(name for name, field in self.infos.items()
+                               if field[2] == 'Float')
+        self.format_floats = set(name for name, field in 
+                                 self.formats.items() if field[2] == 'Float')
+
+
+    def __iter__(self):
+        n = 0
+        records = iter(self.file)
+        while True:
+            try:
+                record = next(records)
+            except StopIteration:
+                return
+            except (OSError, IOError) as e:
+                # htslib fails on blank lines, which PyVCF skips. Only
+                # stop if there are no more records after them
+                if self.lines is not None and next(self.lines, None) is None:
+                    return
+                position = ''
+                if self.lines is not None:
+                    position = ' (line {})'.format(self.line_number)
+                raise IOError('htslib could not read record {} of {}{}: {}'
+                    .format(n + 1, self.path, position, e))
+            n += 1
+            yield pysam_record(record, self, self.record_text(record))
+
+
+    def record_lines(self):
+        """Generator of the non-blank record lines of the file"""
+        for n, line in enumerate(self.text, 1):
+            if line.strip() and not line.startswith('#'):
+                self.line_number = n
+                yield line
+
+
+    def record_text(self, record):
+        """
+        Text of the next record line, None if it isn't the same record
+        as htslib read or the VCF is read from stdin
+        """
+        if self.lines is None:
+            return(None)
+        line = next(self.lines, None)
+        if line is None:
+            return(None)
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) < 8 or fields[0] != record.chrom or \
+                fields[1] != str(record.pos):
+            return(None)
+        return(record_text(fields, self.info_floats, self.format_floats))
+
+
+    def close(self):
+        self.file.close()
+        if self.text is not None:
+            self.text.close()
+
+
+def convert_value(value, number, type_, info=False, text=None):
+    """
+    Convert a value from pysam into the type PyVCF would give: lists for
+    fields with more than one value, a single value otherwise. For INFO
+    fields, PyVCF splits single strings on commas and keeps the first.
+    Float values are read from text, the field in the text of the
+    record, if it is given.
+    """
+    if type_ == 'Float' and text is not None:
+        value = text_floats(text)
+    if isinstance(value, tuple):
+        if type_ == 'Float' and text is None:
+            value = [float32_to_float(v) for v in value]
+        else:
+            value = list(value)
+        if number == 1:
+            value = value[0]
+        return(value)
+    if type_ == 'Float' and text is None:
+        return(float32_to_float(value))
+    if type_ == 'String' and value is not None and number == 1:
+        if info:
+            return(value.split(',')[0])
+        return(value)
+    if type_ == 'String' and value is not None and number != 1:
+        return(value.split(','))
+    if number not in (0, 1) and type_ != 'Flag':
+        return([value])
+    return(value)
+
+
+class pysam_info(dict):
+    """INFO fields of a record, converted the first time each is used"""
+    def __init__(self, record, infos, text=None):
+        dict.__init__(self)
+        self.record = record
+        self.infos = infos
+        self.text = text
+
+
+    def __missing__(self, key):
+        info = self.record.info
+        if key not in info:
+            raise KeyError(key)
+        value = info[key]
+        try:
+            name, number, type_, desc = self.infos[key]
+        except KeyError:
+            number, type_ = '.', 'String'
+        if type_ == 'Flag':
+            value = True
+        else:
+            text = None
+            if type_ == 'Float' and self.text is not None:
+                text = self.text.info_value(key)
+            value = convert_value(value, number, type_, info=True, 
+                                  text=text)
+        self[key] = value
+        return(value)
+
+
+    def get(self, key, default=None):
+        try:
+            return(self[key])
+        except KeyError:
+            return(default)
+
+
+class pysam_call(object):
+    """The FORMAT fields of one sample, like a PyVCF call"""
+    def __init__(self, sample, formats, text=None, index=0):
+        self.sample = sample.name
+        self.data = sample
+        self.formats = formats
+        self.text = text
+        self.index = index
+
+
+    def __getitem__(self, key):
+        if key not in self.data:
+            raise AttributeError(key)
+        value = self.data[key]
+
+        # genotypes are kept as text, e.g. 0/1
+        if key == 'GT':
+            if value is None:
+                return(None)
+            sep = '|' if self.data.phased else '/'
+            return(sep.join(
+                '.' if allele is None else str(allele) for allele in value))
+
+        if value is None or value == (None,):
+            return(None)
+        try:
+            name, number, type_, desc = self.formats[key]
+        except KeyError:
+            number, type_ = '.', 'String'
+        text = None
+        if type_ == 'Float' and self.text is not None:
+            text = self.text.format_value(self.index, key)
+        return(convert_value(value, number, type_, text=text))
+
+
+class pysam_record(object):
+    """A pysam record with the attributes of a PyVCF record"""
+    def __init__(self, record, reader, text=None):
+        self.record = record
+        self.reader = reader
+        self.text = text
+        self.CHROM = record.chrom
+        self.POS = record.pos
+        self.REF = record.ref
+        if record.alts is None:
+            self.ALT = [None]
+        else:
+            self.ALT = [pyvcf_alt(alt) for alt in record.alts]
+
+        # PASS is an empty list, missing filter is None, as in PyVCF
+        filters = list(record.filter.keys())
+        if not filters:
+            self.FILTER = None
+        elif filters == ['PASS']:
+            self.FILTER = []
+        else:
+            self.FILTER = filters
+        self.INFO = pysam_info(record, reader.infos, text)
+
+
+    def __iter__(self):
+        formats = self.reader.formats
+        for n, sample in enumerate(self.record.samples.values()):
+            yield pysam_call(sample, formats, self.text, n)
+
+
+# -- PLAIN RECORDS ----------------------------------------------------
+# Records and headers made of plain Python values, so that they can be
+# saved as JSON (see record_cache.py). Made from the records of any
+# backend, and used in the same way as PyVCF records.
+
+class plain_reader(object):
+    """Header of a VCF, with samples, infos and formats like a reader"""
+    def __init__(self, samples, infos, formats):
+        self.samples = samples
+        self.infos = infos
+        self.formats = formats
+
+
+    @classmethod
+    def from_reader(cls, reader):
+        return(cls(
+            list(reader.samples),
+            OrderedDict((name, header_field(tuple(info)[:4])) 
+                for name, info in reader.infos.items()),
+            OrderedDict((name, header_field(tuple(fmt)[:4])) 
+                for name, fmt in reader.formats.items())
+        ))
+
+
+class plain_call(object):
+    """The FORMAT fields of one sample, held in a dictionary"""
+    __slots__ = ('sample', 'data')
+
+    def __init__(self, sample, data):
+        self.sample = sample
+        self.data = data
+
+
+    def __getitem__(self, key):
+        try:
+            return(self.data[key])
+        except KeyError:
+            raise AttributeError(key)
+
+
+class plain_record(object):
+    """A VCF record held as plain Python values"""
+    __slots__ = ('CHROM', 'POS', 'REF', 'ALT', 'FILTER', 'INFO', 'samples')
+
+    def __init__(self, CHROM, POS, REF, ALT, FILTER, INFO, samples):
+        self.CHROM = CHROM
+        self.POS = POS
+        self.REF = REF
+        self.ALT = ALT
+        self.FILTER = FILTER
+        self.INFO = INFO
+        self.samples = samples
+
+
+    def __iter__(self):
+        return(iter(self.samples))
+
+
+    def __getstate__(self):
+        return((self.CHROM, self.POS, self.REF, 
+            [None if alt is None else str(alt) for alt in self.ALT],
+            self.FILTER, self.INFO,
+            [(call.sample, call.data) for call in self.samples]))
+
+
+    def __setstate__(self, state):
+        chrom, pos, ref, alts, filters, info, samples = state
+        self.CHROM = chrom
+        self.POS = pos
+        self.REF = ref
+        self.ALT = [None if alt is None else pyvcf_alt(alt) for alt in alts]
+        self.FILTER = filters
+        self.INFO = info
+        self.samples = [plain_call(name, data) for name, data in samples]
+
+
+    @classmethod
+    def from_state(cls, state):
+        """Make a plain record from the values of __getstate__"""
+        record = cls.__new__(cls)
+        record.__setstate__(state)
+        return(record)
+
+
+    @classmethod
+    def from_record(cls, record):
+        """Make a plain record from a PyVCF or pysam record"""
+        if isinstance(record, pysam_record):
+            info = dict((key, record.INFO[key]) 
+                for key in record.record.info.keys())
+            samples = [plain_call(call.sample, dict(
+                (key, call[key]) for key in call.data.keys())) 
+                for call in record]
+        else:
+            info = dict(record.INFO)
+            samples = [plain_call(call.sample, dict(call.data._asdict())) 
+                for call in record]
+        alts = [None if alt is None else pyvcf_alt(str(alt)) 
+            for alt in record.ALT]
+        return(cls(record.CHROM, record.POS, record.REF, alts,
+            record.FILTER, info, samples))
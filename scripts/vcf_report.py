@@ -1,4 +1,4 @@
-#!/anaconda3/envs/python2/bin/python
+#!/usr/bin/env python
 
 """
 vcf_report.py
@@ -16,33 +16,99 @@ Updated:    31 Oct 2018
 import os
 import vcf
 import csv
+import copy
 import logging
 
+from scripts.report_table import report_table, report_row
+from scripts.vcf_backends import open_vcf
+from scripts.file_utils import describe_path, STDIO
+from scripts.record_cache import record_cache
+from scripts.annotation_cache import csq_hash, MISSING
+
+
+def format_float(value):
+    """
+    Formats a float the same way as str() does in Python 2 (12 
+    significant figures), so that reports are identical whichever 
+    version of Python is used.
+    """
+    out = '{:.12g}'.format(value)
+    if out.lstrip('-').isdigit():
+        out += '.0'
+    return(out)
+
+
+class shared_entry(object):
+    """
+    A CSQ entry and the VEP columns made from it, shared between all 
+    the reports made from a variant so that the entry is only split and
+    each field formatted once.
+    """
+    __slots__ = ('entry', 'fields', 'values')
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.fields = None
+        self.values = {}
+
+
+    def split(self):
+        if self.fields is None:
+            self.fields = self.entry.split('|')
+        return(self.fields)
+
 
 # ----------------- REPORT CLASS --------------------------------------
 class vcf_report:
-    def __init__(self):
+    def __init__(self, backend='pyvcf'):
         """
         Object properties that are loaded when the oject is created.
+        backend is the library used to read VCFs (see vcf_backends.py).
         The logger deals with all status messages from the object and
         is a child of the main logger vcf_parse.
         """
         self.logger = logging.getLogger('vcf_parse.vcf')
+        self.backend = backend
 
+        # report_summary object, if set it is updated as the report is made
+        self.summary = None
 
-    def load_data(self, inp, out):
-        """Load in data from a VCF"""
-        # read input vcf with pyvcf package, save as list
-        self.logger.info(
-            'loading VCF file from {}'.format(os.path.abspath(inp)))
-        with open(inp, 'r') as vcf_input:
-            vcf_reader = vcf.Reader(vcf_input)
-            vcf_records = []
-            for var in vcf_reader:
-                vcf_records.append(var)
-            self.data = vcf_records
-            self.logger.info('loading VCF completed')
+        # record_filter object, if set only variants and transcripts 
+        # that pass the filter expression are included in the report
+        self.filter = None
+
+        # transcript_chooser object, if set only the preferred (or best)
+        # transcript of each variant is included in the report
+        self.transcript_chooser = None
+
+        # columnar_engine object, if set numeric fields are decoded in 
+        # batches by it
+        self.engine = None
+
+        # annotation_cache object, if set VEP columns are reused from it
+        self.annotation_cache = None
+        self.cache_hits = 0
+        self.cache_misses = 0
 
+
+    def read_header(self, vcf_input):
+        """
+        Read the header of a VCF and load the sample name, info, format
+        and vep fields from it. vcf_input can be a filepath or an open 
+        file object. Returns the pyvcf reader, which is ready to read 
+        the records one at a time.
+        """
+        # files are decompressed by open_text, so pyvcf doesn't need to
+        vcf_reader = vcf.Reader(vcf_input, compressed=False)
+        self.load_header(vcf_reader)
+        return(vcf_reader)
+
+
+    def load_header(self, vcf_reader):
+        """
+        Load the sample name, info, format and vep fields from an open 
+        VCF reader, from any backend.
+        """
         # load sample name from vcf
         self.sample = vcf_reader.samples[0]
 
@@ -57,16 +123,103 @@ class vcf_report:
         except KeyError:
             self.vep_fields = [] # use empty list instead of None to avoid downstream errors
 
-        # load output filepath
+        # make empty config variable 
+        self.config = None
+
+
+    def open_data(self, inp, out):
+        """
+        Open a VCF (plain text or gzip compressed) and read its header,
+        without loading the records. Returns the pyvcf reader, and the
+        open file is kept as self.vcf_file until the records are read.
+        """
+        self.logger.info(
+            'loading VCF file from {}'.format(describe_path(inp)))
+        self.vcf_file, vcf_reader = open_vcf(inp, self.backend)
+        self.load_header(vcf_reader)
+        self.set_output(out)
+        return(vcf_reader)
+
+
+    def set_output(self, out):
+        """load output filepath"""
         if out is not None:
             self.output_dir = os.path.abspath(out)
         else:
             self.output_dir = os.path.abspath('.')
+        self.set_name(None)
+
+
+    def set_name(self, name):
+        """
+        Name the report, it is saved as <sample>_<name>_VariantReport.txt
+        in the output folder. If name is None, it is saved as
+        <sample>_VariantReport.txt. report_name is used at the start of 
+        the names of all files made from the report.
+        """
+        if name is None:
+            self.report_name = self.sample
+        else:
+            self.report_name = '{}_{}'.format(self.sample, name)
         self.report_path = os.path.join(
-            self.output_dir, self.sample + '_VariantReport.txt')
+            self.output_dir, self.report_name + '_VariantReport.txt')
 
-        # make empty vep variable 
-        self.config = None
+
+    def config_report(self, config, name):
+        """
+        Returns a new report of the same VCF with a different config,
+        named name (see set_name). The header and loaded records are
+        shared with this report, so make_reports can make both reports
+        in one pass over the records.
+        """
+        report = copy.copy(self)
+        report.config = config
+        report.summary = None
+        report.cache_hits = 0
+        report.cache_misses = 0
+        report.set_name(name)
+        return(report)
+
+
+    def load_data(self, inp, out, use_cache=False):
+        """
+        Load in data from a VCF. If use_cache is set, the decoded records
+        are loaded from the record cache next to the VCF if it is up to 
+        date, otherwise they are saved to it for next time.
+        """
+        cache = None
+        if use_cache and inp != STDIO:
+            cache = record_cache(inp)
+            cached = cache.load()
+            if cached is not None:
+                header, self.data = cached
+                self.load_header(header)
+                self.set_output(out)
+                return
+
+        # read input vcf, save as list
+        vcf_reader = self.open_data(inp, out)
+        vcf_records = []
+        for var in vcf_reader:
+            vcf_records.append(var)
+        self.data = vcf_records
+        self.vcf_file.close()
+        self.logger.info('loading VCF completed')
+
+        if cache is not None:
+            cache.save(vcf_reader, vcf_records)
+
+
+    def load_lines(self, lines, out):
+        """
+        Load in data from the lines of a VCF, e.g. the header and some
+        of the records of a larger VCF (see parallel_parse.vcf_lines)
+        """
+        vcf_reader = self.read_header(lines)
+        self.set_output(out)
+        self.data = list(vcf_reader)
+        self.logger.info('loading VCF completed - {} records'.format(
+            len(self.data)))
 
 
     def load_config(self, config_file):
@@ -222,7 +375,7 @@ class vcf_report:
                     for record in out.split('&'):
                         split = record.split(':')
                         percent = float(split[1]) * 100
-                        out_string += '{}:{}%,'.format(split[0], str(percent))
+                        out_string += '{}:{}%,'.format(split[0], format_float(percent))
                     out = out_string.rstrip(',')
                 except:
                     pass
@@ -233,31 +386,89 @@ class vcf_report:
         return([out])
 
 
+    def unique_csq(self, vep):
+        """
+        Remove repeated CSQ entries from a variant, keeping the first of
+        each in the order they appear. VEP often gives each transcript
+        twice (once per annotation source), so this saves splitting and
+        formatting the same entry again.
+        """
+        seen = set()
+        out = []
+        for entry in vep:
+            if entry not in seen:
+                seen.add(entry)
+                out.append(entry)
+        return(out)
+
+
+    def vep_columns(self, variant, entry, shared=None):
+        """
+        Returns the finished VEP columns of a CSQ entry, in the order
+        they appear in the report, or None if the transcript isn't an NM
+        transcript. If there is an annotation cache, columns are taken 
+        from it when the same entry has been seen before. shared is an
+        optional shared_entry, so that columns already made for another
+        report from the same entry are reused.
+        """
+        cache = self.annotation_cache
+        if cache is not None:
+            key = (variant, csq_hash(self.cache_prefix, entry))
+            out = cache.get(key)
+            if out is not MISSING:
+                self.cache_hits += 1
+                return(out)
+            self.cache_misses += 1
+
+        out = None
+        if shared is None:
+            vep_split = entry.split('|')
+        else:
+            vep_split = shared.split()
+        transcript_col = self.vep_fields.index('Feature')
+        if vep_split[transcript_col].startswith('NM'):
+            if shared is None:
+                out = [self.parse_vep_field(field, vep_split)[0]
+                       for field in self.vep_report_fields]
+            else:
+                values = shared.values
+                out = []
+                for field in self.vep_report_fields:
+                    value = values.get(field)
+                    if value is None:
+                        value = self.parse_vep_field(field, vep_split)[0]
+                        values[field] = value
+                    out.append(value)
+
+        if cache is not None:
+            cache.put(key, out)
+        return(out)
+
+
     def make_header(self):
+        """Returns the list of column headers for the variant report"""
         # Sample and variant are always the first two columns
-        header = 'SampleID\tVariant'
+        header = ['SampleID', 'Variant']
 
         # config file provided
         if self.config:
             for annotation in self.config:
                 if annotation[2] != '':
-                    header +=  '\t' + annotation[2]
+                    header.append(annotation[2])
                 else:
-                    header +=  '\t' + annotation[0]
+                    header.append(annotation[0])
 
         # config file not provided - all headers
         else:
-            header += '\tPreferred\tClassification\tFilter'
+            header += ['Preferred', 'Classification', 'Filter']
             for annotation in self.info_fields:
                 if annotation != 'CSQ':
-                    header += '\t' + annotation
+                    header.append(annotation)
             for annotation in self.format_fields:
-                header += '\t' + annotation
+                header.append(annotation)
             for annotation in self.vep_fields:
-                header += '\t' + annotation
+                header.append(annotation)
         
-        # add newline and return
-        header += '\n'
         return(header)
 
 
@@ -290,9 +501,39 @@ class vcf_report:
         return(out)
 
 
-    def make_record_no_config(self, variant, vep=None):
+    def make_record_no_config(self, variant, vep=None, vep_columns=None,
+            shared=None):
+        """
+        Makes a line of the variant report if no config are present. 
+        vep_columns are the finished VEP columns, if already made. 
+        shared is an optional dictionary of the values already made for
+        this variant, which is added to.
+        """
+        if shared is not None:
+            out = shared.get('no_config')
+            if out is None:
+                out = self.variant_columns(variant, shared)
+                shared['no_config'] = out
+        else:
+            out = self.variant_columns(variant, {})
+        out = list(out)
+
+        # vep
+        if vep_columns is not None:
+            out += vep_columns
+        else:
+            for annotation in self.vep_fields:
+                out += self.parse_vep_field(annotation, vep)
+
+        return(out)
+
+
+    def variant_columns(self, variant, shared):
         """
-        Makes a line of the variant report if no config are present
+        Columns of the report before the VEP columns if no config are
+        present, these are the same for every transcript of a variant.
+        Values already in the shared dictionary for the variant are 
+        used instead of parsing the field again.
         """
         out = []
 
@@ -306,108 +547,293 @@ class vcf_report:
         # info - don't include CSQ field, this is parsed as part of the vep parser
         for annotation in self.info_fields:
             if annotation != 'CSQ':
-                out += self.parse_info_field(variant, annotation)
+                value = shared.get((annotation, 'info'))
+                if value is None:
+                    out += self.parse_info_field(variant, annotation)
+                else:
+                    out.append(value)
 
         # format
         for annotation in self.format_fields:
-            out += self.parse_format_field(variant, annotation)
+            value = shared.get((annotation, 'format'))
+            if value is None:
+                out += self.parse_format_field(variant, annotation)
+            else:
+                out.append(value)
 
-        # vep
-        for annotation in self.vep_fields:
-            out += self.parse_vep_field(annotation, vep)
+        return(out)
 
+
+    def config_values(self, variant, shared):
+        """
+        Values of the config settings that aren't from VEP, which are
+        the same for every transcript of a variant, with None in place 
+        of the VEP columns. Each value is kept in the shared dictionary
+        of values for the variant, so that other reports can use it.
+        """
+        out = []
+        for setting in self.config:
+            if setting[1] == 'vep':
+                out.append(None)
+                continue
+            key = (setting[0], setting[1])
+            value = shared.get(key)
+            if value is None:
+                value = self.make_record_config(setting, variant)[0]
+                shared[key] = value
+            out.append(value)
         return(out)
 
 
-    def make_report(self, filter_setting):
+    def load_report_fields(self):
+        """
+        VEP fields included in the report, in order. The prefix makes
+        cached columns specific to these fields
+        """
+        if self.config:
+            self.vep_report_fields = [
+                annotation[0] for annotation in self.config 
+                if annotation[1] == 'vep']
+            self.vep_positions = [
+                i for i, annotation in enumerate(self.config) 
+                if annotation[1] == 'vep']
+        else:
+            self.vep_report_fields = list(self.vep_fields)
+        self.cache_prefix = '{}\t{}\t'.format(
+            '|'.join(self.vep_fields), '|'.join(self.vep_report_fields))
+
+
+    def iter_report(self, filter_setting, records=None):
+        """
+        Generator that makes the rows of the variant report one at a 
+        time, from records if given, otherwise from the loaded data. 
+        Rows are yielded as report_row objects.
         """
+        for report, row in self.iter_reports(filter_setting, [self], records):
+            yield row
+
+
+    def iter_reports(self, filter_setting, reports, records=None):
+        """
+        Generator that makes the rows of several variant reports (made
+        with config_report) in one pass over the records. Work that is
+        the same for every report - filtering, the variant name, 
+        splitting CSQ entries and the values of each field - is only 
+        done once for each variant. Yields (report, report_row) pairs, 
+        the rows of each report are in the same order as iter_report.
+
         Contains a lot of nested loops, overview of loop structure:
 
-        - open file to save output to
-        - saves headers to output file
         - loops through each variant:
-           - if variant has VEP annotation:
-              - loop through each transcript:
+           - for each report:
+              - if variant has VEP annotation:
+                 - loop through each transcript:
+                    - if config file provided: 
+                       - loop through config and add to output list
+                    - if no config: 
+                       - loop through all annotations and add to output 
+                         list
+                    - yield output list as a row, unless it is a 
+                      duplicate of the previous record
+              - if no VEP annotations:
                  - if config file provided: 
                     - loop through config and add to output list
                  - if no config: 
                     - loop through all annotations and add to output list
-                 - save output list to output file
-           - if no VEP annotations:
-              - if config file provided: 
-                 - loop through config and add to output list
-              - if no config: 
-                 - loop through all annotations and add to output list
-              - save output list to output file
-        - remove duplicate records  
+                 - yield output list as a row, unless it is a duplicate 
+                   of the previous record
         """
-        self.logger.info('writing variant report')
-
-        # open empty output file
-        outfile = open(self.report_path, 'w')
-        report_writer = csv.writer(outfile, delimiter='\t')
+        if records is None:
+            records = self.data
+        for report in reports:
+            report.load_report_fields()
+
+        # compiled filter expression, if there is one
+        record_filter = self.filter
+        variant_test = None
+        transcript_test = None
+        if record_filter is not None:
+            variant_test = record_filter.variant
+            transcript_test = record_filter.transcript
+        chooser = self.transcript_chooser
+        share_entries = len(reports) > 1 or transcript_test is not None \
+            or chooser is not None
+
+        # rows identical to the row before are skipped, this removes 
+        # duplicate records in the same way as uniq
+        last_values = [None] * len(reports)
+
+        # values of each variant, shared by all the reports. The 
+        # columnar engine works these out for batches of records first
+        if self.engine is not None:
+            records = self.engine.decode(records, reports)
+        else:
+            records = ((var, {}) for var in records)
 
         # loop through variants
-        for var in self.data:
+        for var, shared in records:
             
             # PASS filter - pass will be empty - [], anything else will be filtered out
             if filter_setting and var.FILTER :
-                pass
-
-            else:
-                # make variant name
-                variant = self.make_variant_name(var)
+                continue
+
+            # filter expression conditions on the variant, checked before
+            # anything else is done with it
+            if variant_test is not None and not variant_test(var):
+                record_filter.variants_removed += 1
+                continue
+
+            # make variant name and typed coordinates
+            variant = self.make_variant_name(var)
+            coords = (
+                str(var.CHROM), int(var.POS), str(var.REF), 
+                tuple(str(alt) for alt in var.ALT)
+            )
+
+            # values of each CSQ entry, shared by all the reports
+            try:
+                vep = [shared_entry(entry) 
+                       for entry in self.unique_csq(var.INFO['CSQ'])]
+            except:
+                vep = None
+
+            # filter expression conditions on the transcript, checked 
+            # once for each CSQ entry before any rows are made from it.
+            # Variants without VEP output are tested with no transcript
+            if transcript_test is not None:
+                if vep is None:
+                    if not transcript_test(var, None):
+                        record_filter.variants_removed += 1
+                        continue
+                else:
+                    n = len(vep)
+                    vep = [entry for entry in vep 
+                           if transcript_test(var, entry.split())]
+                    record_filter.transcripts_removed += n - len(vep)
+
+            # only the preferred or best transcript, if asked for
+            if chooser is not None and vep:
+                vep = chooser.choose(vep)
+
+            for n, report in enumerate(reports):
+                rows = []
+                transcripts = []
+                config_values = None
                 
                 # if VEP annotation exists, loop through each transcript
                 try:
-                    vep = var.INFO['CSQ']
-                    for record in range(len(vep)):
-                        out = []
-                        vep_split = vep[record].split('|')
-
-                        # filter out any transcripts that dont begin with NM 
-                        transcript_col = self.vep_fields.index('Feature')
-                        if vep_split[transcript_col].startswith('NM'):
-
-                            # if config file provided, parse annotations
-                            if self.config:
-                                for annotation in self.config:
-                                    out += self.make_record_config(annotation, var, vep=vep_split)
+                    if vep is None:
+                        raise KeyError('CSQ')
+                    for entry in vep:
+
+                        # filter out any transcripts that dont begin with
+                        # NM, these have no VEP columns. VEP columns are
+                        # only shared if there are other reports, or the
+                        # entry has already been split for the filter
+                        vep_out = report.vep_columns(variant, entry.entry, 
+                            entry if share_entries else None)
+                        if vep_out is not None:
+
+                            # if config file provided, parse annotations,
+                            # putting the VEP columns in their places
+                            if report.config:
+                                if config_values is None:
+                                    config_values = report.config_values(
+                                        var, shared)
+                                out = list(config_values)
+                                for pos, value in zip(
+                                        report.vep_positions, vep_out):
+                                    out[pos] = value
 
                             # if no config file - include all annotations
                             # filter and preferred must be first, in that order
                             else:
-                                out = self.make_record_no_config(var, vep=vep_split)
+                                out = report.make_record_no_config(
+                                    var, vep_columns=vep_out, shared=shared)
                             
-                            # save to file then repeat for all transcripts
-                            report_writer.writerow([self.sample] + [variant] + out)
+                            # save row then repeat for all transcripts
+                            rows.append([report.sample, variant] + out)
+                            transcripts.append(entry.entry)
 
                 # if variant has no vep annotations
                 except:
                     out = []
 
                     # if config file provided, parse annotations
-                    if self.config:
-                        for annotation in self.config:
-                            out += self.make_record_config(annotation, var)
+                    if report.config:
+                        for annotation in report.config:
+                            out += report.make_record_config(annotation, var)
                     
                     # if no config file - include all annotations
                     # filter and preferred must be first, in that order
                     else:
-                        out = self.make_record_no_config(var)
+                        out = report.make_record_no_config(var)
 
-                    # save to file then repeat for next variant
-                    report_writer.writerow([self.sample] + [variant] + out)
+                    # save row then repeat for next variant
+                    rows.append([report.sample, variant] + out)
 
-        # once loop has finished, close the output file
-        outfile.close()
-        
-        # remove duplicates in output file
-        uniq = os.popen('cat {} | uniq'.format(self.report_path)).read()
-
-        # write final report
-        out = open(self.report_path, 'w') 
-        out.write(self.make_header())
-        out.write(uniq)
-        out.close()
-        self.logger.info('variant report completed - {}'.format(self.report_path))
+                # add variant to the summary statistics, once for all
+                # the reports
+                if n == 0 and self.summary is not None and rows:
+                    self.summary.add_variant(var, transcripts)
+
+                # yield rows for this variant, a copy of each row is 
+                # kept for comparison as later steps may change the row
+                for values in rows:
+                    if values != last_values[n]:
+                        last_values[n] = values[:]
+                        yield report, report_row(*coords, values=values)
+
+
+    def make_report(self, filter_setting):
+        """
+        Makes the variant report and holds it in memory as a 
+        report_table (self.table), so that preferred transcripts, known
+        variants and BED files can be applied without reading it back in
+        from disk. Call write_report to save it. 
+        """
+        self.make_reports(filter_setting, [self])
+
+
+    def make_reports(self, filter_setting, reports):
+        """
+        Makes several variant reports (made with config_report) from one
+        pass over the loaded records, each held in memory as the 
+        report_table of that report.
+        """
+        if len(reports) == 1:
+            self.logger.info('making variant report')
+        else:
+            self.logger.info('making {} variant reports'.format(len(reports)))
+        for report in reports:
+            report.table = report_table(report.make_header())
+        for report, row in self.iter_reports(filter_setting, reports):
+            report.table.rows.append(row)
+        for report in reports:
+            self.logger.info('variant report made - {} rows'.format(
+                len(report.table.rows)))
+
+
+    def annotation_column(self, annotation):
+        """
+        Position of an annotation in the report table, using the 
+        alternative header name from the config if there is one. Returns
+        None if the annotation isn't in the report.
+        """
+        name = annotation
+        if self.config:
+            name = None
+            for record in self.config:
+                if record[0] == annotation:
+                    name = record[2] or record[0]
+        return(self.table.column(name))
+
+
+    def write_report(self, rows=None):
+        """
+        Save the variant report held in memory to the report path, or
+        the rows given in its place
+        """
+        self.table.write(self.report_path, rows)
+        self.logger.info('variant report completed - {}'.format(
+            describe_path(self.report_path, 'w')))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+watch_folder.py
+
+Object that watches an input folder and makes a variant report for
+each new VCF as soon as it has been fully written. Processed inputs
+are recorded in a state file so that they are not redone after a
+restart.
+Loaded as part of the vcf_parse.py program.
+"""
+
+
+import os
+import copy
+import json
+import time
+import logging
+
+
+# file extensions that are picked up from the watched folder
+VCF_EXTENSIONS = ('.vcf', '.vcf.gz')
+
+
+# -- WATCH FOLDER CLASS -----------------------------------------------
+
+class watch_folder:
+    def __init__(self, args, run, references):
+        """
+        Object properties that are loaded when the oject is created.
+        args are the command line arguments used for every VCF, run is
+        the function that processes a single VCF and references is the
+        shared reference_data object.
+        The logger deals with all status messages from the object and
+        is a child of the main logger vcf_parse.
+        """
+        self.logger = logging.getLogger('vcf_parse.watch')
+        self.args = args
+        self.run = run
+        self.references = references
+        self.folder = os.path.abspath(args.watch)
+
+        # state file defaults to the output folder
+        if args.watch_state:
+            self.state_path = os.path.abspath(args.watch_state)
+        else:
+            self.state_path = os.path.join(
+                os.path.abspath(args.output or '.'), 'vcf_parse_watch_state.json')
+
+        # files seen on the last scan that may still be being written
+        self.pending = {}
+        self.load_state()
+
+
+    def load_state(self):
+        """
+        Load the list of already processed inputs from the state file,
+        start with an empty state if there isn't one.
+        """
+        try:
+            with open(self.state_path, 'r') as f:
+                self.state = json.load(f)
+            self.logger.info('loaded watch state from {} - {} inputs processed'.format(
+                self.state_path, len(self.state)))
+        except (IOError, OSError, ValueError):
+            self.state = {}
+
+
+    def save_state(self):
+        """
+        Save the state file, written to a temp file first so that the
+        state is never left half written.
+        """
+        temp = self.state_path + '.temp'
+        with open(temp, 'w') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.rename(temp, self.state_path)
+
+
+    def list_inputs(self):
+        """
+        Returns the VCFs in the watched folder with their size and
+        modification time. Hidden files are ignored, these are usually
+        temp files still being copied in.
+        """
+        inputs = {}
+        for name in sorted(os.listdir(self.folder)):
+            path = os.path.join(self.folder, name)
+            if name.startswith('.') or not name.endswith(VCF_EXTENSIONS):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            inputs[path] = [stat.st_size, stat.st_mtime]
+        return(inputs)
+
+
+    def scan(self):
+        """
+        Checks the watched folder once and processes every VCF that is
+        new and fully written. A file counts as fully written once its
+        size and modification time are the same on two scans in a row.
+        Returns the list of inputs processed.
+        """
+        processed = []
+        inputs = self.list_inputs()
+
+        for path, signature in inputs.items():
+            # skip if processed already and unchanged since
+            done = self.state.get(path)
+            if done is not None and done['signature'] == signature:
+                continue
+
+            # wait for the next scan if file is new or still growing
+            if self.pending.get(path) != signature:
+                self.pending[path] = signature
+                continue
+
+            # process file and record the result in the state file
+            del self.pending[path]
+            self.state[path] = self.process(path, signature)
+            self.save_state()
+            processed.append(path)
+
+        # forget about pending files that have disappeared
+        for path in list(self.pending):
+            if path not in inputs:
+                del self.pending[path]
+
+        return(processed)
+
+
+    def process(self, path, signature):
+        """
+        Make the variant report for a single VCF, returns the state
+        entry for that input. Failed inputs are recorded as well, so
+        they are only retried if the file changes.
+        """
+        args = copy.copy(self.args)
+        args.input = path
+        args.config_list = False
+
+        start = time.time()
+        self.logger.info('new VCF found - {}'.format(path))
+        entry = {'signature': signature, 'processed': start}
+        try:
+            report = self.run(args, self.references)
+            entry['status'] = 'done'
+            entry['report'] = report.report_path
+        except Exception as e:
+            self.logger.exception('failed to process {}'.format(path))
+            entry['status'] = 'failed'
+            entry['error'] = str(e)
+
+        entry['seconds'] = round(time.time() - start, 4)
+        return(entry)
+
+
+    def watch(self):
+        """
+        Poll the watched folder until interrupted.
+        """
+        self.logger.info('watching {} every {}s, state file {}'.format(
+            self.folder, self.args.poll_interval, self.state_path))
+        try:
+            while True:
+                self.scan()
+                time.sleep(self.args.poll_interval)
+        except KeyboardInterrupt:
+            self.logger.info('stopped watching {}'.format(self.folder))
@@ -1,4 +1,4 @@
-#!/anaconda3/envs/python2/bin/python
+#!/usr/bin/env python
 
 """
 test.py
@@ -15,11 +15,55 @@ Updated:    23 Oct 2018
 import unittest
 import os
 import csv
-
-from scripts.vcf_report import vcf_report
-from scripts.preferred_transcripts import preferred_transcripts
+import time
+import gzip
+import shutil
+import tempfile
+import threading
+import json
+import sys
+import subprocess
+import socket
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+from scripts.vcf_report import vcf_report, shared_entry
+from scripts.report_table import report_row
+from scripts.preferred_transcripts import preferred_transcripts, \
+    transcript_chooser
 from scripts.bed_object import bed_object
 from scripts.known_variants import known_variants
+from scripts.reference_data import reference_data
+from scripts.daemon import vcf_daemon, send_request, parse_address
+from scripts.watch_folder import watch_folder
+from scripts.annotation_cache import annotation_cache, MISSING
+from scripts.external_sort import external_sort, make_sort_key, \
+    value_text, SORT_KEYS
+from scripts.api import vcf_parser, parse_vcf
+from scripts.vcf_backends import available_backends, open_vcf
+from scripts.record_cache import record_cache
+from scripts.columnar_engine import columnar_engine
+from scripts.vcf_backends import plain_record, plain_call
+from scripts.filter_expression import record_filter, filter_error
+from scripts.parallel_parse import parallel_parser, header_end, chunk_ranges
+from scripts.report_summary import report_summary
+from scripts.shards import shard_runner, contig_ranges, size_ranges
+from scripts.file_utils import open_text
+from scripts.bed_index import bed_index, bed_index_cache
+from scripts.cohort_matrix import load_matrix, MATRIX_NAME
+from scripts.checkpoint import checkpoint_runner
+from scripts.shared_reference import shared_table, shared_references, \
+    shared_known_variants, SHARED_PREFIX
+from scripts.auto_plan import run_plan, prescan, MB
+from vcf_parse import run, get_args, run_cohort
 
 
 class TestVCF(unittest.TestCase):
@@ -30,6 +74,7 @@ class TestVCF(unittest.TestCase):
             os.path.abspath('test/test.vcf'), os.path.abspath('test/')
             )
         self.report.make_report(False)
+        self.report.write_report()
 
     
     def tearDown(self):
@@ -50,6 +95,15 @@ class TestVCF(unittest.TestCase):
                 os.remove(os.path.abspath(filename))
 
 
+    def test_unique_csq(self):
+        """
+        Check that repeated CSQ entries are removed, keeping the first
+        of each in order
+        """
+        vep = ['a|1', 'b|2', 'a|1', 'c|3', 'b|2']
+        self.assertEqual(self.report.unique_csq(vep), ['a|1', 'b|2', 'c|3'])
+
+
     def test_vcf_parser_number_variants(self):
         """
         Check that number of variants loaded from VCF is correct, 
@@ -129,6 +183,7 @@ class TestVCF(unittest.TestCase):
         should be 477
         """
         self.report.make_report(True)
+        self.report.write_report()
 
         report_sum = sum(1 for line in open(os.path.abspath(
             'test/SAMPLE1_VariantReport.txt'
@@ -151,6 +206,19 @@ class TestVCF(unittest.TestCase):
             )
 
 
+    def test_variant_report_line_endings(self):
+        """
+        Check that the header and every row of the variant report end
+        in a bare newline. Reports used to end each row in CRLF on 
+        Python 2 only, they now end in LF everywhere
+        """
+        with open(self.report.report_path, 'rb') as report:
+            lines = report.read().split(b'\n')
+        self.assertEqual(lines[-1], b'')
+        self.assertEqual(len(lines), 272)
+        self.assertFalse(any(line.endswith(b'\r') for line in lines))
+
+
     def test_load_config(self):
         """
         Check that settings file is loaded correctly, the headers loaded in 
@@ -163,11 +231,12 @@ class TestVCF(unittest.TestCase):
         # load config
         self.report.load_config(os.path.abspath('test/config.txt'))
         self.report.make_report(False)
+        self.report.write_report()
 
         # compare headers in report to expected list
         with open(self.report.report_path) as f:
             reader = csv.reader(f, delimiter='\t')
-            self.assertEqual(reader.next(), expected_settings)
+            self.assertEqual(next(reader), expected_settings)
 
     
     def test_preferred_transcripts_high_strictness_true(self):
@@ -179,6 +248,7 @@ class TestVCF(unittest.TestCase):
         self.pt = preferred_transcripts()
         self.pt.load(os.path.abspath('test/PreferredTranscripts.txt'))
         self.pt.apply(self.report, 'high')
+        self.report.write_report()
 
         # check in report
         with open(self.report.report_path) as report:
@@ -199,6 +269,7 @@ class TestVCF(unittest.TestCase):
         self.pt = preferred_transcripts()
         self.pt.load(os.path.abspath('test/PreferredTranscripts.txt'))
         self.pt.apply(self.report, 'high')
+        self.report.write_report()
 
         # check in report
         with open(self.report.report_path) as report:
@@ -218,6 +289,7 @@ class TestVCF(unittest.TestCase):
         self.pt = preferred_transcripts()
         self.pt.load(os.path.abspath('test/PreferredTranscripts.txt'))
         self.pt.apply(self.report, 'low')
+        self.report.write_report()
 
         # check in report
         with open(self.report.report_path) as report:
@@ -238,6 +310,7 @@ class TestVCF(unittest.TestCase):
         self.pt = preferred_transcripts()
         self.pt.load(os.path.abspath('test/PreferredTranscripts.txt'))
         self.pt.apply(self.report, 'low')
+        self.report.write_report()
 
         # check in report
         with open(self.report.report_path) as report:
@@ -257,6 +330,7 @@ class TestVCF(unittest.TestCase):
         self.pt = preferred_transcripts()
         self.pt.load(os.path.abspath('test/PreferredTranscripts.txt'))
         self.pt.apply(self.report, 'low')
+        self.report.write_report()
 
         # check in report
         with open(self.report.report_path) as report:
@@ -322,6 +396,7 @@ class TestVCF(unittest.TestCase):
             'test/KnownVariants.vcf'
         ))
         known.apply_known_variants(self.report)
+        self.report.write_report()
 
         # check output report
         with open(self.report.report_path) as report:
@@ -339,6 +414,7 @@ class TestEdgeVariants(unittest.TestCase):
             os.path.abspath('test/edge_variants.vcf'), os.path.abspath('test/')
             )
         self.report.make_report(False)
+        self.report.write_report()
 
 
     def tearDown(self):
@@ -381,6 +457,7 @@ class TestEmptyVcf(unittest.TestCase):
             os.path.abspath('test/empty_vcf.vcf'), os.path.abspath('test/')
             )
         self.report.make_report(False)
+        self.report.write_report()
 
 
     def tearDown(self):
@@ -406,6 +483,1882 @@ class TestEmptyVcf(unittest.TestCase):
         self.assertEqual(n , 1) #should be one because there is a header only
 
 
+class OutputFolderTest(unittest.TestCase):
+    """
+    Base class of the tests that write their reports to a temporary
+    output folder, self.output, which is removed after each test
+    """
+    def setUp(self):
+        """make an output folder"""
+        self.output = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        """remove output folder"""
+        shutil.rmtree(self.output)
+
+
+    def read_files(self, folder, skip=None):
+        """
+        text of every file in a folder, by filepath. skip is an optional
+        function of the filepath, files it returns True for are left out
+        """
+        out = {}
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                path = os.path.relpath(os.path.join(root, name), folder)
+                if skip is not None and skip(path):
+                    continue
+                with open_text(os.path.join(folder, path), 'r') as f:
+                    out[path] = f.read()
+        return(out)
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        """start a daemon on a free localhost port"""
+        args = get_args([
+            '-O', os.path.abspath('test/'), 
+            '-k', os.path.abspath('test/KnownVariants.vcf'),
+            '--daemon', '127.0.0.1:0', '--workers', '1', '--max_queue', '1'
+        ])
+        self.daemon = vcf_daemon(args, run, reference_data())
+        host, port = self.daemon.start()
+        self.address = '{}:{}'.format(host, port)
+        self.thread = threading.Thread(target=self.daemon.serve)
+        self.thread.start()
+
+
+    def tearDown(self):
+        """stop the daemon and remove output files"""
+        send_request(self.address, {'command': 'shutdown'})
+        self.thread.join()
+        if os.path.isfile('test/SAMPLE1_VariantReport.txt'):
+            os.remove('test/SAMPLE1_VariantReport.txt')
+
+
+    def wait(self, job_id):
+        """poll the daemon until a job has finished"""
+        for i in range(200):
+            job = send_request(self.address, {'command': 'job', 'job': job_id})['job']
+            if job['state'] in ('done', 'failed'):
+                return job
+            time.sleep(0.05)
+
+
+    def test_daemon_job(self):
+        """
+        Check that a submitted job makes the variant report, reusing the 
+        known variants loaded when the daemon started
+        """
+        response = send_request(self.address, 
+            {'command': 'submit', 'input': 'test/test.vcf'})
+        self.assertEqual(response['status'], 'queued')
+
+        job = self.wait(response['job'])
+        self.assertEqual(job['state'], 'done')
+        self.assertTrue(os.path.isfile(job['report']))
+        self.assertEqual(len(self.daemon.references.cache), 1)
+
+        status = send_request(self.address, {'command': 'status'})
+        self.assertEqual(status['queue_depth'], 0)
+        self.assertEqual(status['completed'], 1)
+        self.assertTrue(status['jobs'][0]['latency_seconds'] > 0)
+
+
+    def test_daemon_missing_input(self):
+        """
+        Check that jobs without an input VCF are rejected
+        """
+        response = send_request(self.address, {'command': 'submit'})
+        self.assertEqual(response['status'], 'error')
+
+
+    def test_daemon_local_only(self):
+        """
+        Check that the daemon only listens on localhost
+        """
+        self.assertEqual(parse_address('9000'), ('127.0.0.1', 9000))
+        self.assertEqual(parse_address('localhost:9000'), 
+                         ('localhost', 9000))
+        self.assertEqual(parse_address('[::1]:9000'), ('::1', 9000))
+        for address in ('0.0.0.0:9000', '192.168.0.1:9000', 
+                        'example.com:9000', '[::]:9000'):
+            with self.assertRaises(ValueError):
+                parse_address(address)
+
+        args = get_args(['--daemon', '0.0.0.0:0'])
+        with self.assertRaises(ValueError):
+            vcf_daemon(args, run, reference_data()).start()
+
+
+    def test_daemon_bad_request(self):
+        """
+        Check that requests that aren't JSON objects get an error 
+        response and the connection is kept open
+        """
+        host, port = self.address.rsplit(':', 1)
+        sock = socket.create_connection((host, int(port)))
+        try:
+            stream = sock.makefile('rwb')
+            for line in (b'[]', b'"x"', b'1', b'{', b'{"command": "status"}'):
+                stream.write(line + b'\n')
+                stream.flush()
+                response = json.loads(stream.readline().decode('utf-8'))
+                if line.startswith(b'{"'):
+                    self.assertEqual(response['status'], 'ok')
+                else:
+                    self.assertEqual(response['status'], 'error')
+            stream.close()
+        finally:
+            sock.close()
+
+
+    def test_shared_annotation_cache(self):
+        """
+        Check that jobs on several threads can share an annotation cache
+        while changing its size
+        """
+        references = reference_data()
+        def job(size):
+            cache = references.annotation_cache('test/shared.cache', size)
+            for i in range(2000):
+                cache.put((size, i), i)
+                cache.get((size, i - 1))
+        threads = [threading.Thread(target=job, args=(size,)) 
+                   for size in (10, 50, 100, 500)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cache = references.annotation_cache('test/shared.cache', 10)
+        self.assertEqual(len(cache), 10)
+
+
+class TestWatchFolder(OutputFolderTest):
+    def setUp(self):
+        """make a watched folder and an output folder"""
+        OutputFolderTest.setUp(self)
+        self.folder = tempfile.mkdtemp()
+        self.args = get_args([
+            '-O', self.output, '--watch', self.folder, '--poll_interval', '0'
+        ])
+
+
+    def tearDown(self):
+        """remove temp folders"""
+        shutil.rmtree(self.folder)
+        OutputFolderTest.tearDown(self)
+
+
+    def test_watch_folder(self):
+        """
+        Check that a new VCF is processed once it is fully written, and 
+        that it isn't processed again after a restart
+        """
+        watcher = watch_folder(self.args, run, reference_data())
+        self.assertEqual(watcher.scan(), [])
+
+        # first scan sees the file, second scan processes it
+        vcf = os.path.join(self.folder, 'test.vcf')
+        shutil.copy('test/test.vcf', vcf)
+        self.assertEqual(watcher.scan(), [])
+        self.assertEqual(watcher.scan(), [vcf])
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.output, 'SAMPLE1_VariantReport.txt')))
+        self.assertEqual(watcher.scan(), [])
+
+        # restarted watcher loads the state file and skips the VCF
+        watcher = watch_folder(self.args, run, reference_data())
+        self.assertEqual(watcher.scan(), [])
+        self.assertEqual(watcher.scan(), [])
+
+
+class TestApi(unittest.TestCase):
+    def setUp(self):
+        """make the same report with the file based pipeline"""
+        self.report = vcf_report()
+        self.report.load_data(
+            os.path.abspath('test/test.vcf'), os.path.abspath('test/')
+            )
+        self.report.load_config(os.path.abspath('test/config.txt'))
+        self.report.make_report(False)
+        pt = preferred_transcripts()
+        pt.load(os.path.abspath('test/PreferredTranscripts.txt'))
+        pt.apply(self.report, 'low')
+        known = known_variants()
+        known.load_known_variants(os.path.abspath('test/KnownVariants.vcf'))
+        known.apply_known_variants(self.report)
+
+        self.parser = vcf_parser(
+            config=os.path.abspath('test/config.txt'), 
+            transcripts=os.path.abspath('test/PreferredTranscripts.txt'),
+            known_variants=known
+        )
+
+
+    def test_api_rows(self):
+        """
+        Check that the API gives the same rows as the file based 
+        pipeline, with typed coordinates, and writes no files
+        """
+        files = os.listdir('test')
+        rows = self.parser.parse('test/test.vcf')
+
+        self.assertEqual(rows.sample, 'SAMPLE1')
+        self.assertEqual(rows.header, self.report.table.header)
+        table = rows.table
+        rows = list(rows)
+        self.assertEqual([row.values for row in rows], 
+            [row.values for row in self.report.table.rows])
+        self.assertEqual(os.listdir('test'), files)
+
+        self.assertEqual(rows[0].chrom, '1')
+        self.assertEqual(rows[0].pos, 115256669)
+        self.assertEqual(rows[0].ref, 'G')
+        self.assertEqual(rows[0].alt, ('A',))
+
+        # FORMAT values are typed, their text is as written to the report
+        self.assertEqual(rows[0].values[table.column('AD')], [143, 121])
+        self.assertEqual(table.text(rows[0], 'AD'), '[143, 121]')
+        self.assertTrue(table.text(rows[0], 'Missing') is None)
+
+
+    def test_api_file_object(self):
+        """
+        Check that a file object can be parsed, with options
+        """
+        with open('test/test.vcf') as f:
+            rows = list(parse_vcf(f, filter_non_pass=True))
+        self.assertEqual(len(rows), 228)
+
+
+    def test_api_threads(self):
+        """
+        Check that several VCFs can be parsed at once from threads
+        """
+        results = [None] * 4
+        def parse(i):
+            results[i] = [row.values for row in self.parser.parse('test/test.vcf')]
+
+        threads = [threading.Thread(target=parse, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expected = [row.values for row in self.report.table.rows]
+        for result in results:
+            self.assertEqual(result, expected)
+
+
+class TestPipeline(OutputFolderTest):
+    def make_report(self, options, folder):
+        """run vcf_parse with options, returns the report lines"""
+        out = os.path.join(self.output, folder)
+        os.mkdir(out)
+        report = run(get_args(options + ['-O', out,
+            '-t', 'test/PreferredTranscripts.txt', 
+            '-k', 'test/KnownVariants.vcf', '-c', 'test/config.txt']), 
+            reference_data())
+        if report.report_path.endswith('.gz'):
+            with gzip.open(report.report_path, 'rb') as f:
+                return f.read().decode('utf-8').splitlines()
+        with open(report.report_path) as f:
+            return f.read().splitlines()
+
+
+    def test_pipeline_output(self):
+        """
+        Check that pipelined mode gives the same report as the default 
+        mode, including with small queues
+        """
+        expected = self.make_report(['test/test.vcf'], 'default')
+        pipelined = self.make_report(
+            ['test/test.vcf', '--pipeline', '--queue_size', '1'], 'pipeline')
+        self.assertEqual(pipelined, expected)
+
+
+    def test_pipeline_gzip(self):
+        """
+        Check that gzipped VCFs are read and gzipped reports written
+        """
+        expected = self.make_report(['test/test.vcf'], 'default')
+        vcf = os.path.join(self.output, 'test.vcf.gz')
+        with open('test/test.vcf', 'rb') as f_in:
+            with gzip.open(vcf, 'wb') as f_out:
+                f_out.write(f_in.read())
+
+        pipelined = self.make_report(
+            [vcf, '--pipeline', '--gzip_output'], 'pipeline')
+        self.assertEqual(pipelined, expected)
+
+
+class TestExternalSort(unittest.TestCase):
+    def setUp(self):
+        """make report rows, with a tiny memory budget so runs are saved"""
+        self.scratch = tempfile.mkdtemp()
+        self.report = vcf_report()
+        self.report.load_data('test/test.vcf', self.scratch)
+        self.report.load_config('test/config.txt')
+        self.report.make_report(False)
+        self.rows = self.report.table.rows
+
+
+    def tearDown(self):
+        """remove scratch folder"""
+        shutil.rmtree(self.scratch)
+
+
+    def test_sort_position(self):
+        """
+        Check that sorting with runs saved to disk gives the same order as
+        sorting in memory
+        """
+        key = make_sort_key('position', self.report)
+        sorter = external_sort(key, memory_mb=0.005, scratch_dir=self.scratch)
+        result = [row.values for row in sorter.sort(self.rows)]
+        expected = [row.values for row in sorted(self.rows, key=key)]
+        self.assertTrue(sorter.runs > 1)
+        self.assertEqual(result, expected)
+        self.assertEqual(os.listdir(self.scratch), [])
+
+
+    def test_sort_gene(self):
+        """
+        Check that sorting by gene orders by SYMBOL then position
+        """
+        key = make_sort_key('gene', self.report)
+        sorter = external_sort(key, memory_mb=0.005, scratch_dir=self.scratch)
+        result = list(sorter.sort(self.rows))
+        column = self.report.annotation_column('SYMBOL')
+        genes = [value_text(row.values[column]) for row in result]
+        self.assertEqual(genes, sorted(genes))
+        self.assertEqual(len(result), len(self.rows))
+
+
+    def test_dedup(self):
+        """
+        Check that duplicates anywhere in the report are removed, keeping
+        the first of each in the original order
+        """
+        rows = self.rows + self.rows[:10]
+        sorter = external_sort(
+            dedup=True, memory_mb=0.005, scratch_dir=self.scratch)
+        result = [row.values for row in sorter.sort(rows)]
+        self.assertEqual(result, [row.values for row in self.rows])
+        self.assertEqual(sorter.duplicates, 10)
+
+
+    def test_no_config(self):
+        """
+        Check sorting and removing duplicates from a report made without
+        a config, which has numbers, lists and empty values in the same
+        columns
+        """
+        report = vcf_report()
+        report.load_data('test/test.vcf', self.scratch)
+        report.make_report(False)
+        rows = report.table.rows
+
+        # a copy of a row with a number replaced by an empty value isn't
+        # a duplicate
+        changed = report_row(rows[0].chrom, rows[0].pos, rows[0].ref, 
+                             rows[0].alt, list(rows[0].values))
+        column = [n for n, value in enumerate(changed.values) 
+                  if isinstance(value, int)][0]
+        changed.values[column] = None
+        expected = rows + [changed]
+        rows = rows + rows[:10] + [changed]
+
+        for sort_by in SORT_KEYS:
+            key = make_sort_key(sort_by, report)
+            sorter = external_sort(key, dedup=True, memory_mb=0.005, 
+                                   scratch_dir=self.scratch)
+            result = list(sorter.sort(rows))
+            self.assertTrue(sorter.runs > 1)
+            self.assertEqual(sorter.duplicates, 10)
+            self.assertEqual([row.values for row in result], 
+                [row.values for row in sorted(expected, key=key)])
+
+        # and from the command line
+        for options in (['--sort_by', 'gene'], ['--dedup']):
+            folder = os.path.join(self.scratch, 'output')
+            os.makedirs(folder)
+            made = run(get_args(['test/test.vcf', '-O', folder] + options), 
+                       reference_data())
+            # rows are taken out of the table as they are sorted
+            self.assertEqual(made.table.rows, [])
+            path = os.path.join(folder, 'SAMPLE1_VariantReport.txt')
+            with open(path) as f:
+                self.assertEqual(len(f.readlines()), 
+                                 len(report.table.rows) + 1)
+            shutil.rmtree(folder)
+
+
+@unittest.skipIf(numpy is None, 'numpy not installed')
+class TestSummary(OutputFolderTest):
+    def make_summary(self, options, folder):
+        """run vcf_parse with a summary, returns the report and summary"""
+        out = os.path.join(self.output, folder)
+        os.mkdir(out)
+        report = run(get_args(['test/test.vcf', '-O', out, 
+            '-c', 'test/config.txt', '--summary'] + options), 
+            reference_data())
+        with open(os.path.join(out, 'SAMPLE1_VariantSummary.json')) as f:
+            return(report, json.load(f))
+
+
+    def test_summary(self):
+        """
+        Check the summary counts against the variant report
+        """
+        report, summary = self.make_summary([], 'default')
+        table = report.table
+        variants = set(row.variant for row in table.rows)
+        self.assertEqual(summary['variants'], len(variants))
+
+        # variants without VEP annotation aren't counted by gene
+        genes = {}
+        for variant, gene in set(
+                (row.variant, table.value(row, 'Gene')) for row in table.rows):
+            if gene != 'No VEP output':
+                genes[gene] = genes.get(gene, 0) + 1
+        self.assertEqual(summary['genes'], genes)
+
+        self.assertEqual(sum(summary['impacts'].values()), 
+            len(set((row.variant, table.value(row, 'IMPACT')) 
+            for row in table.rows)) - summary['variants_without_vep'])
+        self.assertEqual(sum(summary['VF']['counts']), len(variants))
+        self.assertEqual(sum(summary['DP']['counts']), len(variants))
+
+
+    def test_summary_pipeline(self):
+        """
+        Check that pipelined mode gives the same summary
+        """
+        report, expected = self.make_summary([], 'default')
+        report, pipelined = self.make_summary(['--pipeline'], 'pipeline')
+        self.assertEqual(pipelined, expected)
+
+
+@unittest.skipIf('pysam' not in available_backends(), 'pysam not installed')
+class TestBackends(OutputFolderTest):
+    def make_report(self, vcf, options, folder):
+        """run vcf_parse with options, returns the report lines"""
+        out = os.path.join(self.output, folder)
+        os.mkdir(out)
+        report = run(get_args([vcf, '-O', out] + options), reference_data())
+        with open(report.report_path) as f:
+            return f.read().splitlines()
+
+
+    def test_backends_same_report(self):
+        """
+        Check that every backend gives the same report for each test VCF,
+        with and without a config
+        """
+        options = [
+            [],
+            ['-c', 'test/config.txt', '-F'],
+            ['-t', 'test/PreferredTranscripts.txt', 
+             '-k', 'test/KnownVariants.vcf'],
+        ]
+        n = 0
+        for vcf in ('test/test.vcf', 'test/edge_variants.vcf', 
+                    'test/empty_vcf.vcf'):
+            for option in options:
+                n += 1
+                expected = self.make_report(
+                    vcf, option + ['--backend', 'pyvcf'], 'pyvcf{}'.format(n))
+                for backend in available_backends()[1:]:
+                    result = self.make_report(vcf, option + 
+                        ['--backend', backend], '{}{}'.format(backend, n))
+                    self.assertEqual(result, expected)
+
+
+    def test_backends_gzip(self):
+        """
+        Check that gzip and bgzip compressed VCFs give the same report 
+        with every backend
+        """
+        gz = os.path.join(self.output, 'test.vcf.gz')
+        with open('test/test.vcf', 'rb') as f_in:
+            with gzip.open(gz, 'wb') as f_out:
+                f_out.write(f_in.read())
+        bgz = os.path.join(self.output, 'test.bgz.vcf.gz')
+        pysam.tabix_compress('test/test.vcf', bgz)
+
+        expected = self.make_report('test/test.vcf', [], 'pyvcf')
+        for backend in available_backends()[1:]:
+            for vcf in (gz, bgz):
+                folder = backend + os.path.basename(vcf)
+                result = self.make_report(
+                    vcf, ['--backend', backend], folder)
+                self.assertEqual(result, expected)
+
+
+    def test_backends_float_precision(self):
+        """
+        Check that Float values with more significant figures than 
+        htslib keeps are the same with every backend
+        """
+        vcf = os.path.join(self.output, 'precise.vcf')
+        with open('test/test.vcf') as f_in:
+            with open(vcf, 'w') as f_out:
+                for line in f_in:
+                    if not line.startswith('#'):
+                        line = line.replace('AF=0.5;', 
+                            'AF=0.123456789012;').replace(
+                            ':0.4583\n', ':0.333333333333\n')
+                    f_out.write(line)
+
+        expected = self.make_report(vcf, [], 'pyvcf')
+        self.assertTrue(any('0.123456789012' in line for line in expected))
+        self.assertTrue(any('0.333333333333' in line for line in expected))
+        for backend in available_backends()[1:]:
+            result = self.make_report(vcf, ['--backend', backend], backend)
+            self.assertEqual(result, expected)
+
+
+    def test_backends_read_error(self):
+        """
+        Check that a record htslib can't read is reported with its 
+        position, while blank lines at the end are skipped
+        """
+        vcf = os.path.join(self.output, 'blank.vcf')
+        with open('test/test.vcf') as f_in:
+            lines = f_in.readlines()
+        header = len([line for line in lines if line.startswith('#')])
+        with open(vcf, 'w') as f_out:
+            f_out.writelines(lines[:header + 2] + ['\n'] + 
+                             lines[header + 2:header + 3])
+        vcf_input, reader = open_vcf(vcf, 'pysam')
+        with self.assertRaises(IOError) as error:
+            list(reader)
+        vcf_input.close()
+        self.assertIn('record 3', str(error.exception))
+        self.assertIn('line {}'.format(header + 4), str(error.exception))
+
+
+class TestStdio(OutputFolderTest):
+    def run_script(self, options, vcf):
+        """run vcf_parse.py with a VCF piped into stdin, returns stdout"""
+        with open(vcf, 'rb') as f:
+            process = subprocess.Popen(
+                [sys.executable, 'vcf_parse.py'] + options, 
+                stdin=f, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = process.communicate()
+        self.assertEqual(process.returncode, 0, err)
+        return(out)
+
+
+    def test_stdin_stdout(self):
+        """
+        Check that reading from stdin and writing to stdout gives the
+        same report as using files, and nothing else is written to stdout
+        """
+        report = run(get_args(['test/test.vcf', '-O', self.output, 
+            '-c', 'test/config.txt']), reference_data())
+        with open(report.report_path, 'rb') as f:
+            expected = f.read()
+
+        for mode in ([], ['--pipeline']):
+            out = self.run_script(['-', '--stdout', '-c', 'test/config.txt', 
+                '-O', self.output] + mode, 'test/test.vcf')
+            self.assertEqual(out, expected)
+
+
+class TestAnnotationCache(OutputFolderTest):
+    def setUp(self):
+        """make an output folder"""
+        OutputFolderTest.setUp(self)
+        self.cache = os.path.join(self.output, 'annotation.cache')
+
+
+    def make_report(self, options, folder):
+        """run vcf_parse with options, returns the report and its lines"""
+        out = os.path.join(self.output, folder)
+        os.mkdir(out)
+        report = run(get_args(['test/test.vcf', '-O', out] + options), 
+            reference_data())
+        with open(report.report_path) as f:
+            return(report, f.read().splitlines())
+
+
+    def test_cache_reused(self):
+        """
+        Check that a second run takes every transcript from the cache 
+        saved by the first, and the reports are the same as without a
+        cache
+        """
+        for config in ([], ['-c', 'test/config.txt']):
+            expected = self.make_report(config, 'none')[1]
+            first, first_lines = self.make_report(
+                config + ['--annotation_cache', self.cache], 'first')
+            second, second_lines = self.make_report(
+                config + ['--annotation_cache', self.cache], 'second')
+
+            self.assertEqual(first.cache_hits, 0)
+            self.assertEqual(second.cache_misses, 0)
+            self.assertEqual(second.cache_hits, first.cache_misses)
+            self.assertEqual(first_lines, expected)
+            self.assertEqual(second_lines, expected)
+
+            os.remove(self.cache)
+            for folder in ('none', 'first', 'second'):
+                shutil.rmtree(os.path.join(self.output, folder))
+
+
+    def test_cache_size(self):
+        """
+        Check that the least recently used entries are removed once the
+        cache is full
+        """
+        cache = annotation_cache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertEqual(cache.evicted, 1)
+        self.assertTrue(cache.get('b') is MISSING)
+
+
+class TestPartitionedOutput(OutputFolderTest):
+    def read_rows(self, path):
+        with open(path) as f:
+            return([line.split('\t') for line in f.read().splitlines()])
+
+
+    def test_partition_by_gene(self):
+        """
+        Check that every row is saved once in its gene's file, even when
+        only one file can be open at a time, and that the manifest is 
+        right
+        """
+        report = run(get_args(['test/test.vcf', '-O', self.output, 
+            '-c', 'test/config.txt', '--partition_by', 'gene', 
+            '--max_open_files', '1', '--partition_manifest']), 
+            reference_data())
+        main = self.read_rows(report.report_path)
+        folder = os.path.join(self.output, 'SAMPLE1_VariantReport_by_gene')
+        manifest = self.read_rows(os.path.join(folder, 'manifest.txt'))[1:]
+
+        gene = main[0].index('Gene')
+        all_rows = []
+        for name, filename, rows, size in manifest:
+            path = os.path.join(folder, filename)
+            partition = self.read_rows(path)
+            self.assertEqual(partition[0], main[0])
+            self.assertEqual(int(rows), len(partition) - 1)
+            self.assertEqual(int(size), os.path.getsize(path))
+            for row in partition[1:]:
+                if name == 'no_gene':
+                    self.assertTrue(row[gene] in ('', 'No VEP output'))
+                else:
+                    self.assertEqual(row[gene], name)
+            all_rows += partition[1:]
+        self.assertEqual(sorted(all_rows), sorted(main[1:]))
+
+
+    def test_partition_by_chrom(self):
+        """
+        Check that pipelined mode splits the report in the same way
+        """
+        for folder, mode in (('default', []), ('pipeline', ['--pipeline'])):
+            os.mkdir(os.path.join(self.output, folder))
+            run(get_args(['test/test.vcf', '-O', 
+                os.path.join(self.output, folder), '--partition_by', 
+                'chrom'] + mode), reference_data())
+        default = os.path.join(
+            self.output, 'default', 'SAMPLE1_VariantReport_by_chrom')
+        pipeline = os.path.join(
+            self.output, 'pipeline', 'SAMPLE1_VariantReport_by_chrom')
+        self.assertEqual(sorted(os.listdir(default)), 
+            sorted(os.listdir(pipeline)))
+        self.assertTrue('17.txt' in os.listdir(default))
+        for filename in os.listdir(default):
+            self.assertEqual(
+                self.read_rows(os.path.join(default, filename)),
+                self.read_rows(os.path.join(pipeline, filename)))
+
+
+class TestRecordCache(OutputFolderTest):
+    def setUp(self):
+        """make an output folder with a copy of the test VCF"""
+        OutputFolderTest.setUp(self)
+        self.vcf = os.path.join(self.output, 'test.vcf')
+        shutil.copy('test/test.vcf', self.vcf)
+
+
+    def make_report(self, options, folder, use_cache=True):
+        """make a report from the copied VCF, returns the report lines"""
+        out = os.path.join(self.output, folder)
+        os.mkdir(out)
+        if use_cache:
+            options = options + ['--record_cache']
+        report = run(get_args([self.vcf, '-O', out] + options), 
+            reference_data())
+        with open(report.report_path) as f:
+            return f.read().splitlines()
+
+
+    def test_cache_reused(self):
+        """
+        Check that the cache is saved on the first run and loaded on the
+        second, and the reports are the same as without it
+        """
+        cache = record_cache(self.vcf)
+        for n, backend in enumerate(available_backends()):
+            options = ['-c', 'test/config.txt', '--backend', backend]
+            expected = self.make_report(options, 'none{}'.format(n), False)
+            first = self.make_report(options, 'first{}'.format(n))
+            self.assertTrue(os.path.exists(cache.path))
+            self.assertTrue(cache.load() is not None)
+            second = self.make_report(options, 'second{}'.format(n))
+            self.assertEqual(first, expected)
+            self.assertEqual(second, expected)
+            os.remove(cache.path)
+
+
+    def test_cache_invalidated(self):
+        """Check that the cache isn't used once the VCF has changed"""
+        self.make_report([], 'first')
+        cache = record_cache(self.vcf)
+        self.assertTrue(cache.load() is not None)
+
+        # remove the last record
+        with open(self.vcf) as f:
+            lines = f.read().splitlines(True)
+        with open(self.vcf, 'w') as f:
+            f.writelines(lines[:-1])
+        self.assertTrue(record_cache(self.vcf).load() is None)
+
+        expected = self.make_report([], 'none', False)
+        result = self.make_report([], 'second')
+        self.assertEqual(result, expected)
+        self.assertTrue(record_cache(self.vcf).load() is not None)
+
+
+    def test_cache_touched(self):
+        """
+        Check that the cache is still used once the VCF is touched, as
+        its hash hasn't changed, but not once it is changed in place
+        """
+        self.make_report([], 'first')
+        os.utime(self.vcf, (0, 0))
+        cache = record_cache(self.vcf)
+        self.assertTrue(cache.load() is not None)
+
+        # same size, different content
+        with open(self.vcf) as f:
+            text = f.read()
+        with open(self.vcf, 'w') as f:
+            f.write(text.replace('PASS', 'FAIL'))
+        self.assertTrue(record_cache(self.vcf).load() is None)
+
+
+    def test_cache_is_json(self):
+        """Check that the cache file is JSON lines"""
+        self.make_report([], 'first')
+        with open(record_cache(self.vcf).path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines[0]['version'], 2)
+        self.assertEqual(lines[1][0], ['SAMPLE1'])
+
+
+class TestMultipleConfigs(OutputFolderTest):
+    def setUp(self):
+        """make an output folder and a second config"""
+        OutputFolderTest.setUp(self)
+        self.config = os.path.join(self.output, 'small.txt')
+        with open(self.config, 'w') as out:
+            out.write('Gene\tvep\tSYMBOL\n')
+            out.write('DP\tinfo\n')
+            out.write('Frequency\tformat\tVF\n')
+            out.write('HGVSc\tvep\n')
+            out.write('Filter\tfilter\n')
+
+
+    def read_reports(self, folder):
+        """text of each report in a folder and its subfolders"""
+        out = {}
+        for path, folders, files in os.walk(folder):
+            for name in files:
+                with open(os.path.join(path, name)) as f:
+                    out[os.path.relpath(os.path.join(path, name), folder)
+                        ] = f.read()
+        return(out)
+
+
+    def test_same_as_seperate_runs(self):
+        """
+        Check that each report made from one run with several configs
+        is the same as a run with that config on its own
+        """
+        options = ['-t', 'test/PreferredTranscripts.txt', 
+                   '-k', 'test/KnownVariants.vcf', 
+                   '-B', 'test/test_bed_files/']
+        both = os.path.join(self.output, 'both')
+        os.mkdir(both)
+        run(get_args(['test/test.vcf', '-O', both, '-c', 'test/config.txt', 
+            '-c', self.config] + options), reference_data())
+        reports = self.read_reports(both)
+
+        for config, name in (('test/config.txt', 'config'), 
+                             (self.config, 'small')):
+            out = os.path.join(self.output, name)
+            os.mkdir(out)
+            report = run(get_args(['test/test.vcf', '-O', out, '-c', config]
+                + options), reference_data())
+
+            # files are named <sample>_<config name>_... in the first run
+            for path, text in self.read_reports(out).items():
+                folder, filename = os.path.split(path)
+                filename = filename.replace(report.sample, 
+                    '{}_{}'.format(report.sample, name), 1)
+                path = os.path.join(folder, filename)
+                self.assertEqual(reports.pop(path), text)
+        self.assertEqual(reports, {})
+
+
+@unittest.skipIf(numpy is None, 'numpy not installed')
+class TestColumnarEngine(OutputFolderTest):
+    def setUp(self):
+        """make an output folder and a config with numeric fields"""
+        OutputFolderTest.setUp(self)
+        self.config = os.path.join(self.output, 'numeric.txt')
+        with open(self.config, 'w') as out:
+            out.write('Frequency\tformat\tVF\n')
+            out.write('DP\tinfo\n')
+            out.write('MQ\tinfo\n')
+            out.write('BaseQRankSum\tinfo\n')
+            out.write('GQ\tformat\n')
+            out.write('SB\tformat\n')
+            out.write('GT\tformat\n')
+            out.write('SYMBOL\tvep\n')
+
+
+    def make_report(self, vcf, options, folder):
+        """run vcf_parse with options, returns the report lines"""
+        out = os.path.join(self.output, folder)
+        os.mkdir(out)
+        report = run(get_args([vcf, '-O', out] + options), reference_data())
+        with open(report.report_path) as f:
+            return f.read().splitlines()
+
+
+    def test_same_report(self):
+        """
+        Check that the columnar engine gives the same report as the row
+        engine for each test VCF
+        """
+        options = [
+            [],
+            ['-c', 'test/config.txt', '-F'],
+            ['-c', self.config],
+        ]
+        n = 0
+        for vcf in ('test/test.vcf', 'test/edge_variants.vcf', 
+                    'test/empty_vcf.vcf'):
+            for option in options:
+                n += 1
+                expected = self.make_report(vcf, option, 'row{}'.format(n))
+                result = self.make_report(vcf, option + 
+                    ['--engine', 'columnar'], 'columnar{}'.format(n))
+                self.assertEqual(result, expected)
+
+
+    def test_batches(self):
+        """
+        Check that rows are the same whatever the batch size, including
+        batches that don't divide the number of records
+        """
+        report = vcf_report()
+        report.load_data('test/test.vcf', self.output)
+        report.load_config(self.config)
+        expected = [row.values for row in report.iter_report(False)]
+        for batch_size in (1, 7, 1000):
+            report.engine = columnar_engine(report, batch_size)
+            result = [row.values for row in report.iter_report(False)]
+            self.assertEqual(result, expected)
+
+
+    def test_multi_allelic(self):
+        """
+        Check the allele frequency from AD of records with different 
+        numbers of ALT alleles in the same batch, and that records the
+        frequency can't be worked out for are left to the report
+        """
+        report = vcf_report()
+        report.load_data('test/test.vcf', self.output)
+        report.load_config(self.config)
+        engine = columnar_engine(report)
+        engine.select_fields([report])
+
+        records = []
+        for ad in ([10, 5, 3], [3, 1], [6, 2, 1, 1], [0, 0], [4], None):
+            records.append(plain_record('1', 100, 'A', ['C'], [], {'DP': 9},
+                [plain_call(report.sample, {'AD': ad, 'GQ': 20})]))
+        values = [shared for record, shared in engine.decode_batch(records)]
+
+        frequency = [shared.get(('Frequency', 'format')) 
+                     for shared in values]
+        self.assertEqual(frequency, 
+            ['33.33%', '25.0%', '25.0%', None, None, None])
+        self.assertEqual(values[0][('DP', 'info')], '9')
+        self.assertEqual(values[0][('MQ', 'info')], '')
+        self.assertEqual(values[0][('GQ', 'format')], 20)
+        self.assertEqual(values[0][('SB', 'format')], '')
+
+
+class TestFilterExpression(OutputFolderTest):
+    def setUp(self):
+        """load the unfiltered report of the test VCF"""
+        OutputFolderTest.setUp(self)
+        self.report = vcf_report()
+        self.report.load_data('test/test.vcf', self.output)
+        self.header = self.report.make_header()
+        self.rows = [row.values for row in self.report.iter_report(False)]
+
+
+    def filtered_rows(self, expression):
+        """rows of the test VCF report with the filter applied"""
+        report = vcf_report()
+        report.load_data('test/test.vcf', self.output)
+        report.filter = record_filter(expression, report)
+        return([row.values for row in report.iter_report(False)])
+
+
+    def test_errors(self):
+        """Check that bad expressions are rejected when compiled"""
+        for expression in ('NOT_A_FIELD > 1', 'DP >', 'DP >= high', 
+                'IMPACT in (HIGH', 'DP > 1 and', '(DP > 1'):
+            with self.assertRaises(filter_error):
+                record_filter(expression, self.report)
+
+
+    def test_split(self):
+        """
+        Check that conditions are split into those on the variant and
+        those on each transcript
+        """
+        test = record_filter('DP >= 100', self.report)
+        self.assertIsNotNone(test.variant)
+        self.assertIsNone(test.transcript)
+
+        test = record_filter('IMPACT == HIGH', self.report)
+        self.assertIsNone(test.variant)
+        self.assertIsNotNone(test.transcript)
+
+        test = record_filter('DP >= 100 and VEP.IMPACT in (HIGH,MODERATE)',
+            self.report)
+        self.assertIsNotNone(test.variant)
+        self.assertIsNotNone(test.transcript)
+
+
+    def test_same_rows(self):
+        """
+        Check that the filtered report has the same rows as filtering 
+        the unfiltered report
+        """
+        dp = self.header.index('DP')
+        impact = self.header.index('IMPACT')
+        symbol = self.header.index('SYMBOL')
+
+        expected = [row for row in self.rows if int(row[dp]) >= 100 and 
+                    row[impact] in ('HIGH', 'MODERATE')]
+        result = self.filtered_rows('DP>=100 and IMPACT in (HIGH,MODERATE)')
+        self.assertTrue(expected)
+        self.assertEqual(result, expected)
+
+        expected = [row for row in self.rows if not int(row[dp]) < 500 or 
+                    row[symbol] == 'NRAS']
+        result = self.filtered_rows('not DP < 500 or SYMBOL == NRAS')
+        self.assertEqual(result, expected)
+
+        # variants with no VEP output have no IMPACT, so don't match
+        expected = [row for row in self.rows 
+                    if row[impact] not in ('LOW', 'MODIFIER', 'No VEP output')]
+        result = self.filtered_rows("IMPACT not in ('LOW', MODIFIER)")
+        self.assertEqual(result, expected)
+
+
+    def test_pipeline(self):
+        """Check that the filter gives the same report in pipeline mode"""
+        reports = []
+        for option in ([], ['--pipeline']):
+            out = tempfile.mkdtemp(dir=self.output)
+            report = run(get_args(['test/test.vcf', '-O', out, '--filter', 
+                'DP>=100 and IMPACT in (HIGH,MODERATE)'] + option), 
+                reference_data())
+            with open(report.report_path) as f:
+                reports.append(f.read())
+        self.assertEqual(reports[0], reports[1])
+
+
+class TestParallelParse(OutputFolderTest):
+    def make_reports(self, vcf, configs, parallel=None, summary=False,
+                     expression=None, cache=None):
+        """
+        make a report for each config, with parallel_parser and an
+        annotation cache if given, returns the rows of each report and
+        the summary. The reports are kept in self.reports
+        """
+        report = vcf_report()
+        report.annotation_cache = cache
+        if parallel is None:
+            report.load_data(vcf, self.output)
+        else:
+            report.open_data(vcf, self.output)
+            report.vcf_file.close()
+        report.config = configs[0]
+        reports = [report]
+        for n, config in enumerate(configs[1:]):
+            reports.append(report.config_report(config, str(n)))
+        if summary:
+            report.summary = report_summary(report)
+        if expression:
+            report.filter = record_filter(expression, report)
+
+        if parallel is None:
+            report.make_reports(True, reports)
+        else:
+            parallel.make_reports(True, reports)
+        rows = [[(row.chrom, row.pos, row.ref, row.alt, row.values) 
+                 for row in each.table.rows] for each in reports]
+        self.reports = reports
+        if summary:
+            summary = report.summary.to_dict()
+        return(rows, summary)
+
+
+    def test_chunk_ranges(self):
+        """
+        Check that the ranges start after the header, are next to each
+        other, cover every record and are split at line ends
+        """
+        with open('test/test.vcf', 'rb') as f:
+            data = f.read()
+        start = header_end(data)
+        self.assertTrue(data[:start].endswith(b'\n'))
+        self.assertTrue(data[:start].splitlines()[-1].startswith(b'#CHROM'))
+        self.assertNotEqual(data[start:start + 1], b'#')
+
+        for chunks in (1, 2, 3, 7, 50, 100000):
+            ranges = chunk_ranges(data, start, chunks)
+            self.assertTrue(1 <= len(ranges) <= chunks)
+            self.assertEqual(ranges[0][0], start)
+            self.assertEqual(ranges[-1][1], len(data))
+            for (a, b), (c, d) in zip(ranges, ranges[1:]):
+                self.assertEqual(b, c)
+                self.assertEqual(data[b - 1:b], b'\n')
+            self.assertEqual(b''.join(data[a:b] for a, b in ranges), 
+                             data[start:])
+
+
+    def test_same_report(self):
+        """
+        Check that the reports are the same as from one process, with 
+        the records split into ranges in several ways
+        """
+        config = reference_data().config('test/config.txt')
+        for vcf in ('test/test.vcf', 'test/edge_variants.vcf', 
+                    'test/empty_vcf.vcf'):
+            for configs in ([None], [config], [config, None]):
+                expected = self.make_reports(vcf, configs)
+                for workers, chunks in ((1, 5), (2, 3), (3, 40)):
+                    result = self.make_reports(vcf, configs, 
+                        parallel_parser(vcf, workers, chunks))
+                    self.assertEqual(result, expected)
+
+
+    @unittest.skipIf(numpy is None, 'numpy not installed')
+    def test_summary_and_filter(self):
+        """
+        Check that the summaries and filter counts of each range are 
+        added up to those of the whole VCF
+        """
+        expression = 'DP>=100 or IMPACT in (HIGH,MODERATE)'
+        expected = self.make_reports('test/test.vcf', [None], 
+            summary=True, expression=expression)
+        result = self.make_reports('test/test.vcf', [None], 
+            parallel_parser('test/test.vcf', 2, 6), summary=True, 
+            expression=expression)
+        self.assertEqual(result, expected)
+
+
+    def test_annotation_cache(self):
+        """
+        Check that the workers use the annotation cache, and that the
+        entries they make are added to it in the same order as in one
+        process
+        """
+        config = reference_data().config('test/config.txt')
+        single = annotation_cache()
+        expected = self.make_reports('test/test.vcf', [config], cache=single)
+
+        cache = annotation_cache()
+        result = self.make_reports('test/test.vcf', [config], 
+            parallel_parser('test/test.vcf', 2, 3), cache=cache)
+        self.assertEqual(result, expected)
+        self.assertTrue(len(cache) > 0)
+        self.assertEqual(list(cache.entries.items()), 
+                         list(single.entries.items()))
+
+        # a second run finds every entry in the cache
+        result = self.make_reports('test/test.vcf', [config], 
+            parallel_parser('test/test.vcf', 2, 3), cache=cache)
+        self.assertEqual(result, expected)
+        self.assertTrue(self.reports[0].cache_hits > 0)
+        self.assertEqual(self.reports[0].cache_misses, 0)
+
+
+    def test_options(self):
+        """
+        Check that compressed input is made in one process, and that
+        --processes can't be used with --pipeline
+        """
+        with self.assertRaises(ValueError):
+            parallel_parser('sample.vcf.gz', 2)
+        with self.assertRaises(ValueError):
+            run(get_args(['test/test.vcf', '-O', self.output, 
+                '--processes', '2', '--pipeline']), reference_data())
+
+
+class TestShards(OutputFolderTest):
+    def shard_file(self, path):
+        """True for the files of the shards rather than the reports"""
+        folder, name = os.path.split(path)
+        return('shards' in folder.split(os.sep) or 'Shard' in name or 
+               name.startswith('shard_'))
+
+
+    def run_shards(self, vcf, options):
+        """
+        plan, run and merge the shards of a VCF, returns the merged 
+        files and the number of shards
+        """
+        out = os.path.join(self.output, 'sharded')
+        manifest = os.path.join(out, 'shard_manifest.json')
+        references = reference_data()
+        plan = shard_runner(get_args([vcf, '-O', out, '--shard', 'plan'] + 
+            options), run, references).plan()
+        for shard in plan['shards']:
+            shard_runner(get_args(['--shard', 'run', '--manifest', manifest,
+                '--shard_index', str(shard['index'])]), run, 
+                references).run_shard(shard['index'])
+        shard_runner(get_args(['--shard', 'merge', '--manifest', manifest]), 
+            run, references).merge()
+        return(self.read_files(out, self.shard_file), len(plan['shards']))
+
+
+    def test_ranges(self):
+        """
+        Check that contig ranges split the records where the contig
+        changes, and that size ranges are about the size asked for
+        """
+        header = b'##fileformat=VCFv4.2\n#CHROM\tPOS\n'
+        counts = [('1', 500), ('2', 3), ('10', 1), ('X', 2000), ('Y', 7)]
+        data = header
+        expected = []
+        for contig, count in counts:
+            start = len(data)
+            for pos in range(count):
+                data += '{}\t{}\tA\tC\n'.format(contig, pos).encode()
+            expected.append((start, len(data), [contig]))
+        self.assertEqual(contig_ranges(data, len(header)), expected)
+        self.assertEqual(contig_ranges(data[:-1], len(header))[-1], 
+            (expected[-1][0], len(data) - 1, ['Y']))
+
+        ranges = size_ranges(data, len(header), 5000)
+        self.assertEqual(len(ranges), -(-(len(data) - len(header)) // 5000))
+        for start, end, contigs in ranges:
+            lines = data[start:end].splitlines()
+            first = lines[0].split(b'\t')[0].decode()
+            last = lines[-1].split(b'\t')[0].decode()
+            self.assertEqual(contigs, [first] if first == last 
+                else [first, last])
+
+
+    def test_same_reports(self):
+        """
+        Check that the merged reports, BED file reports and summary are
+        the same as from a single run
+        """
+        options = [
+            [],
+            ['--shard_by', 'size', '--shard_size', '0.01', '-c', 
+             'test/config.txt', '-t', 'test/PreferredTranscripts.txt', 
+             '-k', 'test/KnownVariants.vcf', '-B', 'test/test_bed_files/',
+             '--summary', '--filter', 'POS > 1000'],
+            ['--shard_by', 'size', '--shard_size', '0.003', '-b',
+             'test/test_bed_files/edge.bed', '--gzip_output', '-F'],
+        ]
+        for vcf in ('test/test.vcf', 'test/edge_variants.vcf', 
+                    'test/empty_vcf.vcf'):
+            for option in options:
+                single = tempfile.mkdtemp(dir=self.output)
+                run(get_args([vcf, '-O', single] + option), reference_data())
+                result, shards = self.run_shards(vcf, option)
+                self.assertEqual(result, self.read_files(single, self.shard_file))
+                shutil.rmtree(single)
+                shutil.rmtree(os.path.join(self.output, 'sharded'))
+                if vcf == 'test/test.vcf':
+                    self.assertTrue(shards > 1)
+
+
+    def test_errors(self):
+        """
+        Check that shards aren't merged until they are all finished, or
+        run if the VCF has changed since they were planned
+        """
+        vcf = os.path.join(self.output, 'test.vcf')
+        shutil.copy('test/test.vcf', vcf)
+        manifest = os.path.join(self.output, 'shard_manifest.json')
+        shard_runner(get_args([vcf, '-O', self.output, '--shard', 'plan']), 
+            run, reference_data()).plan()
+        shards = shard_runner(get_args(['--shard', 'merge', '--manifest', 
+            manifest]), run, reference_data())
+        with self.assertRaises(ValueError):
+            shards.merge()
+
+        with open(vcf, 'a') as out:
+            out.write('\n')
+        with self.assertRaises(ValueError):
+            shards.run_shard(0)
+
+
+@unittest.skipIf(numpy is None, 'numpy not installed')
+class TestBedIndex(OutputFolderTest):
+    def setUp(self):
+        """make an output folder"""
+        OutputFolderTest.setUp(self)
+        self.cache = os.path.join(self.output, 'bed_cache')
+
+
+    def read_reports(self, folder):
+        """text of each BED file report in a folder, by filename"""
+        out = {}
+        for name in os.listdir(folder):
+            with open(os.path.join(folder, name)) as f:
+                out[name] = f.read()
+        return(out)
+
+
+    def test_overlaps(self):
+        """
+        Check that the index finds the same overlaps as bedtools, with
+        intervals that overlap, touch or have no length
+        """
+        import random
+        random.seed(0)
+        bed = os.path.join(self.output, 'random.bed')
+        intervals = []
+        with open(bed, 'w') as out:
+            out.write('track name=random\n')
+            for n in range(300):
+                chrom = random.choice(['1', '2'])
+                start = random.randint(0, 2000)
+                end = start + random.choice([0, 1, 5, 40])
+                intervals.append((chrom, start, end))
+                out.write('{}\t{}\t{}\n'.format(chrom, start, end))
+        index = bed_index.from_bed(bed)
+
+        for chrom in ('1', '2', '3'):
+            starts = numpy.arange(0, 2100)
+            for length in (1, 2, 7):
+                ends = starts + length
+                expected = [any(c == chrom and s < be and bs < e 
+                                for c, bs, be in intervals)
+                            for s, e in zip(starts, ends)]
+                result = index.overlaps(chrom, starts, ends)
+                self.assertEqual(result.tolist(), expected)
+
+
+    def test_same_reports(self):
+        """
+        Check that BED file reports are the same as with bedtools, both
+        when the indexes are compiled and when they are loaded
+        """
+        options = ['test/test.vcf', '-B', 'test/test_bed_files/']
+        expected = os.path.join(self.output, 'bedtools')
+        os.mkdir(expected)
+        run(get_args(options + ['-O', expected]), reference_data())
+        expected = self.read_reports(
+            os.path.join(expected, 'test_bed_files'))
+
+        for n in range(2):
+            out = os.path.join(self.output, 'index{}'.format(n))
+            os.mkdir(out)
+            references = reference_data()
+            run(get_args(options + ['-O', out, '--bed_cache', self.cache]), 
+                references)
+            result = self.read_reports(os.path.join(out, 'test_bed_files'))
+            self.assertEqual(result, expected)
+
+            cache = references.bed_index_cache(self.cache)
+            if n == 0:
+                self.assertEqual((cache.compiled, cache.loaded), (4, 0))
+            else:
+                self.assertEqual((cache.compiled, cache.loaded), (0, 4))
+                self.assertIsInstance(
+                    list(cache.indexes.values())[0].intervals, numpy.memmap)
+
+
+    def test_changed_bed(self):
+        """Check that a BED file is compiled again when it changes"""
+        bed = os.path.join(self.output, 'panel.bed')
+        with open(bed, 'w') as out:
+            out.write('1\t100\t200\n')
+        index = bed_index_cache(self.cache).get(bed)
+        self.assertEqual(index.overlaps('1', numpy.array([150]), 
+            numpy.array([151])).tolist(), [True])
+
+        with open(bed, 'w') as out:
+            out.write('1\t300\t400\n')
+        os.utime(bed, (0, 0))
+        cache = bed_index_cache(self.cache)
+        index = cache.get(bed)
+        self.assertEqual(cache.compiled, 1)
+        self.assertEqual(index.overlaps('1', numpy.array([150]), 
+            numpy.array([151])).tolist(), [False])
+
+
+class TestPreferredOnly(OutputFolderTest):
+    def make_report(self, options):
+        """run vcf_parse on the test VCF, returns the report table"""
+        out = tempfile.mkdtemp(dir=self.output)
+        report = run(get_args(['test/test.vcf', '-O', out, 
+            '-t', 'test/PreferredTranscripts.txt'] + options), 
+            reference_data())
+        return(report.table)
+
+
+    def test_preferred_or_best(self):
+        """
+        Check that each variant keeps its preferred transcripts, or the
+        best transcript if it has none, and that the rows are otherwise
+        the same as the full report
+        """
+        full = self.make_report([])
+        result = self.make_report(['--preferred_only'])
+        preferred = full.column('Preferred')
+        impact = full.column('IMPACT')
+        canonical = full.column('CANONICAL')
+
+        variants = {}
+        for row in full.rows:
+            variants.setdefault(row.variant, []).append(row.values)
+        chosen = {}
+        for row in result.rows:
+            chosen.setdefault(row.variant, []).append(row.values)
+        self.assertEqual(list(chosen), list(variants))
+        self.assertTrue(len(result.rows) < len(full.rows))
+
+        order = ('HIGH', 'MODERATE', 'LOW', 'MODIFIER')
+        n_preferred = 0
+        for variant, rows in variants.items():
+            expected = [row for row in rows if row[preferred] == 'True']
+            if expected:
+                n_preferred += 1
+            elif rows[0][impact] == 'No VEP output':
+                expected = rows
+            else:
+                expected = [min(rows, key=lambda row: (
+                    row[canonical] != 'YES', order.index(row[impact])))]
+            self.assertEqual(chosen[variant], expected)
+        self.assertTrue(n_preferred > 0)
+
+
+    def test_same_in_every_mode(self):
+        """Check that the pipeline and several processes choose the same"""
+        expected = self.make_report(['--preferred_only']).rows
+        for option in (['--pipeline', '-b', 'test/test_bed_files/bed2.bed'],
+                       ['--processes', '2']):
+            result = self.make_report(['--preferred_only'] + option).rows
+            self.assertEqual([row.values for row in result], 
+                             [row.values for row in expected])
+
+
+    def test_rank(self):
+        """
+        Check the order transcripts are chosen in when none are 
+        preferred: PICK, MANE, canonical, IMPACT, then CSQ order
+        """
+        report = vcf_report()
+        report.vep_fields = ['Feature', 'IMPACT', 'CANONICAL', 
+                             'MANE_SELECT', 'PICK']
+        chooser = transcript_chooser(report)
+        entries = [
+            'NM_1|MODIFIER|||',
+            'NM_2|HIGH|||',
+            'NM_3|LOW|YES||',
+            'NM_4|LOW||NM_4.1|',
+            'NM_5|MODIFIER|||1',
+            'XM_6|HIGH|YES|NM_6|1',
+        ]
+        for n in range(len(entries) - 1):
+            shared = [shared_entry(entry) for entry in entries[n:]]
+            best = chooser.choose(shared)
+            self.assertEqual(len(best), 1)
+            self.assertEqual(best[0].entry, max(entries[n:-1], 
+                key=lambda entry: (entry.endswith('1'), 'NM_4.1' in entry,
+                    'YES' in entry, 'HIGH' in entry, -entries.index(entry))))
+        self.assertEqual(chooser.choose([shared_entry(entries[-1])]), [])
+
+
+@unittest.skipIf(numpy is None, 'numpy not installed')
+class TestCohortMatrix(OutputFolderTest):
+    def setUp(self):
+        """
+        make an output folder, and a copy of the test VCF with a 
+        different sample name and one variant left out
+        """
+        OutputFolderTest.setUp(self)
+        self.copy = os.path.join(self.output, 'copy.vcf')
+        removed = None
+        with open('test/test.vcf') as vcf_in:
+            with open(self.copy, 'w') as vcf_out:
+                for line in vcf_in:
+                    if line.startswith('#CHROM'):
+                        line = line.replace('SAMPLE1', 'SAMPLE2')
+                    elif not line.startswith('#') and removed is None:
+                        removed = line
+                        continue
+                    vcf_out.write(line)
+        fields = removed.split('\t')
+        self.removed = '{}:{}{}>{}'.format(*(fields[:2] + fields[3:5]))
+        self.list = os.path.join(self.output, 'cohort.txt')
+        with open(self.list, 'w') as f:
+            f.write('{}\ntest/edge_variants.vcf\n'.format(self.copy))
+
+
+    def make_matrix(self, options=()):
+        """build the matrix of the cohort, returns it loaded from file"""
+        args = get_args(['--cohort', 'test/test.vcf', self.list, 
+            'test/empty_vcf.vcf', '-O', self.output] + list(options))
+        run_cohort(args)
+        return(load_matrix(os.path.join(self.output, MATRIX_NAME)))
+
+
+    def test_matrix(self):
+        """
+        Check the variants and samples of the matrix, and that each
+        variant is only added once however many samples it is in
+        """
+        matrix = self.make_matrix()
+        self.assertEqual([str(sample) for sample in matrix['samples']], 
+            ['SAMPLE1', 'SAMPLE2', 'SAMPLE1', 'SAMPLE1'])
+        self.assertEqual(list(matrix['shape']), 
+                         [len(matrix['variants']), 4])
+
+        report = vcf_report()
+        report.load_data('test/test.vcf', None)
+        names = [report.make_variant_name(var) for var in report.data]
+        self.assertEqual([str(name) for name in 
+                          matrix['variants'][:len(names)]], names)
+
+        variants = [str(name) for name in matrix['variants']]
+        self.assertEqual(len(set(variants)), len(variants))
+        entries = set(zip(matrix['row'].tolist(), matrix['col'].tolist()))
+        self.assertEqual(len(entries), len(matrix['row']))
+
+        # every variant of the test VCF is in both samples but one
+        recurrence = numpy.bincount(matrix['row'], 
+                                    minlength=len(variants))
+        for n, name in enumerate(names):
+            expected = 1 if name == self.removed else 2
+            self.assertEqual(recurrence[n], expected)
+        self.assertFalse(numpy.any(matrix['col'] == 3))
+
+
+    def test_values(self):
+        """
+        Check the genotype, frequency and depth of each entry against 
+        the fields of the test VCF
+        """
+        matrix = self.make_matrix()
+        report = vcf_report()
+        report.load_data('test/test.vcf', None)
+        codes = {'0/0': 0, '0/1': 1, '1/1': 2}
+        entries = {}
+        for n in range(len(matrix['row'])):
+            if matrix['col'][n] == 0:
+                entries[str(matrix['variants'][matrix['row'][n]])] = (
+                    matrix['genotype'][n], matrix['frequency'][n], 
+                    matrix['depth'][n])
+        for var in report.data:
+            call = var.samples[0]
+            genotype, frequency, depth = entries[
+                report.make_variant_name(var)]
+            self.assertEqual(genotype, codes[call['GT']])
+            self.assertAlmostEqual(frequency, call['VF'], places=5)
+            self.assertEqual(depth, sum(call['AD']))
+
+
+    def test_filter(self):
+        """Check that -F and --filter leave variants out of the matrix"""
+        full = self.make_matrix()
+        matrix = self.make_matrix(['-F', '--filter', 'POS > 100000000'])
+        self.assertTrue(0 < len(matrix['variants']) < len(full['variants']))
+        self.assertEqual(len(matrix['row']), 
+                         len(set(matrix['row'].tolist())) * 2 - 1)
+        with self.assertRaises(ValueError):
+            self.make_matrix(['--filter', 'IMPACT == HIGH'])
+
+
+class TestCheckpoint(OutputFolderTest):
+    def setUp(self):
+        """make an output folder and the options of every run"""
+        OutputFolderTest.setUp(self)
+        self.options = ['-c', 'test/config.txt', '--summary', 
+            '-t', 'test/PreferredTranscripts.txt', 
+            '-k', 'test/KnownVariants.vcf', 
+            '-b', 'test/test_bed_files/bed2.bed']
+
+
+    def single_run(self, vcf, options):
+        """files made by a run without checkpoints"""
+        folder = os.path.join(self.output, 'single')
+        os.makedirs(folder)
+        run(get_args([vcf, '-O', folder] + options), reference_data())
+        return(self.read_files(folder))
+
+
+    def checkpoint_args(self, vcf, options, resume=False):
+        """arguments of a run with a checkpoint after every 5KB"""
+        folder = os.path.join(self.output, 'checkpoints')
+        args = [vcf, '-O', folder, '--checkpoint', '--checkpoint_size', 
+                '0.005'] + options
+        if resume:
+            args.append('--resume')
+        return(get_args(args))
+
+
+    def test_same_as_single_run(self):
+        """Check that the reports are the same as without checkpoints"""
+        for vcf in ('test/test.vcf', 'test/edge_variants.vcf',
+                    'test/empty_vcf.vcf'):
+            expected = self.single_run(vcf, self.options)
+            runner = checkpoint_runner(self.checkpoint_args(vcf, 
+                self.options), run, reference_data())
+            checkpoint = runner.run()
+            self.assertEqual(self.read_files(runner.output), expected)
+            if vcf == 'test/test.vcf':
+                self.assertTrue(len(checkpoint['ranges']) > 5)
+            shutil.rmtree(os.path.join(self.output, 'single'))
+            shutil.rmtree(runner.output)
+
+
+    def test_resume(self):
+        """
+        Check that a run interrupted after a checkpoint, with part of 
+        the next range written, gives the same reports once resumed
+        """
+        class interrupted(Exception):
+            pass
+
+        class interrupted_runner(checkpoint_runner):
+            def run_range(self, checkpoint, index):
+                checkpoint_runner.run_range(self, checkpoint, index)
+                if index == 3:
+                    for name in checkpoint['reports']:
+                        with open(os.path.join(self.output, name), 'a') as f:
+                            f.write('partial row\t')
+                    raise interrupted()
+
+        options = self.options + ['--filter', 'POS > 1000', 
+                                  '--preferred_only']
+        expected = self.single_run('test/test.vcf', options)
+        runner = interrupted_runner(self.checkpoint_args('test/test.vcf', 
+            options), run, reference_data())
+        with self.assertRaises(interrupted):
+            runner.run()
+        with open(runner.checkpoint_path) as f:
+            self.assertEqual(json.load(f)['next'], 3)
+
+        # other options can't be used to resume
+        with self.assertRaises(ValueError):
+            checkpoint_runner(self.checkpoint_args('test/test.vcf', 
+                options[:-1], resume=True), run, reference_data()).run()
+
+        runner = checkpoint_runner(self.checkpoint_args('test/test.vcf', 
+            options, resume=True), run, reference_data())
+        runner.run()
+        self.assertEqual(self.read_files(runner.output), expected)
+
+
+@unittest.skipIf(numpy is None, 'numpy not installed')
+class TestSharedReference(OutputFolderTest):
+    def test_shared_table(self):
+        """Check that every key is found, and that missing keys aren't"""
+        mapping = dict(('{}:{}A>G'.format(n % 23, n), str(n % 5)) 
+                       for n in range(2000))
+        mapping['1:100' + 'A' * 300 + '>A'] = '1,2'
+
+        # values are text, which is bytes in python 2
+        text = u'\u00e9'
+        if bytes is str:
+            text = text.encode('utf-8')
+        mapping[text] = text * 2
+        table = shared_table.write(self.output, 'test', mapping)
+        self.assertEqual(len(table), len(mapping))
+        keys = sorted(mapping) + ['missing', '', '1:0A>C']
+        self.assertEqual(table.lookup(keys), 
+                         [mapping.get(key) for key in keys])
+        self.assertEqual(table.get('missing', 'none'), 'none')
+
+        empty = shared_table.write(self.output, 'empty', {})
+        self.assertEqual(empty.lookup(['1:0A>G']), [None])
+
+
+    def test_known_variants(self):
+        """
+        Check that the shared known variants annotate rows in the same
+        way as the loaded known variants, and that the shared folder is
+        removed
+        """
+        known = reference_data().known_variants('test/KnownVariants.vcf')
+        shared = shared_references(known, self.output)
+        rows = []
+        for each in (known, shared_known_variants(shared.folder)):
+            report = vcf_report()
+            report.load_data('test/test.vcf', self.output)
+            report.make_report(False)
+            each.apply_known_variants(report)
+            rows.append([row.values for row in report.table.rows])
+        self.assertEqual(rows[1], rows[0])
+        column = report.table.column('Classification')
+        self.assertTrue(any(values[column] for values in rows[1]))
+        shared.close()
+        self.assertFalse(os.path.exists(shared.folder))
+
+
+    def test_workers(self):
+        """
+        Check that reports with preferred transcripts and known variants
+        applied by the workers are the same as from one process
+        """
+        references = reference_data()
+        config = references.config('test/config.txt')
+        for options in (['-k', 'test/KnownVariants.vcf', 
+                         '-t', 'test/PreferredTranscripts.txt'],
+                        ['-k', 'test/KnownVariants.vcf', '-c', 
+                         'test/config.txt', '-c', 'test/config.txt']):
+            folders = []
+            for processes in ('1', '2'):
+                folder = tempfile.mkdtemp(dir=self.output)
+                run(get_args(['test/test.vcf', '-O', folder, '--processes', 
+                    processes] + options), references)
+                folders.append(folder)
+            for name in os.listdir(folders[0]):
+                with open(os.path.join(folders[0], name)) as f:
+                    expected = f.read()
+                with open(os.path.join(folders[1], name)) as f:
+                    self.assertEqual(f.read(), expected)
+
+        # the known variants can't be sent to the workers, so they must
+        # be read from the shared table
+        class unpicklable_known(known_variants):
+            def __reduce__(self):
+                raise TypeError('known variants sent to a worker')
+
+        known = unpicklable_known()
+        known.load_known_variants('test/KnownVariants.vcf')
+        transcripts = references.transcripts('test/PreferredTranscripts.txt')
+        report = vcf_report()
+        report.open_data('test/test.vcf', self.output)
+        report.vcf_file.close()
+        report.config = config
+        parallel = parallel_parser('test/test.vcf', 2, 4)
+        parallel.make_reports(False, [report], transcripts, 'low', known)
+        self.assertTrue(parallel.transcripts_applied)
+        self.assertTrue(parallel.known_applied)
+        self.assertTrue(any(report.table.value(row, 'Classification') 
+                            for row in report.table.rows))
+
+
+    def test_from_file(self):
+        """
+        Check that known variants read straight from the VCF give the
+        same table as a loaded known_variants object
+        """
+        known = reference_data().known_variants('test/KnownVariants.vcf')
+        keys = list(known.classifications) + ['1:0A>G']
+        tables = []
+        for each in (known, 'test/KnownVariants.vcf'):
+            shared = shared_references(each, self.output)
+            tables.append(shared_table(shared.folder, 'known').lookup(keys))
+            shared.close()
+        self.assertEqual(tables[1], tables[0])
+
+
+    def test_cleanup(self):
+        """
+        Check that folders left by a program that is no longer running
+        are removed, and that folders are removed when the program exits
+        """
+        stale = os.path.join(self.output, '{}999999999_abc'.format(
+            SHARED_PREFIX))
+        other = os.path.join(self.output, 'other')
+        os.makedirs(stale)
+        os.makedirs(other)
+        shared = shared_references('test/KnownVariants.vcf', self.output)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(other))
+        self.assertTrue(os.path.basename(shared.folder).startswith(
+            '{}{}_'.format(SHARED_PREFIX, os.getpid())))
+
+        # a program that is stopped part way through a run 
+        script = ('import sys\n'
+                  'from scripts.shared_reference import shared_references\n'
+                  'shared = shared_references("test/KnownVariants.vcf", '
+                  'sys.argv[1])\n'
+                  'print(shared.folder)\n'
+                  'raise KeyboardInterrupt\n')
+        process = subprocess.Popen([sys.executable, '-c', script, 
+            self.output], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        folder = out.decode('utf-8').strip()
+        self.assertTrue(folder.startswith(self.output))
+        self.assertFalse(os.path.exists(folder))
+        shared.close()
+        shared.close()
+        self.assertFalse(os.path.exists(shared.folder))
+
+
+class TestAutoPlan(OutputFolderTest):
+    def large_plan(self, options):
+        """
+        Plan for a VCF like test.vcf but a thousand times larger, with 4 
+        CPUs
+        """
+        plan = run_plan(get_args(['test/test.vcf', '-O', self.output] + 
+                                 options), cpus=4)
+        plan.scan = prescan('test/test.vcf', plan.args.config or ())
+        for key in ('records', 'data_bytes'):
+            plan.scan[key] *= 1000
+        return(plan)
+
+
+    def test_prescan(self):
+        """Check what the pre-scan finds against the report made"""
+        scan = prescan('test/test.vcf')
+        self.assertEqual(scan['records'], 96)
+        self.assertEqual(scan['samples'], 1)
+        self.assertFalse(scan['compressed'])
+        self.assertIsNone(scan['index'])
+        self.assertEqual(scan['beds'], 0)
+
+        report = vcf_report()
+        report.load_data('test/test.vcf', self.output)
+        report.make_report(False)
+        self.assertEqual(scan['columns'], [len(report.make_header())])
+        self.assertEqual(int(scan['records'] * scan['transcripts']), 
+                         len(report.table.rows))
+
+        scan = prescan('test/test.vcf', ['test/config.txt'], 
+                       bed_folder='test/test_bed_files/')
+        self.assertEqual(scan['columns'], [14])
+        self.assertEqual(scan['beds'], 4)
+
+        scan = prescan('test/empty_vcf.vcf')
+        self.assertEqual(scan['records'], 0)
+        self.assertEqual(scan['data_bytes'], 0)
+
+
+    def test_compressed(self):
+        """Check that the size of a compressed VCF is estimated"""
+        path = os.path.join(self.output, 'test.vcf.gz')
+        with open('test/test.vcf', 'rb') as vcf:
+            with gzip.open(path, 'wb') as out:
+                out.write(vcf.read())
+        scan = prescan(path)
+        self.assertTrue(scan['compressed'])
+        self.assertTrue(scan['size'] < scan['uncompressed'])
+        self.assertEqual(scan['uncompressed'], 
+                         os.path.getsize('test/test.vcf'))
+        self.assertEqual(scan['records'], 96)
+
+        # compressed VCFs can't be split between processes
+        plan = run_plan(get_args([path, '-O', self.output]), cpus=4)
+        self.assertEqual(plan.apply()['strategy'], 'memory')
+        self.assertEqual(plan.args.processes, 1)
+
+
+    def test_choose(self):
+        """Check the plan chosen with and without a memory budget"""
+        plan = self.large_plan([])
+        chosen = plan.choose()
+        self.assertEqual(chosen['strategy'], 'memory')
+        self.assertEqual(chosen['processes'], 4)
+
+        # the budget rules out making the report in memory
+        plan = self.large_plan(['--max_memory', '150'])
+        chosen = plan.choose()
+        self.assertEqual(chosen['strategy'], 'pipeline')
+        self.assertTrue(chosen['memory'] <= 150 * MB)
+
+        # several configs can't be pipelined, and the columnar engine 
+        # is used with a config
+        plan = self.large_plan(['--max_memory', '60', 
+            '-c', 'test/config.txt', '-c', 'test/config.txt'])
+        chosen = plan.choose()
+        self.assertEqual(chosen['strategy'], 'ranges')
+        self.assertEqual(chosen['engine'], 'columnar')
+        self.assertTrue(chosen['memory'] <= 60 * MB)
+
+        # the plan needing least memory is used if none fit
+        plan = self.large_plan(['--max_memory', '1'])
+        chosen = plan.choose()
+        self.assertEqual(chosen['memory'], min(each['memory'] for each in 
+                                               plan.candidates()))
+
+        # options given are kept
+        chosen = self.large_plan(['--pipeline', '--max_memory', '1']).choose()
+        self.assertEqual(chosen['strategy'], 'pipeline')
+        chosen = self.large_plan(['--processes', '2']).choose()
+        self.assertEqual(chosen['processes'], 2)
+        chosen = self.large_plan(['--sort_by', 'gene', 
+                                  '--max_memory', '60']).choose()
+        self.assertNotEqual(chosen['strategy'], 'ranges')
+
+
+    def test_same_reports(self):
+        """Check that the reports are the same as without --auto"""
+        options = ['-c', 'test/config.txt', '--summary',
+            '-t', 'test/PreferredTranscripts.txt', 
+            '-k', 'test/KnownVariants.vcf', 
+            '-b', 'test/test_bed_files/bed2.bed']
+        single = os.path.join(self.output, 'single')
+        os.makedirs(single)
+        run(get_args(['test/test.vcf', '-O', single] + options), 
+            reference_data())
+        expected = self.read_files(single)
+
+        for auto in (['--auto'], ['--auto', '--max_memory', '41'], 
+                ['--auto', '--checkpoint', '--checkpoint_size', '0.005']):
+            folder = os.path.join(self.output, 'auto')
+            os.makedirs(folder)
+            args = get_args(['test/test.vcf', '-O', folder] + options + auto)
+            run_plan(args).apply()
+            if args.checkpoint:
+                checkpoint_runner(args, run, reference_data()).run()
+            else:
+                run(args, reference_data())
+            self.assertEqual(self.read_files(folder), expected)
+            shutil.rmtree(folder)
+
+
+    def test_stdin(self):
+        """Check that options aren't changed for stdin"""
+        args = get_args(['-', '-O', self.output, '--auto'])
+        self.assertIsNone(run_plan(args).apply())
+        self.assertFalse(args.pipeline)
+
+
 # Runs all tests when the script is run
 # command: python -m unittest -v test
 if __name__ == '__main__':
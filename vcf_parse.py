@@ -1,4 +1,4 @@
-#!/anaconda3/envs/python2/bin/python
+#!/usr/bin/env python
 
 """
 vcf_parse.py
@@ -11,7 +11,7 @@ Usage:  vcf_parse.py [-h] [-v]
                      [-t TRANSCRIPTS] [-T TRANSCRIPT_STRICTNESS] 
                      [-b BED | -B BED_FOLDER] 
                      [-k KNOWN_VARIANTS]
-                     [-c CONFIG] [-l] 
+                     [-c CONFIG [-c CONFIG ...]] [-l] 
                      input
         vcf_parse.py -h for full description of options.
 
@@ -24,21 +24,41 @@ __version__ = '0.1.0'
 __updated__ = '31 Oct 2018'
 
 
+import os
 import argparse
 import logging
 import textwrap
 
 from scripts.vcf_report import vcf_report
-from scripts.preferred_transcripts import preferred_transcripts
+from scripts.preferred_transcripts import preferred_transcripts, \
+    transcript_chooser
 from scripts.bed_object import bed_object
 from scripts.known_variants import known_variants
+from scripts.reference_data import reference_data
+from scripts.daemon import vcf_daemon
+from scripts.watch_folder import watch_folder
+from scripts.pipeline import report_pipeline
+from scripts.file_utils import open_text, STDIO
+from scripts.report_summary import report_summary
+from scripts.vcf_backends import BACKENDS
+from scripts.columnar_engine import columnar_engine, choose_engine, ENGINES
+from scripts.filter_expression import record_filter
+from scripts.parallel_parse import parallel_parser, can_map, vcf_lines
+from scripts.shared_reference import shared_references, numpy
+from scripts.shards import shard_runner, SHARD_STEPS, SHARD_BY
+from scripts.partitioned_output import partition_writer, PARTITION_KEYS
+from scripts.external_sort import external_sort, make_sort_key, SORT_KEYS
+from scripts.cohort_matrix import cohort_matrix, MATRIX_NAME
+from scripts.checkpoint import checkpoint_runner
+from scripts.auto_plan import run_plan
 
 
 ## -- PARSE INPUT ARGUMENTS -------------------------------------------
 
-def get_args():
+def get_args(argv=None):
     """
-    Use argparse package to take arguments from the command line. 
+    Use argparse package to take arguments from the command line, or 
+    from argv if given. 
     See descriptions for full detail of each argument.
     """
 
@@ -64,10 +84,11 @@ def get_args():
 
 
     # Arguments (see help string for full descriptions):
-    # REQUIRED: VCF file input
+    # REQUIRED: VCF file input, unless running in daemon mode
     parser.add_argument(
-        'input', action='store', 
-        help='Filepath to input VCF file. REQUIRED.'
+        'input', action='store', nargs='?', 
+        help='Filepath to input VCF file, or - to read the VCF from stdin. '
+             'REQUIRED unless using --daemon, --watch or --cohort.'
     )
 
 
@@ -117,6 +138,22 @@ def get_args():
     ))
 
 
+    # OPTIONAL: Only include the preferred transcript of each variant
+    parser.add_argument(
+        '--preferred_only', action='store_true', 
+        help=textwrap.dedent(
+        '''
+        Only include the preferred transcript of each variant (see -t),
+        or the single best transcript if none of them are preferred, 
+        instead of a row for every NM transcript. The best transcript 
+        is the one picked by VEP (PICK), then MANE Select, then the 
+        canonical transcript, then the most severe IMPACT, then the 
+        first in the CSQ field. Transcripts are chosen while the report
+        is made, so the report is much smaller.
+        \n'''
+    ))
+
+
     # OPTIONAL: either a single BED file or a folder containing BED 
     # files, only one of these can be used
     bed_files = parser.add_mutually_exclusive_group()
@@ -179,10 +216,12 @@ def get_args():
 
     # OPTIONAL: File containing the headers for the report
     parser.add_argument(
-        '-c', '--config', action='store', 
+        '-c', '--config', action='append', 
         help=textwrap.dedent(
         '''
-        Filepath to config file. 
+        Filepath to config file. Can be given more than once to make a 
+        report for each config from one pass over the VCF, these are 
+        saved as <sample>_<config name>_VariantReport.txt.
 
         This is a tab seperated text file containing a number of rows, where 
         each row specifies an annotation to be included in the variant report.
@@ -230,78 +269,918 @@ def get_args():
         \n'''
     ))
 
-    return parser.parse_args()
+    # OPTIONAL: Filter expression
+    parser.add_argument(
+        '--filter', action='store', 
+        help=textwrap.dedent(
+        '''
+        Only include variants and transcripts that match a filter
+        expression, e.g. 'DP>=100 and IMPACT in (HIGH,MODERATE)'. 
+        Conditions are field op value, where op is one of == != < <= 
+        > >=, or field in (value,...), field not in (...), or just a
+        field to check it has a value. Conditions can be joined with
+        and, or, not and brackets. Fields are looked up in the record
+        (CHROM, POS, REF, ALT, FILTER), then INFO, FORMAT and VEP, a
+        prefix such as INFO. or VEP. picks one. Conditions on the 
+        variant are checked before the CSQ field is decoded, conditions
+        on VEP fields are checked for each transcript.
+        \n'''
+    ))
+
+    # OPTIONAL: Pipelined mode
+    parser.add_argument(
+        '--pipeline', action='store_true', 
+        help=textwrap.dedent(
+        '''
+        Make the variant report with seperate reader, transform and writer
+        threads connected by bounded queues, so that reading and writing 
+        overlap with making the report rows. The records of the VCF are 
+        not all held in memory. Output is identical to the default mode.
+        Queue occupancy is logged at the end, for tuning --queue_size.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Size of pipeline queues
+    parser.add_argument(
+        '--queue_size', action='store', type=int, default=64, 
+        help=textwrap.dedent(
+        '''
+        Number of batches of 100 records/ rows that each queue can hold 
+        in --pipeline mode. Default is 64.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Parse the VCF with several worker processes
+    parser.add_argument(
+        '--processes', action='store', type=int, default=1, 
+        help=textwrap.dedent(
+        '''
+        Number of worker processes used to make the variant report. The
+        VCF is memory-mapped and split into ranges of whole lines, each
+        worker parses its own ranges and the rows are joined in order,
+        so the report is the same as with one process. Only used for 
+        uncompressed VCF files, not with --pipeline. Default is 1.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Library used to read VCFs
+    parser.add_argument(
+        '--backend', action='store', choices=BACKENDS, default=BACKENDS[0],
+        help=textwrap.dedent(
+        '''
+        Library used to read the input and known variants VCFs. Reports 
+        are the same whichever is used.
+
+        Options:
+
+        pyvcf - PyVCF, pure Python (default)
+        pysam - htslib through pysam, much faster. If pysam isn't 
+                installed, pyvcf is used instead.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Engine used to make the report rows
+    parser.add_argument(
+        '--engine', action='store', choices=ENGINES, default=ENGINES[0],
+        help=textwrap.dedent(
+        '''
+        How the values in the report are worked out. Reports are the same
+        whichever is used.
+
+        Options:
+
+        row      - each field is parsed one record at a time (default)
+        columnar - numeric INFO and FORMAT fields are decoded into numpy
+                   arrays for batches of 1000 records, and the allele 
+                   frequency is worked out for the whole batch at once. 
+                   Needs numpy, if it isn't installed the row engine is
+                   used instead.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Write the variant report to stdout
+    parser.add_argument(
+        '--stdout', action='store_true', 
+        help=textwrap.dedent(
+        '''
+        Write the main variant report to stdout instead of saving it in
+        the output folder, e.g. to pipe it into bgzip. Log messages are
+        written to stderr. Any BED file reports and summaries are still
+        saved in the output folder.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Reuse decoded VCF records between runs
+    parser.add_argument(
+        '--record_cache', action='store_true', 
+        help=textwrap.dedent(
+        '''
+        Save the decoded VCF records to <input>.records.cache, and load 
+        them from there on later runs instead of parsing the VCF again, 
+        e.g. when trying different configs or BED files. The cache is 
+        only used if the size, modification time and hash of the VCF 
+        haven't changed. Not used with --pipeline or stdin.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Compress the variant report
+    parser.add_argument(
+        '--gzip_output', action='store_true', 
+        help=textwrap.dedent(
+        '''
+        Compress the main variant report with gzip, it will be saved as
+        <sample>_VariantReport.txt.gz. Input VCFs ending in .gz are always
+        decompressed.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Save summary statistics
+    parser.add_argument(
+        '--summary', action='store_true', 
+        help=textwrap.dedent(
+        '''
+        Save summary statistics as <sample>_VariantSummary.json next to
+        the variant report: number of variants per gene, IMPACT and 
+        consequence, and histograms of depth (DP) and variant frequency.
+        These are collected while the report is made. Needs numpy.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Cache of VEP columns shared between runs
+    parser.add_argument(
+        '--annotation_cache', action='store', 
+        help=textwrap.dedent(
+        '''
+        Filepath of a cache of finished VEP columns, created if it doesn't
+        exist. Transcripts seen in earlier runs are taken from the cache
+        instead of being formatted again, this is faster when the same
+        variants come up in most samples, e.g. amplicon panels. The cache
+        is saved at the end of each run. The number of cache hits and
+        misses is logged.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Folder of compiled BED file indexes
+    parser.add_argument(
+        '--bed_cache', action='store', 
+        help=textwrap.dedent(
+        '''
+        Folder of compiled BED file indexes, created if it doesn't 
+        exist. Each BED file is read, sorted and saved as an interval 
+        index the first time it is used, later runs load the index 
+        memory-mapped and find the variants in it without bedtools. 
+        Indexes are kept by the path and hash of the BED file, so a 
+        changed BED file is compiled again. Needs numpy, if it isn't 
+        installed bedtools is used instead.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Size of the annotation cache
+    parser.add_argument(
+        '--cache_size', action='store', type=int, default=100000, 
+        help=textwrap.dedent(
+        '''
+        Most transcripts kept in the annotation cache, the least recently
+        used are removed first. Default is 100000.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Split the report by chromosome or gene
+    parser.add_argument(
+        '--partition_by', action='store', choices=PARTITION_KEYS, 
+        help=textwrap.dedent(
+        '''
+        As well as the main report, save the report split into one file 
+        per chromosome or gene (SYMBOL column), in a folder named 
+        <sample>_VariantReport_by_<chrom/gene> within the output folder.
+
+        Options:
+
+        chrom - one file per chromosome, e.g. 17.txt
+        gene  - one file per gene, e.g. TP53.txt, rows without a gene 
+                are saved in no_gene.txt
+        \n'''
+    ))
+
+
+    # OPTIONAL: Most partition files open at once
+    parser.add_argument(
+        '--max_open_files', action='store', type=int, default=64, 
+        help=textwrap.dedent(
+        '''
+        Most partition files kept open at once with --partition_by, the 
+        least recently used file is closed when another is needed. 
+        Default is 64.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Save a manifest of the partition files
+    parser.add_argument(
+        '--partition_manifest', action='store_true', 
+        help=textwrap.dedent(
+        '''
+        With --partition_by, save manifest.txt in the partition folder 
+        with the number of rows and size in bytes of each file.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Sort the report
+    parser.add_argument(
+        '--sort_by', action='store', choices=SORT_KEYS, 
+        help=textwrap.dedent(
+        '''
+        Sort the variant report. If missing, rows are in the same order as
+        the VCF.
+
+        Options:
+
+        position    - chromosome then position
+        gene        - SYMBOL then position, SYMBOL must be in the report
+        consequence - Consequence then position, Consequence must be in
+                      the report
+
+        With --pipeline, sorting works on reports larger than memory, 
+        see --memory_budget.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Remove duplicates across the whole report
+    parser.add_argument(
+        '--dedup', action='store_true', 
+        help=textwrap.dedent(
+        '''
+        Remove rows that are identical to any earlier row in the report. 
+        By default only rows identical to the row directly before are 
+        removed.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Memory budget for sorting
+    parser.add_argument(
+        '--memory_budget', action='store', type=float, default=512, 
+        help=textwrap.dedent(
+        '''
+        Approximate memory in MB used to hold rows while sorting or 
+        removing duplicates, once it is used sorted rows are saved to 
+        --scratch_dir and merged at the end. Default is 512. Without 
+        --pipeline the whole report is held in memory before it is 
+        sorted, this only limits the memory used on top of it.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Scratch folder for sorting
+    parser.add_argument(
+        '--scratch_dir', action='store', 
+        help=textwrap.dedent(
+        '''
+        Folder for temporary files made while sorting. Defaults to the 
+        system temp folder.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Step of a run split into shards
+    parser.add_argument(
+        '--shard', action='store', choices=SHARD_STEPS, 
+        help=textwrap.dedent(
+        '''
+        Split the report of a very large uncompressed VCF into shards 
+        that can be run on different machines, e.g. as an array job:
+        plan  - split the input VCF into shards (see --shard_by) and 
+                save them with the other options given in the manifest
+                (see --manifest).
+        run   - make the reports of one shard (see --shard_index) in
+                <output>/shards/shard_<index>, with the options saved 
+                in the manifest.
+        merge - join the reports of all the shards, including BED file
+                reports, into the output folder. These are the same as
+                the reports of a single run. The summary and shard 
+                metrics are added up.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Shard manifest
+    parser.add_argument(
+        '--manifest', action='store', 
+        help=textwrap.dedent(
+        '''
+        Filepath to the shard manifest, made by --shard plan and needed
+        for --shard run and --shard merge. Default for plan is 
+        <output>/shard_manifest.json.
+        \n'''
+    ))
+
+
+    # OPTIONAL: How shards are split
+    parser.add_argument(
+        '--shard_by', action='store', choices=SHARD_BY, default=SHARD_BY[0],
+        help=textwrap.dedent(
+        '''
+        How the records are split into shards with --shard plan:
+        contig - one shard for each contig (default). The VCF must be
+                 sorted so that the records of each contig are together.
+        size   - shards of about --shard_size MB.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Size of shards
+    parser.add_argument(
+        '--shard_size', action='store', type=float, default=1024, 
+        help=textwrap.dedent(
+        '''
+        Size of each shard in MB with --shard_by size. Default is 1024.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Shard to run
+    parser.add_argument(
+        '--shard_index', action='store', type=int, 
+        help=textwrap.dedent(
+        '''
+        Index of the shard made by --shard run, from 0, e.g. the task 
+        ID of an array job.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Save checkpoints so that an interrupted run can resume
+    parser.add_argument(
+        '--checkpoint', action='store_true', 
+        help=textwrap.dedent(
+        '''
+        Make the reports of an uncompressed VCF in ranges of 
+        --checkpoint_size MB, one after the other, saving a checkpoint 
+        in the output folder after each. If the run is interrupted, run 
+        it again with --resume to carry on from the last checkpoint. The
+        reports are the same as without checkpoints.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Size of the ranges between checkpoints
+    parser.add_argument(
+        '--checkpoint_size', action='store', type=float, default=256, 
+        help=textwrap.dedent(
+        '''
+        Size in MB of the VCF read between checkpoints. Default is 256.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Resume an interrupted run from its checkpoint
+    parser.add_argument(
+        '--resume', action='store_true', 
+        help=textwrap.dedent(
+        '''
+        Carry on an interrupted --checkpoint run from the last checkpoint
+        saved in the output folder. The input VCF and options must be 
+        the same. If there is no checkpoint, the run starts from the 
+        beginning. Implies --checkpoint.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Choose how to make the report from a pre-scan of the VCF
+    parser.add_argument(
+        '--auto', action='store_true', 
+        help=textwrap.dedent(
+        '''
+        Pre-scan the input VCF (its size, compression, index, samples,
+        CSQ entries and NM transcripts per record, report columns and 
+        BED files) and choose the engine, number of processes and 
+        whether the report is made in memory, pipelined or in ranges, 
+        to be as fast as possible within --max_memory. Options given on
+        the command line are kept. The plan, with its estimated time 
+        and memory, is logged before the report is made.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Memory budget for --auto
+    parser.add_argument(
+        '--max_memory', action='store', type=float, 
+        help=textwrap.dedent(
+        '''
+        Memory in MB that the plan chosen by --auto should fit in. By 
+        default there is no limit.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Build a variant by sample matrix of a cohort
+    parser.add_argument(
+        '--cohort', action='store', nargs='+', metavar='VCF', 
+        help=textwrap.dedent(
+        '''
+        Build a sparse variant by sample matrix of the genotype, variant
+        frequency and depth of a cohort of single sample VCFs, instead 
+        of a variant report. Each VCF is given, or a text file listing 
+        VCFs one per line. The matrix is saved as 
+        Cohort_VariantMatrix.npz in the output folder. -F and --filter
+        (without VEP fields) choose the variants included.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Run as a daemon that keeps reference data loaded
+    parser.add_argument(
+        '--daemon', action='store', metavar='ADDRESS', 
+        help=textwrap.dedent(
+        '''
+        Run as a long-running daemon instead of processing a single VCF.
+
+        The daemon keeps the config, preferred transcripts and known 
+        variants files loaded in memory and accepts jobs on ADDRESS, which
+        can be a port number or host:port on localhost, or the filepath of
+        a unix socket. The host must be 127.0.0.1, localhost or ::1, the 
+        daemon can't be reached from other machines. Any options given 
+        alongside --daemon are used as the defaults for each job.
+
+        Requests and responses are single lines of JSON, e.g:
+            {"command": "submit", "input": "sample.vcf", "output": "out/"}
+            {"command": "status"}
+            {"command": "job", "job": 1}
+            {"command": "shutdown"}
+        \n'''
+    ))
+
+
+    # OPTIONAL: Number of worker threads in daemon mode
+    parser.add_argument(
+        '--workers', action='store', type=int, default=2, 
+        help=textwrap.dedent(
+        '''
+        Number of jobs the daemon runs at the same time. Default is 2.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Maximum number of queued jobs in daemon mode
+    parser.add_argument(
+        '--max_queue', action='store', type=int, default=100, 
+        help=textwrap.dedent(
+        '''
+        Maximum number of jobs waiting in the daemon queue, jobs 
+        submitted when the queue is full are rejected. Default is 100.
+        \n'''
+    ))
+
+    # OPTIONAL: Watch a folder for new VCFs
+    parser.add_argument(
+        '--watch', action='store', metavar='FOLDER', 
+        help=textwrap.dedent(
+        '''
+        Watch a folder and make a variant report for each new VCF as soon
+        as it has been fully written, instead of processing a single VCF.
+
+        The folder is polled every --poll_interval seconds, a VCF is 
+        processed once its size and modification time have not changed 
+        between two polls. Reference data is loaded once and reused for 
+        every VCF. All other options are applied to every VCF.
+        \n'''
+    ))
+
+
+    # OPTIONAL: State file for watch mode
+    parser.add_argument(
+        '--watch_state', action='store', 
+        help=textwrap.dedent(
+        '''
+        Filepath to the state file used by --watch to record which VCFs 
+        have already been processed, so they are not redone after a 
+        restart. Defaults to vcf_parse_watch_state.json in the output 
+        folder.
+        \n'''
+    ))
+
+
+    # OPTIONAL: Poll interval for watch mode
+    parser.add_argument(
+        '--poll_interval', action='store', type=float, default=5, 
+        help=textwrap.dedent(
+        '''
+        Seconds between polls of the folder in --watch mode. Default is 5.
+        \n'''
+    ))
+
+    # byte range of the input VCF to read, set for each shard run
+    parser.set_defaults(byte_range=None)
+
+    args = parser.parse_args(argv)
+    if args.daemon and args.watch:
+        parser.error('--daemon and --watch cannot be used together')
+    if args.input is None and args.daemon is None and args.watch is None \
+            and args.shard not in ('run', 'merge') and args.cohort is None:
+        parser.error('the following arguments are required: input')
+    if args.shard == 'run' and args.shard_index is None:
+        parser.error('--shard run needs --shard_index')
+    return args
 
 
 # -- MAIN FUNCTION ----------------------------------------------------
 
-def main(args):
-    # setup logger
-    logger = logging.getLogger('vcf_parse')
-    logger.setLevel(logging.DEBUG)
-    handler = logging.StreamHandler()
-    handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(
-        '%(levelname)s\t%(asctime)s\t%(name)s\t%(message)s'
-    )
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.info('running vcf_parse.py...')
+def get_config_files(config):
+    """
+    List of config filepaths from the --config argument, which can also
+    be a single filepath when set in a daemon job
+    """
+    if not config:
+        return([])
+    if isinstance(config, (list, tuple)):
+        return(list(config))
+    return([config])
+
+
+def config_names(config_files):
+    """
+    Names used for the report of each config, the config filename 
+    without its extension. A number is added if two are the same.
+    """
+    names = []
+    for path in config_files:
+        name = os.path.splitext(os.path.basename(path))[0]
+        n = 1
+        unique = name
+        while unique in names:
+            n += 1
+            unique = '{}{}'.format(name, n)
+        names.append(unique)
+    return(names)
 
-    # Load arguments, make vcf report object and load data
-    report = vcf_report()
-    report.load_data(args.input, args.output)
 
-    # If -l flag called, print headers and exit
+
+def run(args, references):
+    """
+    Makes the variant report for a single VCF and applies preferred 
+    transcripts, known variants and BED files to it. Reference files are
+    loaded through the reference_data object so that they can be reused
+    between runs.
+    """
+    logger = logging.getLogger('vcf_parse')
+
+    # If -l flag called, print headers and finish, only the VCF header
+    # needs to be read for this
     if args.config_list:
+        report = vcf_report()
+        with open_text(args.input, 'r') as vcf_input:
+            report.read_header(vcf_input)
         report.list_config()
-        exit()
-
-    # If config file provided, load config
-    if args.config:
-        report.load_config(args.config)
+        return(report)
+
+    # If several processes requested, each parses part of the VCF so only
+    # the header is read here
+    parallel = None
+    if args.processes > 1:
+        if args.pipeline:
+            raise ValueError('--processes cannot be used with --pipeline')
+        if can_map(args.input):
+            parallel = parallel_parser(args.input, args.processes)
+        else:
+            logger.warning('only uncompressed VCF files can be split '
+                'between processes -- making report in one process')
+
+    # Load arguments, make vcf report object and load data. In pipeline
+    # mode only the header is read here, records are read as they are
+    # needed
+    report = vcf_report(backend=args.backend)
+    if args.pipeline:
+        vcf_reader = report.open_data(args.input, args.output)
+    elif args.byte_range is not None:
+        report.load_lines(vcf_lines(args.input, *args.byte_range), 
+            args.output)
+    elif parallel is not None:
+        report.open_data(args.input, args.output)
+        report.vcf_file.close()
+        if args.record_cache:
+            logger.info('record cache is not used with --processes')
+    else:
+        report.load_data(args.input, args.output, args.record_cache)
+    if args.stdout:
+        report.report_path = STDIO
+    elif args.gzip_output:
+        report.report_path += '.gz'
+
+    # If annotation cache given, VEP columns are reused between runs
+    if args.annotation_cache:
+        report.annotation_cache = references.annotation_cache(
+            args.annotation_cache, args.cache_size)
+
+    # If columnar engine requested, numeric fields are decoded in batches
+    if choose_engine(args.engine) == 'columnar':
+        report.engine = columnar_engine(report)
+
+    # If filter expression given, it is compiled once from the header
+    if args.filter:
+        report.filter = record_filter(args.filter, report)
+
+    # If summary requested, it is collected while the report is made
+    if args.summary:
+        report.summary = report_summary(report)
+
+    # If config file provided, load config. If there is more than one,
+    # a report is made for each config from the same records, named 
+    # after the config file
+    reports = [report]
+    config_files = get_config_files(args.config)
+    if config_files:
+        report.config = references.config(config_files[0])
     else:
         logger.info('no config file found -- outputting all data from VCF.')
-
-    # Make variant report of whole VCF
-    report.make_report(args.filter_non_pass)
-
-    # If preferred transcripts provided, apply to variant report
+    if len(config_files) > 1:
+        if args.pipeline or args.stdout:
+            raise ValueError('only one config file can be used with '
+                '--pipeline or --stdout')
+        names = config_names(config_files)
+        report.set_name(names[0])
+        for path, name in zip(config_files[1:], names[1:]):
+            reports.append(
+                report.config_report(references.config(path), name))
+        if args.gzip_output:
+            for each in reports:
+                each.report_path += '.gz'
+
+    # Load preferred transcripts and known variants if provided
+    pt = None
     if args.transcripts:
-        pt = preferred_transcripts()
-        pt.load(args.transcripts)
-        pt.apply(report, args.transcript_strictness)
+        pt = references.transcripts(args.transcripts)
     else:
         logger.info('no preferred transcripts file provided -- preferred ' +
         'transcripts column will all be labelled as "Unknown"')
 
-    # If known variants provided, apply to variant report
-    if args.known_variants:
-        known = known_variants()
-        known.load_known_variants(args.known_variants)
-        known.apply_known_variants(report)
-    
+    # If only the preferred transcripts are wanted, they are chosen as
+    # the report is made
+    if args.preferred_only:
+        report.transcript_chooser = transcript_chooser(report, 
+            pt.list if pt else None, args.transcript_strictness)
+
+    # With several processes, known variants are read straight into a
+    # table shared with the workers, the main process keeps no copy
+    known = None
+    if args.known_variants and parallel is not None and numpy is not None:
+        known = shared_references(args.known_variants, backend=args.backend)
+    elif args.known_variants:
+        known = references.known_variants(args.known_variants, args.backend)
     else:
         logger.info('no known variants file provided -- Classification ' +
         'column will be empty')
 
+    # If sorting or removing duplicates across the whole report, this is
+    # done within the memory budget, saving to disk if needed
+    sort_rows = None
+    if args.sort_by or args.dedup:
+        def sort_rows(rows, report=report):
+            key = None
+            if args.sort_by:
+                key = make_sort_key(args.sort_by, report)
+            sorter = external_sort(key, args.dedup, args.memory_budget, 
+                args.scratch_dir)
+            return(sorter.sort(rows))
+
+    # If splitting the report, the partition files are made once the 
+    # header is complete
+    partitions = None
+    if args.partition_by:
+        def partitions(report=report):
+            return(partition_writer(report, args.partition_by, 
+                args.max_open_files, args.partition_manifest))
+
+    # In pipeline mode, make, annotate and save the variant report in 
+    # one pass with seperate reader, transform and writer threads. Rows
+    # are only kept in memory if they are needed for BED files
+    if args.pipeline:
+        pipeline = report_pipeline(report, queue_size=args.queue_size)
+        pipeline.run(vcf_reader, args.filter_non_pass, pt, 
+            args.transcript_strictness, known, 
+            keep_rows=bool(args.bed or args.bed_folder), sort_rows=sort_rows,
+            partitions=partitions)
+
+    else:
+        # Make variant report of whole VCF for each config in one pass,
+        # these are held in memory until all annotations have been 
+        # applied. With several processes, preferred transcripts and
+        # known variants are applied by the workers
+        applied_pt = False
+        applied_known = False
+        if parallel is not None:
+            try:
+                parallel.make_reports(args.filter_non_pass, reports, pt, 
+                    args.transcript_strictness, known)
+            finally:
+                if isinstance(known, shared_references):
+                    known.close()
+            applied_pt = parallel.transcripts_applied
+            applied_known = parallel.known_applied
+        else:
+            report.make_reports(args.filter_non_pass, reports)
+
+        for each in reports:
+            # If preferred transcripts provided, apply to variant report
+            if pt and not applied_pt:
+                pt.apply(each, args.transcript_strictness)
+
+            # If known variants provided, apply to variant report
+            if known and not applied_known:
+                known.apply_known_variants(each)
+
+            # Sort and/ or remove duplicates. Unless BED files still
+            # need them, rows are taken out of the table as they are 
+            # sorted and the sorted rows are written as they come out, 
+            # so no second copy of the report is held
+            rows = None
+            if sort_rows is not None:
+                if args.bed or args.bed_folder:
+                    each.table.rows = list(sort_rows(each.table.rows, each))
+                else:
+                    rows = sort_rows(each.table.take_rows(), each)
+
+            # Save the annotated variant report, and the report split by
+            # chromosome or gene in the same pass
+            writer = None
+            if partitions is not None:
+                writer = partitions(each)
+                rows = writer.pass_rows(
+                    each.table.rows if rows is None else rows)
+            each.write_report(rows)
+            if writer is not None:
+                writer.close()
+
+    # Report how many variants and transcripts were filtered out
+    if report.filter is not None:
+        report.filter.log_counts()
+    if report.transcript_chooser is not None:
+        report.transcript_chooser.log_counts()
+
+    # Report how well the annotation cache worked and save it
+    if report.annotation_cache is not None:
+        hits = sum(each.cache_hits for each in reports)
+        misses = sum(each.cache_misses for each in reports)
+        lookups = hits + misses
+        logger.info('annotation cache - {} hits, {} misses ({:.1f}% hit '
+            'rate), {} entries, {} evicted'.format(
+            hits, misses,
+            100.0 * hits / lookups if lookups else 0.0,
+            len(report.annotation_cache), 
+            report.annotation_cache.evicted))
+        report.annotation_cache.save()
+
+    # Save the summary statistics next to the report
+    if report.summary is not None:
+        report.summary.write(report.output_dir)
+
+    # If BED cache given, BED files are applied with their compiled
+    # indexes instead of bedtools
+    bed_cache = None
+    if args.bed_cache and (args.bed or args.bed_folder):
+        bed_cache = references.bed_index_cache(args.bed_cache)
+
     # If single BED file provided, make variant report with BED file 
     # applied
     if args.bed:
-        bed = bed_object()
-        bed.apply_single(args.bed, report)
+        bed = bed_object(bed_cache)
+        for each in reports:
+            bed.apply_single(args.bed, each)
 
     # If folder of BED file provided, make a seperate variant report 
     # for each BED file. Output will be saved in a folder named the 
     # same as the BED file folder, within the output directory.
     elif args.bed_folder:
-        bed = bed_object()
-        bed.apply_multiple(args.bed_folder, report)
+        bed = bed_object(bed_cache)
+        for each in reports:
+            bed.apply_multiple(args.bed_folder, each)
 
     # If no BED files provided, pass
     else:
         logger.info('no BED files provided')
 
+    return(report)
+
+
+def cohort_vcfs(paths):
+    """
+    VCF filepaths of the --cohort argument. Paths that aren't VCFs are
+    text files listing VCFs, one per line.
+    """
+    out = []
+    for path in paths:
+        if path.endswith(('.vcf', '.vcf.gz')):
+            out.append(path)
+            continue
+        with open(path) as vcf_list:
+            out.extend(line.strip() for line in vcf_list 
+                       if line.strip() and not line.startswith('#'))
+    return(out)
+
+
+def run_cohort(args):
+    """
+    Builds the variant by sample matrix of every VCF in the cohort and
+    saves it in the output folder. Returns the cohort_matrix object.
+    """
+    cohort = cohort_matrix(args.backend, args.filter_non_pass, args.filter)
+    for path in cohort_vcfs(args.cohort):
+        cohort.add_vcf(path)
+    if args.filter is not None:
+        logging.getLogger('vcf_parse').info('filter "{}" removed {} '
+            'variants'.format(args.filter, cohort.variants_removed))
+    output = os.path.abspath(args.output or '.')
+    cohort.save(os.path.join(output, MATRIX_NAME))
+    return(cohort)
+
+
+def setup_logger():
+    """
+    Add a handler to the vcf_parse logger that prints to the screen. 
+    The handler is only added once, however many times main is called.
+    """
+    logger = logging.getLogger('vcf_parse')
+    logger.setLevel(logging.DEBUG)
+    for handler in logger.handlers:
+        if getattr(handler, 'vcf_parse_handler', False):
+            return(logger)
+
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        '%(levelname)s\t%(asctime)s\t%(name)s\t%(message)s'
+    )
+    handler.setFormatter(formatter)
+    handler.vcf_parse_handler = True
+    logger.addHandler(handler)
+    return(logger)
+
+
+def main(args):
+    # setup logger
+    logger = setup_logger()
+    logger.info('running vcf_parse.py...')
+
+    # reference data is loaded once and shared between all runs
+    references = reference_data()
+
+    # If auto plan requested, the options used to make the report are
+    # chosen from a quick pre-scan of the input
+    if args.auto and args.input is not None and not (args.daemon or 
+            args.watch or args.shard or args.cohort or args.config_list):
+        run_plan(args).apply()
+
+    # If daemon mode called, keep reference data loaded and process
+    # jobs sent to the daemon until it is shut down
+    if args.daemon:
+        daemon = vcf_daemon(args, run, references)
+        daemon.serve()
+
+    # If watch mode called, keep reference data loaded and process new
+    # VCFs in the watched folder until interrupted
+    elif args.watch:
+        watcher = watch_folder(args, run, references)
+        watcher.watch()
+
+    # If shard step called, plan shards, make the reports of one shard
+    # or merge the reports of all the shards
+    elif args.shard:
+        shards = shard_runner(args, run, references)
+        if args.shard == 'plan':
+            shards.plan()
+        elif args.shard == 'run':
+            shards.run_shard(args.shard_index)
+        else:
+            shards.merge()
+
+    # If cohort called, build the variant by sample matrix of all the
+    # cohort VCFs
+    elif args.cohort:
+        run_cohort(args)
+
+    # If checkpoints requested, make the reports in ranges saving a 
+    # checkpoint after each, carrying on from the last one if resuming
+    elif args.checkpoint or args.resume:
+        checkpoints = checkpoint_runner(args, run, references)
+        checkpoints.run()
+
+    # Otherwise make the variant report for the input VCF
+    else:
+        run(args, references)
+
     # Finish
     logger.info('vcf_parse.py completed\n{}'.format('---'*30))
 